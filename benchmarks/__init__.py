@@ -0,0 +1,5 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Benchmarks for `fbchat`, run against :class:`benchmarks.fakefb.FakeFacebook` instead of the real Facebook servers
+"""
@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Compares sending an album of images one by one, against sending it as one message with
+:func:`Client.sendLocalFiles` (one upload request) and :func:`Client.sendRemoteFiles` (concurrent uploads)
+
+Usage: python -m benchmarks.album [--images 8] [--size 512] [--latency 0.05]
+"""
+
+from __future__ import unicode_literals, print_function, division
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from fbchat.models import ThreadType
+from .fakefb import FakeFacebook
+
+
+def measure(name, fake, send):
+    before = sum(fake.counts.values())
+    start = time.time()
+    send()
+    return {
+        'name': name,
+        'seconds': round(time.time() - start, 3),
+        'requests': sum(fake.counts.values()) - before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--images', type=int, default=8, help='Amount of images in the album')
+    parser.add_argument('--size', type=int, default=512, help='Size of each image, in KB')
+    parser.add_argument('--latency', type=float, default=0.05, help='Simulated latency of the server, in seconds')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        with FakeFacebook(latency=args.latency, bandwidth=8 * 1024**2) as fake:
+            paths, urls = [], []
+            for i in range(args.images):
+                content = os.urandom(args.size * 1024)
+                paths.append(os.path.join(directory, 'image{}.jpg'.format(i)))
+                with open(paths[-1], 'wb') as f:
+                    f.write(content)
+                fake.files['/static/image{}.jpg'.format(i)] = content
+                urls.append('{}/static/image{}.jpg'.format(fake.url, i))
+
+            client = fake.client()
+            thread = {'thread_id': '1234', 'thread_type': ThreadType.USER}
+            results = [
+                measure('sendLocalImage (one by one)', fake, lambda: [client.sendLocalImage(p, **thread) for p in paths]),
+                measure('sendLocalFiles', fake, lambda: client.sendLocalFiles(paths, **thread)),
+                measure('sendRemoteImage (one by one)', fake, lambda: [client.sendRemoteImage(u, **thread) for u in urls]),
+                measure('sendRemoteFiles', fake, lambda: client.sendRemoteFiles(urls, **thread)),
+            ]
+    finally:
+        shutil.rmtree(directory)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
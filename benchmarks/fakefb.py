@@ -0,0 +1,368 @@
+# -*- coding: UTF-8 -*-
+
+"""
+A local stand-in for the Facebook endpoints `fbchat` uses, so `fbchat` can be benchmarked without an account or network access.
+
+Usage::
+
+    with FakeFacebook(latency=0.02) as fake:
+        client = fake.client()
+        client.sendMessage('Hi', thread_id='1234', thread_type=ThreadType.USER)
+"""
+
+from __future__ import unicode_literals
+import json
+import logging
+import re
+import threading
+import time
+import zlib
+from collections import deque
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+from fbchat import Client
+from fbchat.utils import ReqUrl, mimetype_to_key
+from . import payloads
+
+#: The user ID of the fake account
+UID = '100000000000001'
+
+HOME_PAGE = """<html><body>
+<form><input type="hidden" name="fb_dtsg" value="AQFakeDtsg:AQFakeDtsg" /><input type="hidden" name="h" value="AfakeH" /></form>
+<form><input type="hidden" name="lsd" value="AVfakeLsd" /><input type="hidden" name="m_ts" value="1500000000" /></form>
+<script>{"client_revision":3000000,"server_revision":3000000}</script>
+</body></html>"""
+
+
+CHUNK_SIZE = 64 * 1024
+# Bodies larger than this are not kept in memory
+MAX_BODY = 1024 * 1024
+UPLOADED_FILE = re.compile(br'filename="[^"]*"\r\nContent-Type: ([^\r]+)\r\n\r\n')
+COOKIE_UID = re.compile(r'c_user=(\d+)')
+#: The `doc_id` of the GraphQL query for a thread and its messages
+THREAD_QUERY = '1386147188135407'
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections early (e.g. after rejecting a too large download) aren't errors here
+        pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which would otherwise be delayed by Nagle's algorithm
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status=200, body='', headers=None):
+        body = body.encode('utf-8') if not isinstance(body, bytes) else body
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _sendFile(self, content):
+        etag = '"{:x}"'.format(zlib.crc32(content) & 0xffffffff)
+        if self.headers.get('If-None-Match') == etag:
+            return self._respond(304, '', {'ETag': etag})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        for i in range(0, len(content), CHUNK_SIZE):
+            self.server.fake._throttle(CHUNK_SIZE)
+            self.wfile.write(content[i:i+CHUNK_SIZE])
+
+    def _bodyChunks(self, method):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return
+                self.server.fake._throttle(size)
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        elif method == 'POST':
+            remaining = int(self.headers.get('Content-Length') or 0)
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                self.server.fake._throttle(len(chunk))
+                yield chunk
+
+    def _readBody(self, method):
+        """
+        Returns the request body. Large bodies (uploads) aren't kept in memory:
+        Only the headers of the uploaded files are, so the memory use of the client can be measured in the same process
+        """
+        chunks, size, tail = [], 0, None
+        for chunk in self._bodyChunks(method):
+            size += len(chunk)
+            if size <= MAX_BODY:
+                chunks.append(chunk)
+                continue
+            if tail is None:
+                tail = b''.join(chunks)
+                chunks = [m.group(0) for m in UPLOADED_FILE.finditer(tail)]
+                tail = tail[-1024:]
+            data = tail + chunk
+            chunks.extend(m.group(0) for m in UPLOADED_FILE.finditer(data) if m.end() > len(tail))
+            tail = data[-1024:]
+        self.body_size = size
+        return b''.join(chunks)
+
+    def _handle(self, method):
+        fake = self.server.fake
+        url = urlsplit(self.path)
+        body = self._readBody(method)
+        fake._count(url.path)
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        if method == 'GET' and url.path in fake.files:
+            return self._sendFile(fake.files[url.path])
+
+        route = fake.routes.get((method, url.path)) or fake.routes.get((None, url.path))
+        if route is None:
+            return self._respond(404, 'Not found: {} {}'.format(method, url.path))
+        status, rtn, headers = route(self, url, body)
+        self._respond(status, rtn, headers)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+def patch_urls(url):
+    """
+    Points the URLs in :class:`fbchat.utils.ReqUrl` at `url`, e.g. at a server running in another process
+
+    :return: The original URLs, for :func:`unpatch_urls`
+    """
+    originals = {}
+    for name, value in vars(ReqUrl).items():
+        if name.isupper() and value.startswith('http'):
+            originals[name] = value
+            parts = urlsplit(value)
+            setattr(ReqUrl, name, url + parts.path + ('?' + parts.query if parts.query else ''))
+    return originals
+
+
+def unpatch_urls(originals):
+    """Restores the URLs changed by :func:`patch_urls`"""
+    for name, value in originals.items():
+        setattr(ReqUrl, name, value)
+
+
+def _json(obj):
+    # Facebook prefixes its JSON responses, to prevent JSON hijacking
+    return 'for (;;);' + json.dumps(obj)
+
+
+class FakeFacebook(object):
+    """
+    Serves fake responses for the Facebook endpoints in :class:`fbchat.utils.ReqUrl` on a local port.
+    While started, `ReqUrl` is patched to point at the server
+
+    :param latency: Seconds to wait before answering each request, to simulate the network
+    :param port: Port to listen on. Defaults to a random free port
+    :param bandwidth: Bytes per second to send and receive file contents with, per request. `None` means no limit
+    :param pull_timeout: Seconds a pull waits for messages before answering without any, like the long polling of Facebook
+    """
+    def __init__(self, latency=0, port=0, bandwidth=None, pull_timeout=1):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.pull_timeout = pull_timeout
+        #: File contents served on `GET` requests, labeled by path, e.g. `/static/image.png`
+        self.files = {}
+        self.port = port
+        #: Amount of requests received, labeled by path
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._message_counter = 0
+        # Messages waiting to be pulled, labeled by user ID
+        self._streams = {}
+        self._stream_condition = threading.Condition(self._lock)
+        self._original_urls = {}
+        self._server = None
+        #: Handlers, labeled by `(method, path)`. A method of `None` matches both GET and POST
+        self.routes = {
+            (None, '/'): self._home,
+            (None, '/home.php'): self._home,
+            ('GET', '/login.php'): self._loginPage,
+            ('POST', '/login.php'): self._login,
+            ('POST', '/messaging/send/'): self._send,
+            ('POST', '/ajax/mercury/upload.php'): self._upload,
+            ('POST', '/chat/remove_participants/'): self._ok,
+            ('POST', '/ajax/mercury/change_read_status.php'): self._ok,
+            ('POST', '/ajax/mercury/delivery_receipts.php'): self._ok,
+            ('POST', '/ajax/mercury/mark_seen.php'): self._ok,
+            ('POST', '/ajax/messaging/typ.php'): self._ok,
+            ('GET', '/pull'): self._pull,
+            ('GET', '/active_ping'): self._ok,
+            ('POST', '/api/graphqlbatch/'): self._graphql,
+            ('POST', '/fake/push'): self._push,
+        }
+        #: Sizes of the request bodies of the uploads received
+        self.upload_sizes = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def _throttle(self, size):
+        if self.bandwidth:
+            time.sleep(size / float(self.bandwidth))
+
+    def _count(self, path):
+        with self._lock:
+            self.counts[path] = self.counts.get(path, 0) + 1
+
+    def _nextMessageID(self):
+        with self._lock:
+            self._message_counter += 1
+            return 'mid.$fake{}'.format(self._message_counter)
+
+    def _home(self, handler, url, body):
+        return 200, HOME_PAGE, {'Content-Type': 'text/html'}
+
+    def _loginPage(self, handler, url, body):
+        if 'c_user=' in (handler.headers.get('Cookie') or ''):
+            return 302, '', {'Location': self.url + '/home.php'}
+        return 200, HOME_PAGE, {'Content-Type': 'text/html'}
+
+    def _login(self, handler, url, body):
+        # Logging in with a numeric ID logs in to that account, so multiple accounts can be simulated
+        email = parse_qs(body.decode('utf-8')).get('email', [''])[0]
+        return 302, '', {
+            'Location': self.url + '/home.php',
+            'Set-Cookie': 'c_user={}; Path=/'.format(email if email.isdigit() else UID),
+        }
+
+    def _send(self, handler, url, body):
+        return 200, _json({'payload': {'actions': [{'message_id': self._nextMessageID()}]}}), {}
+
+    def _ok(self, handler, url, body):
+        return 200, _json({'payload': {}}), {}
+
+    def _uid(self, handler):
+        match = COOKIE_UID.search(handler.headers.get('Cookie') or '')
+        return match.group(1) if match else UID
+
+    def push(self, uid, *ms):
+        """
+        Queues messages for the pull api of an account, e.g. from :func:`payloads.new_message_delta`
+
+        :param uid: The user ID of the account
+        :param ms: The messages
+        """
+        with self._stream_condition:
+            self._streams.setdefault(uid, deque()).extend(ms)
+            self._stream_condition.notify_all()
+
+    def pending(self, uid):
+        """Returns the amount of messages waiting to be pulled by an account"""
+        with self._lock:
+            return len(self._streams.get(uid, ()))
+
+    def _push(self, handler, url, body):
+        # Lets a load generator in another process feed the pull api, with `{uid: [message, ...]}`
+        for uid, ms in json.loads(body.decode('utf-8')).items():
+            self.push(uid, *ms)
+        return 200, _json({'payload': {}}), {}
+
+    def _pull(self, handler, url, body):
+        query = parse_qs(url.query)
+        if 'sticky_token' not in query:
+            return 200, _json({'t': 'lb', 'lb_info': {'sticky': '1', 'pool': 'fake'}}), {}
+        uid = self._uid(handler)
+        deadline = time.time() + self.pull_timeout
+        with self._stream_condition:
+            stream = self._streams.setdefault(uid, deque())
+            while len(stream) == 0 and time.time() < deadline:
+                self._stream_condition.wait(deadline - time.time())
+            ms = list(stream)
+            stream.clear()
+        if len(ms) == 0:
+            return 200, _json({'t': 'heartbeat'}), {}
+        return 200, payloads.pull(ms), {}
+
+    def _graphql(self, handler, url, body):
+        queries = json.loads(parse_qs(body.decode('utf-8'))['queries'][0])
+        results = []
+        for i in range(len(queries)):
+            query = queries['q{}'.format(i)]
+            params = query.get('query_params') or {}
+            if query.get('doc_id') == THREAD_QUERY:
+                limit = params.get('message_limit') if params.get('load_messages') else 0
+                results.append({'message_thread': payloads.group_node(str(params.get('id')), messages=limit or 0)})
+            else:
+                results.append({})
+        return 200, payloads.graphql_batch(results), {}
+
+    def _upload(self, handler, url, body):
+        self.upload_sizes.append(handler.body_size)
+        metadata = []
+        for mimetype in UPLOADED_FILE.findall(body):
+            mimetype = mimetype.decode('utf-8')
+            metadata.append({mimetype_to_key(mimetype): self._nextMessageID().split('$')[1], 'filetype': mimetype})
+        return 200, _json({'payload': {'metadata': metadata}}), {}
+
+    def _patch(self):
+        self._original_urls = patch_urls(self.url)
+
+    def _unpatch(self):
+        unpatch_urls(self._original_urls)
+        self._original_urls = {}
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', self.port), _Handler)
+        self._server.fake = self
+        thread = threading.Thread(target=self._server.serve_forever, name='fakefb')
+        thread.daemon = True
+        thread.start()
+        self._patch()
+        return self
+
+    def stop(self):
+        self._unpatch()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def client(self, client_class=Client, uid=UID, login=False, **kwargs):
+        """
+        Returns a client, logged in to the fake server
+
+        :param uid: The user ID of the account
+        :param login: Whether to log in with the login form, instead of with session cookies
+        """
+        kwargs.setdefault('logging_level', logging.ERROR)
+        if login:
+            return client_class(uid, 'password', **kwargs)
+        return client_class(uid, 'password', session_cookies={'c_user': uid}, **kwargs)
@@ -0,0 +1,87 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Measures how long importing `fbchat` takes, in fresh interpreters, and which modules take the longest (with `python -X importtime`).
+Short-lived processes pay this on every start.
+
+The results can be compared like those of :mod:`benchmarks.suite`
+
+Usage: python -m benchmarks.import_time [--repeat 10] [--output results.json] [--compare baseline.json]
+"""
+
+from __future__ import unicode_literals, print_function, division
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import fbchat
+from .suite import compare
+
+#: The statements that are timed, labeled by name
+STATEMENTS = [
+    ('import_fbchat', 'import fbchat'),
+    ('import_models', 'import fbchat.models'),
+    ('import_client', 'from fbchat import Client'),
+    # What's imported by the time a client has logged in
+    ('import_with_login', 'from fbchat import Client; import bs4, lxml.etree'),
+]
+
+TIMER = 'import time; start = time.perf_counter(); {}; print(time.perf_counter() - start)'
+
+
+def run(statement):
+    """Returns the seconds `statement` took in a new interpreter"""
+    output = subprocess.check_output([sys.executable, '-c', TIMER.format(statement)])
+    return float(output.decode('utf-8').strip())
+
+
+def slowest(statement, count):
+    """Returns the `count` modules that took the longest to import (including their own imports), in microseconds"""
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', statement], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    stderr = process.communicate()[1].decode('utf-8')
+    modules = []
+    for line in stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            modules.append((int(parts[1]), parts[2].strip()))
+    return sorted(modules, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=10, help='Amount of times each statement is timed')
+    parser.add_argument('--top', type=int, default=10, help='Amount of slowest modules to show')
+    parser.add_argument('--output', help='File to write the results to')
+    parser.add_argument('--compare', help='Results of an earlier run, to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change that counts as a regression')
+    args = parser.parse_args()
+
+    results = {
+        'fbchat': fbchat.__version__,
+        'python': platform.python_version(),
+        'time': int(time.time()),
+        'results': {},
+    }
+    for name, statement in STATEMENTS:
+        times = sorted(run(statement) for i in range(args.repeat))
+        results['results']['{}_seconds'.format(name)] = round(times[len(times) // 2], 5)
+        print('{:<20} median {:>8.1f} ms, min {:>8.1f} ms'.format(name, times[len(times) // 2] * 1000, times[0] * 1000))
+
+    print('\nSlowest modules of `from fbchat import Client`:')
+    for microseconds, module in slowest('from fbchat import Client', args.top):
+        print('{:>10.1f} ms  {}'.format(microseconds / 1000, module))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            raise SystemExit('Regressions: {}'.format(', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Simulates a bot farm: Many accounts listening at once, each running a handler like `examples/echobot.py`,
+while messages are pushed into their pull streams at a fixed rate.
+Reports the throughput, the latency from pushing a message to its `onMessage` returning, and the CPU and memory used per account.
+
+:class:`benchmarks.fakefb.FakeFacebook` runs in a separate process, so its CPU and memory aren't counted
+
+Usage: python -m benchmarks.load [--accounts 100] [--rate 1] [--duration 30] [--handler benchmarks.load:EchoBot] [--output results.json]
+"""
+
+from __future__ import unicode_literals, print_function, division
+import argparse
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import requests
+import fbchat
+from fbchat import Client
+from . import payloads
+from .fakefb import FakeFacebook, patch_urls, unpatch_urls
+from .send_many import percentile
+
+
+class EchoBot(Client):
+    """The bot of `examples/echobot.py`, without the logging"""
+    def onMessage(self, author_id, message, thread_id, thread_type, **kwargs):
+        self.markAsDelivered(author_id, thread_id)
+        self.markAsRead(author_id)
+
+        if author_id != self.uid:
+            self.sendMessage(message, thread_id=thread_id, thread_type=thread_type)
+
+
+def serve(queue, latency, pull_timeout):
+    fake = FakeFacebook(latency=latency, pull_timeout=pull_timeout).start()
+    queue.put(fake.url)
+    while True:
+        time.sleep(3600)
+
+
+def load_class(path):
+    """Imports a class from a `module:Class` path"""
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def measured(handler_class, pushed, latencies):
+    """Returns a subclass of `handler_class`, that records the time from pushing a message to handling it"""
+    class Measured(handler_class):
+        def onMessage(self, mid=None, **kwargs):
+            try:
+                return super(Measured, self).onMessage(mid=mid, **kwargs)
+            finally:
+                start = pushed.pop(mid, None)
+                if start is not None:
+                    latencies.append(time.time() - start)
+    return Measured
+
+
+def rss():
+    """Returns the resident memory of the process, in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf(str('SC_PAGE_SIZE'))
+    except (IOError, OSError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def cpu():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def drive(url, uids, rate, duration, pushed, interval=0.01):
+    """
+    Pushes `rate` messages per second into the stream of every account, for `duration` seconds.
+    The accounts are spread out in time, instead of all receiving a message at once
+    """
+    session = requests.session()
+    start = time.time()
+    # Fractions of a message owed to each account
+    owed = [account / float(len(uids)) for account in range(len(uids))]
+    sent = 0
+    last = start
+    while last < start + duration:
+        # Based on the time that actually passed, since pushing takes a while with a simulated latency
+        current = time.time()
+        elapsed, last = current - last, current
+        body = {}
+        for account, uid in enumerate(uids):
+            owed[account] += rate * elapsed
+            ms = []
+            while owed[account] >= 1:
+                owed[account] -= 1
+                delta = payloads.new_message_delta(sent, thread_id=payloads.user_id(account), group=False)
+                mid = delta['delta']['messageMetadata']['messageId'] = 'mid.$load{}'.format(sent)
+                pushed[mid] = time.time()
+                ms.append(delta)
+                sent += 1
+            if ms:
+                body[uid] = ms
+        if body:
+            session.post(url + '/fake/push', data=json.dumps(body))
+        time.sleep(max(0, last + interval - time.time()))
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--accounts', type=int, default=100, help='Amount of simulated accounts')
+    parser.add_argument('--rate', type=float, default=1, help='Messages per second received by each account')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to push messages for')
+    parser.add_argument('--handler', default='benchmarks.load:EchoBot', help='The `Client` subclass handling the messages, as `module:Class`')
+    parser.add_argument('--latency', type=float, default=0.02, help='Simulated latency of the server, in seconds')
+    parser.add_argument('--no-ping', action='store_true', help="Don't ping before every pull")
+    parser.add_argument('--output', help='File to write the results to')
+    args = parser.parse_args()
+
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(queue, args.latency, 1))
+    server.daemon = True
+    server.start()
+    url = queue.get()
+    originals = patch_urls(url)
+
+    pushed, latencies = {}, []
+    handler_class = measured(load_class(args.handler), pushed, latencies)
+    uids = [str(200000000000000 + i) for i in range(args.accounts)]
+
+    rss_before = rss()
+    start = time.time()
+    clients = [handler_class(uid, 'password', session_cookies={'c_user': uid}, logging_level=logging.ERROR) for uid in uids]
+    login = time.time() - start
+    rss_idle = rss()
+
+    threads = [threading.Thread(target=client.listen, kwargs={'markAlive': not args.no_ping}) for client in clients]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    cpu_before = cpu()
+    start = time.time()
+    sent = drive(url, uids, args.rate, args.duration, pushed)
+    # Give the accounts a moment to handle the last messages
+    deadline = time.time() + 10
+    while len(pushed) > 0 and time.time() < deadline:
+        time.sleep(0.05)
+    elapsed = time.time() - start
+    cpu_used = cpu() - cpu_before
+    rss_after = rss()
+
+    for client in clients:
+        client.listening = False
+    for thread in threads:
+        thread.join()
+    unpatch_urls(originals)
+    server.terminate()
+    server.join()
+    # If the server is near 100%, it's the bottleneck rather than the accounts
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    results = {
+        'fbchat': fbchat.__version__,
+        'python': platform.python_version(),
+        'time': int(time.time()),
+        'handler': args.handler,
+        'accounts': args.accounts,
+        'rate_per_account': args.rate,
+        'results': {
+            'login_seconds': round(login / args.accounts, 4),
+            'messages_sent': sent,
+            'messages_handled': len(latencies),
+            'messages_per_second': round(len(latencies) / elapsed, 2),
+            'latency_p50_seconds': round(percentile(latencies, 50) or 0, 4),
+            'latency_p99_seconds': round(percentile(latencies, 99) or 0, 4),
+            'cpu_seconds_per_account': round(cpu_used / args.accounts, 4),
+            'cpu_percent_per_account': round(cpu_used / elapsed / args.accounts * 100, 3),
+            'rss_bytes_per_account': (rss_idle - rss_before) // args.accounts,
+            'rss_bytes_per_account_listening': (rss_after - rss_before) // args.accounts,
+            'server_cpu_percent': round((children.ru_utime + children.ru_stime) / elapsed * 100, 1),
+        },
+    }
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Microbenchmarks of the parsing hot paths: Decoding responses, dispatching pulled messages and converting GraphQL results to models.
+The payloads are generated by :mod:`benchmarks.payloads`, and can be scaled up with `--scale`
+
+Each operation is run `--repeat` times, reporting the fastest and the median time, and the memory it allocated (peak) and kept (retained).
+The results can be compared like those of :mod:`benchmarks.suite`
+
+Usage: python -m benchmarks.parsing [--scale 1] [--repeat 5] [--output results.json] [--compare baseline.json]
+"""
+
+from __future__ import unicode_literals, print_function, division
+import argparse
+import copy
+import gc
+import json
+import logging
+import platform
+import time
+import tracemalloc
+from timeit import default_timer
+import requests
+import fbchat
+from fbchat import Client
+from fbchat.graphql import ConcatJSONDecoder, graphql_response_to_json, graphql_to_message, graphql_to_user, graphql_to_group
+from fbchat.utils import check_request, facebookEncoding, handler
+from . import payloads
+from .suite import compare
+
+
+def response(body):
+    """Returns a `requests` response with the body `body`, as `check_request` gets it"""
+    r = requests.Response()
+    r.status_code = 200
+    r._content = body.encode(facebookEncoding)
+    return r
+
+
+def listener():
+    """Returns a client that can dispatch messages, without logging in"""
+    client = Client.__new__(Client)
+    client._hook_seconds = 0
+    # Like `Client(..., logging_level=logging.ERROR)`, so the default hooks don't print every message
+    handler.setLevel(logging.ERROR)
+    return client
+
+
+def operations(scale):
+    """
+    Returns the operations to measure, as `(name, items, setup, function)` tuples.
+    `setup()` returns the argument of `function`, so preparing the input isn't measured
+    """
+    messages = 10000 * scale
+    deltas = 1000 * scale
+    users = 1000 * scale
+    groups = 100 * scale
+
+    history = payloads.graphql_batch([{'message_thread': payloads.group_node('1234', messages=messages)}])
+    batch = payloads.graphql_batch([{'message_thread': payloads.group_node(str(i), messages=messages // 100)} for i in range(100)])
+    pull = payloads.pull(payloads.mixed_deltas(deltas))
+    message_nodes = [payloads.message_node(i) for i in range(messages)]
+    user_nodes = [payloads.user_node(i) for i in range(users)]
+    group_nodes = [payloads.group_node(str(i), participants=50) for i in range(groups)]
+    pull_content = json.loads(pull[pull.index('{'):])
+    client = listener()
+
+    return [
+        ('ConcatJSONDecoder', messages, lambda: history, lambda body: json.loads(body, cls=ConcatJSONDecoder)),
+        ('graphql_response_to_json', messages, lambda: history, graphql_response_to_json),
+        ('graphql_response_to_json_batch', messages, lambda: batch, graphql_response_to_json),
+        ('check_request_pull', deltas, lambda: response(pull), check_request),
+        ('_parseMessage', deltas, lambda: copy.deepcopy(pull_content), client._parseMessage),
+        ('graphql_to_message', messages, lambda: copy.deepcopy(message_nodes), lambda nodes: [graphql_to_message(node) for node in nodes]),
+        ('graphql_to_user', users, lambda: copy.deepcopy(user_nodes), lambda nodes: [graphql_to_user(node) for node in nodes]),
+        ('graphql_to_group', groups, lambda: copy.deepcopy(group_nodes), lambda nodes: [graphql_to_group(node) for node in nodes]),
+    ]
+
+
+def measure(setup, function, repeat):
+    """Returns the times of `repeat` runs, and the peak and retained memory of one run, in bytes"""
+    times = []
+    for i in range(repeat):
+        argument = setup()
+        gc.collect()
+        start = default_timer()
+        function(argument)
+        times.append(default_timer() - start)
+
+    argument = setup()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function(argument)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return sorted(times), peak - before, current - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--scale', type=int, default=1, help='Multiplies the size of the payloads: 10k messages, 1k deltas and 1k users at 1')
+    parser.add_argument('--repeat', type=int, default=5, help='Amount of times each operation is run')
+    parser.add_argument('--only', action='append', help='Only run these operations')
+    parser.add_argument('--output', help='File to write the results to')
+    parser.add_argument('--compare', help='Results of an earlier run, to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change that counts as a regression')
+    args = parser.parse_args()
+
+    results = {
+        'fbchat': fbchat.__version__,
+        'python': platform.python_version(),
+        'time': int(time.time()),
+        'scale': args.scale,
+        'results': {},
+    }
+    print('{:<32} {:>8} {:>12} {:>12} {:>12} {:>14} {:>14}'.format('operation', 'items', 'min ms', 'median ms', 'us/item', 'peak bytes', 'retained bytes'))
+    for name, items, setup, function in operations(args.scale):
+        if args.only and name not in args.only:
+            continue
+        times, peak, retained = measure(setup, function, args.repeat)
+        median = times[len(times) // 2]
+        print('{:<32} {:>8} {:>12.2f} {:>12.2f} {:>12.2f} {:>14} {:>14}'.format(
+            name, items, times[0] * 1000, median * 1000, times[0] / items * 1000000, peak, retained
+        ))
+        results['results'].update({
+            '{}_seconds'.format(name): round(times[0], 6),
+            '{}_median_seconds'.format(name): round(median, 6),
+            '{}_peak_bytes'.format(name): peak,
+            '{}_retained_bytes'.format(name): retained,
+        })
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            raise SystemExit('Regressions: {}'.format(', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
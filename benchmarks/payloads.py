@@ -0,0 +1,158 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Generators of synthetic Facebook responses, shaped like the real ones `fbchat` parses.
+Every generator is deterministic for the same arguments, so results are comparable between runs
+"""
+
+from __future__ import unicode_literals
+import json
+from fbchat.utils import now
+
+#: Words the message texts are made of
+WORDS = ('hello', 'there', 'are', 'you', 'coming', 'tonight', '★', 'see', 'you', 'at', 'eight', 'ok', '😀', 'sure')
+
+
+def text(i, words=8):
+    """Returns the text of the `i`'th message"""
+    return ' '.join(WORDS[(i * 7 + j) % len(WORDS)] for j in range(words))
+
+
+def user_id(i):
+    return str(100000000000100 + i)
+
+
+def thread_key(thread_id, group=True):
+    if group:
+        return {'threadFbId': thread_id}
+    return {'otherUserFbId': thread_id}
+
+
+def message_node(i, author_id=None, timestamp=None, words=8):
+    """Returns a message, as in the `messages` of a GraphQL `message_thread`"""
+    return {
+        'message_id': 'mid.$synthetic{}'.format(i),
+        'message_sender': {'id': author_id or user_id(i % 5)},
+        'timestamp_precise': str(timestamp or 1500000000000 + i * 1000),
+        'unread': i % 3 == 0,
+        'message_reactions': [],
+        'message': {
+            'text': text(i, words),
+            'ranges': [{'entity': {'id': user_id(1)}, 'offset': 0, 'length': 5}] if i % 10 == 0 else [],
+        },
+        'sticker': None,
+        'blob_attachments': [],
+        'extensible_attachment': None,
+    }
+
+
+def user_node(i):
+    """Returns a user, as returned by GraphQL"""
+    uid = user_id(i)
+    return {
+        'id': uid,
+        'name': 'User {}'.format(i),
+        'first_name': 'User',
+        'last_name': str(i),
+        'url': 'https://www.facebook.com/{}'.format(uid),
+        'gender': 'FEMALE' if i % 2 else 'MALE',
+        'is_viewer_friend': i % 2 == 0,
+        'profile_picture': {'uri': 'https://scontent.xx.fbcdn.net/{}.jpg'.format(uid)},
+        'thread_key': {'other_user_id': uid},
+        'thread_type': 'ONE_TO_ONE',
+        'customization_info': {
+            'emoji': None,
+            'outgoing_bubble_color': 'FF44BEC7',
+            'participant_customizations': [{'participant_id': uid, 'nickname': 'Nick {}'.format(i)}],
+        },
+        'messages_count': i * 10,
+    }
+
+
+def group_node(thread_id, participants=5, messages=0):
+    """Returns a group `message_thread`, as returned by GraphQL, optionally with `messages` messages"""
+    return {
+        'thread_key': {'thread_fbid': thread_id},
+        'thread_type': 'GROUP',
+        'name': 'Group {}'.format(thread_id),
+        'image': {'uri': 'https://scontent.xx.fbcdn.net/{}.jpg'.format(thread_id)},
+        'all_participants': {'nodes': [{'messaging_actor': {'id': user_id(i)}} for i in range(participants)]},
+        'customization_info': {
+            'emoji': '👍',
+            'outgoing_bubble_color': None,
+            'participant_customizations': [{'participant_id': user_id(i), 'nickname': 'Nick {}'.format(i)} for i in range(participants)],
+        },
+        'messages_count': messages,
+        'messages': {'nodes': [message_node(i) for i in range(messages)]},
+    }
+
+
+def graphql_batch(results):
+    """
+    Returns the body of a GraphQL batch response: Concatenated JSON objects, one per query, and a summary
+
+    :param results: The `data` of each query
+    """
+    lines = [json.dumps({'q{}'.format(i): {'data': data}}) for i, data in enumerate(results)]
+    lines.append(json.dumps({'successful_results': len(results), 'error_results': 0, 'skipped_results': 0}))
+    return '\n'.join(lines)
+
+
+def new_message_delta(i, thread_id='1234', author_id=None, group=True, timestamp=None, words=8):
+    """Returns a `NewMessage` delta, as received from the pull api"""
+    return {
+        'type': 'delta',
+        'delta': {
+            'class': 'NewMessage',
+            'body': text(i, words),
+            'attachments': [],
+            'messageMetadata': {
+                'messageId': 'mid.$delta{}'.format(i),
+                'actorFbId': author_id or user_id(i % 5),
+                'timestamp': str(timestamp or now()),
+                'threadKey': thread_key(thread_id, group),
+                'tags': ['source:messenger:web'],
+            },
+        },
+    }
+
+
+def mixed_deltas(count, thread_id='1234'):
+    """
+    Returns `count` messages from the pull api, in the proportions seen while listening:
+    Mostly new messages, with delivery and read receipts, typing-free inbox updates and the odd thread change
+    """
+    ms = []
+    for i in range(count):
+        kind = i % 10
+        metadata = {
+            'messageId': 'mid.$delta{}'.format(i),
+            'actorFbId': user_id(i % 5),
+            'timestamp': str(1500000000000 + i * 1000),
+            'threadKey': thread_key(thread_id),
+        }
+        if kind < 6:
+            ms.append(new_message_delta(i, thread_id=thread_id, timestamp=1500000000000 + i * 1000))
+        elif kind == 6:
+            ms.append({'type': 'delta', 'delta': {
+                'class': 'DeliveryReceipt', 'messageIds': ['mid.$delta{}'.format(i - 1)], 'actorFbId': user_id(1),
+                'deliveredWatermarkTimestampMs': str(1500000000000 + i * 1000), 'threadKey': thread_key(thread_id),
+            }})
+        elif kind == 7:
+            ms.append({'type': 'delta', 'delta': {
+                'class': 'ReadReceipt', 'actorFbId': user_id(2), 'actionTimestampMs': str(1500000000000 + i * 1000),
+                'watermarkTimestampMs': str(1500000000000 + i * 1000), 'threadKey': thread_key(thread_id),
+            }})
+        elif kind == 8:
+            ms.append({'type': 'inbox', 'unseen': i, 'unread': i, 'recent_unread': 1})
+        else:
+            ms.append({'type': 'delta', 'delta': {
+                'class': 'AdminTextMessage', 'type': 'change_thread_icon',
+                'untypedData': {'thread_icon': '😀'}, 'messageMetadata': metadata,
+            }})
+    return ms
+
+
+def pull(ms, seq=1):
+    """Returns the body of a pull response with the messages `ms`"""
+    return 'for (;;); ' + json.dumps({'t': 'msg', 'seq': seq, 'ms': ms})
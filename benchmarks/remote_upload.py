@@ -0,0 +1,58 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Compares uploading a remote file by downloading it completely before uploading it (as :func:`Client.sendRemoteImage` used to),
+against piping the download straight into the upload with :func:`Client._uploadRemote`
+
+Usage: python -m benchmarks.remote_upload [--size 8] [--bandwidth 16]
+"""
+
+from __future__ import unicode_literals, print_function, division
+import argparse
+import json
+import os
+import time
+import tracemalloc
+import requests
+from .fakefb import FakeFacebook
+
+
+def measure(name, upload):
+    tracemalloc.start()
+    start = time.time()
+    upload()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'name': name,
+        'seconds': round(elapsed, 3),
+        'peak_memory_mb': round(peak / 1024**2, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--size', type=float, default=8, help='Size of the file, in MB')
+    parser.add_argument('--bandwidth', type=float, default=16, help='Simulated bandwidth of the download and the upload, in MB/s')
+    args = parser.parse_args()
+
+    with FakeFacebook(bandwidth=args.bandwidth * 1024**2) as fake:
+        fake.files['/static/video.mp4'] = os.urandom(int(args.size * 1024**2))
+        url = fake.url + '/static/video.mp4'
+        client = fake.client()
+
+        results = [
+            measure('buffered', lambda: client._uploadImage(url, requests.get(url).content, 'video/mp4')),
+            measure('piped', lambda: client._uploadRemote(url)),
+        ]
+    results.insert(0, {
+        'name': 'expected',
+        'download_seconds': round(args.size / args.bandwidth, 3),
+        'upload_seconds': round(args.size / args.bandwidth, 3),
+    })
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Compares sending a message to many threads one by one with :func:`Client.sendMessage`,
+against :func:`Client.sendMessageToMany`
+
+Usage: python -m benchmarks.send_many [--targets 200] [--latency 0.02] [--workers 8]
+"""
+
+from __future__ import unicode_literals, print_function, division
+import argparse
+import json
+import time
+from fbchat.models import ThreadType
+from .fakefb import FakeFacebook
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def timed(client):
+    """Records the latency of every send request of `client`"""
+    latencies = []
+    send = client._doSendRequest
+
+    def _doSendRequest(data):
+        start = time.time()
+        try:
+            return send(data)
+        finally:
+            latencies.append(time.time() - start)
+
+    client._doSendRequest = _doSendRequest
+    return latencies
+
+
+def report(name, targets, elapsed, latencies):
+    return {
+        'name': name,
+        'messages': len(targets),
+        'seconds': round(elapsed, 4),
+        'messages_per_second': round(len(targets) / elapsed, 2),
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--targets', type=int, default=200, help='Amount of threads to send to')
+    parser.add_argument('--latency', type=float, default=0.02, help='Simulated latency of the server, in seconds')
+    parser.add_argument('--workers', type=int, default=8, help='Workers used by sendMessageToMany')
+    args = parser.parse_args()
+
+    targets = [(str(1000 + i), ThreadType.USER if i % 2 else ThreadType.GROUP) for i in range(args.targets)]
+    results = []
+    with FakeFacebook(latency=args.latency) as fake:
+        client = fake.client()
+        latencies = timed(client)
+        start = time.time()
+        for thread_id, thread_type in targets:
+            client.sendMessage('Hello', thread_id=thread_id, thread_type=thread_type)
+        results.append(report('sendMessage', targets, time.time() - start, latencies))
+
+        client = fake.client()
+        latencies = timed(client)
+        start = time.time()
+        sent = client.sendMessageToMany('Hello', targets, workers=args.workers, rate=10**6)
+        results.append(report('sendMessageToMany', targets, time.time() - start, latencies))
+        results[-1]['failed'] = sum(1 for r in sent.values() if isinstance(r, Exception))
+
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
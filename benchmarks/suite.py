@@ -0,0 +1,182 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Measures the main operations of `fbchat` against :class:`benchmarks.fakefb.FakeFacebook`:
+Logging in, receiving messages with :func:`Client.listen`, GraphQL batches, sending messages and the memory used per client.
+
+The results are written as JSON, and can be compared with the results of an earlier run to spot regressions
+
+Usage: python -m benchmarks.suite [--output results.json] [--compare baseline.json] [--latency 0]
+"""
+
+from __future__ import unicode_literals, print_function, division
+import argparse
+import gc
+import json
+import platform
+import threading
+import time
+import tracemalloc
+import fbchat
+from fbchat import Client
+from fbchat.graphql import GraphQL
+from fbchat.models import ThreadType
+from . import payloads
+from .fakefb import FakeFacebook, THREAD_QUERY, UID
+
+#: Measurements where a lower value is better. For the others (throughputs), higher is better
+LOWER_IS_BETTER = ('seconds', 'bytes')
+
+
+class CountingClient(Client):
+    """Stops listening after receiving `expected` messages"""
+    expected = 0
+    received = 0
+
+    def onMessage(self, **kwargs):
+        self.received += 1
+        if self.received >= self.expected:
+            self.listening = False
+
+
+def bench_login(fake, args):
+    start = time.time()
+    for i in range(args.logins):
+        fake.client(login=True)
+    login = (time.time() - start) / args.logins
+
+    start = time.time()
+    for i in range(args.logins):
+        fake.client()
+    session = (time.time() - start) / args.logins
+
+    state = fake.client().getState()
+    start = time.time()
+    for i in range(args.logins):
+        Client(None, None, state=state, logging_level=None)
+    from_state = (time.time() - start) / args.logins
+    return {'login_seconds': login, 'session_login_seconds': session, 'state_login_seconds': from_state}
+
+
+def bench_listen(fake, args):
+    client = fake.client(client_class=CountingClient)
+    client.expected = args.messages
+    # Queued before listening, so the client receives them in batches of `--pull-size`
+    for i in range(0, args.messages, args.pull_size):
+        fake.push(UID, *[payloads.new_message_delta(j) for j in range(i, min(i + args.pull_size, args.messages))])
+    thread = threading.Thread(target=client.listen, kwargs={'markAlive': False})
+    start = time.time()
+    thread.start()
+    thread.join()
+    elapsed = time.time() - start
+    return {'listen_messages_per_second': client.received / elapsed}
+
+
+def bench_graphql(fake, args):
+    client = fake.client()
+    queries = [GraphQL(doc_id=THREAD_QUERY, params={'id': str(i), 'message_limit': args.graphql_messages, 'load_messages': True}) for i in range(args.graphql_queries)]
+    start = time.time()
+    for i in range(args.graphql_batches):
+        client.graphql_requests(*queries)
+    elapsed = time.time() - start
+    client.fetchThreadMessages(thread_id='1', limit=args.graphql_messages)
+    start = time.time()
+    for i in range(args.graphql_batches):
+        client.fetchThreadMessages(thread_id='1', limit=args.graphql_messages)
+    messages = time.time() - start
+    return {
+        'graphql_batches_per_second': args.graphql_batches / elapsed,
+        'graphql_messages_per_second': args.graphql_batches * args.graphql_messages / messages,
+    }
+
+
+def bench_send(fake, args):
+    client = fake.client()
+    start = time.time()
+    for i in range(args.sends):
+        client.sendMessage(payloads.text(i), thread_id='1234', thread_type=ThreadType.GROUP)
+    return {'send_messages_per_second': args.sends / (time.time() - start)}
+
+
+def bench_memory(fake, args):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    clients = [fake.client() for i in range(args.clients)]
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {'client_bytes': (after - before) // len(clients)}
+
+
+BENCHMARKS = [
+    ('login', bench_login),
+    ('listen', bench_listen),
+    ('graphql', bench_graphql),
+    ('send', bench_send),
+    ('memory', bench_memory),
+]
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints how each measurement changed since `baseline`
+
+    :return: The names of the measurements that got worse by more than `threshold` (a fraction)
+    """
+    regressions = []
+    for name, value in sorted(results['results'].items()):
+        old = baseline['results'].get(name)
+        if not old:
+            continue
+        change = value / old - 1
+        worse = change > threshold if name.endswith(LOWER_IS_BETTER) else change < -threshold
+        if worse:
+            regressions.append(name)
+        print('{:<32} {:>14.4f} {:>14.4f} {:>+8.1%}{}'.format(name, old, value, change, '  REGRESSION' if worse else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--output', help='File to write the results to')
+    parser.add_argument('--compare', help='Results of an earlier run, to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change that counts as a regression')
+    parser.add_argument('--only', action='append', choices=[name for name, bench in BENCHMARKS], help='Only run these benchmarks')
+    parser.add_argument('--latency', type=float, default=0, help='Simulated latency of the server, in seconds')
+    parser.add_argument('--logins', type=int, default=20, help='Amount of logins')
+    parser.add_argument('--messages', type=int, default=5000, help='Amount of messages received while listening')
+    parser.add_argument('--pull-size', type=int, default=50, help='Amount of messages per pull')
+    parser.add_argument('--graphql-batches', type=int, default=50, help='Amount of GraphQL batches')
+    parser.add_argument('--graphql-queries', type=int, default=10, help='Amount of queries per GraphQL batch')
+    parser.add_argument('--graphql-messages', type=int, default=100, help='Amount of messages per GraphQL query')
+    parser.add_argument('--sends', type=int, default=500, help='Amount of messages sent')
+    parser.add_argument('--clients', type=int, default=20, help='Amount of clients the memory use is averaged over')
+    args = parser.parse_args()
+
+    results = {
+        'fbchat': fbchat.__version__,
+        'python': platform.python_version(),
+        'time': int(time.time()),
+        'results': {},
+    }
+    with FakeFacebook(latency=args.latency, pull_timeout=0.1) as fake:
+        for name, bench in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            for key, value in bench(fake, args).items():
+                results['results'][key] = round(value, 6)
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            raise SystemExit('Regressions: {}'.format(', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
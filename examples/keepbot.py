@@ -31,8 +31,7 @@ class KeepBot(Client):
     def onPeopleAdded(self, added_ids, author_id, thread_id, **kwargs):
         if old_thread_id == thread_id and author_id != self.uid:
             log.info("{} got added. They will be removed".format(added_ids))
-            for added_id in added_ids:
-                self.removeUserFromGroup(added_id, thread_id=thread_id)
+            self.removeUsersFromGroup(added_ids, thread_id=thread_id)
 
     def onPersonRemoved(self, removed_id, author_id, thread_id, **kwargs):
         # No point in trying to add ourself
@@ -1,10 +1,5 @@
 # -*- coding: UTF-8 -*-
 
-from __future__ import unicode_literals
-from datetime import datetime
-from .client import *
-
-
 """
     fbchat
     ~~~~~~
@@ -15,6 +10,31 @@ from .client import *
     :license: BSD, see LICENSE for more details.
 """
 
+from __future__ import unicode_literals
+import sys
+from datetime import datetime
+
+if sys.version_info >= (3, 7):
+    from importlib import import_module
+
+    def __getattr__(name):
+        # The client (and with it `requests`) is imported when it's first used,
+        # so e.g. `import fbchat.models` doesn't have to import it
+        if name.startswith('__'):
+            raise AttributeError(name)
+        client = import_module('.client', __name__)
+        # Importing the client imports the submodules it uses (e.g. `fbchat.models`), which sets them on the package
+        if name in globals():
+            return globals()[name]
+        try:
+            value = getattr(client, name)
+        except AttributeError:
+            raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+        globals()[name] = value
+        return value
+else:
+    from .client import *
+
 
 __copyright__ = 'Copyright 2015 - {} by Taehoon Kim'.format(datetime.now().year)
 __version__ = '1.0.23'
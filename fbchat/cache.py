@@ -0,0 +1,212 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import sqlite3
+import threading
+from time import time
+from .utils import *
+from .models import *
+from .index import _reopen
+
+
+class _Call(object):
+    """A lookup of a single ID, that other threads can wait for"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _chained(error):
+    """
+    Returns a new exception for an `error` shared between callers, so they don't all raise (and add to the traceback of) the same instance.
+    It's chained to `error`, and keeps the attributes of a :class:`models.FBchatFacebookError`
+    """
+    if isinstance(error, FBchatFacebookError):
+        rtn = FBchatFacebookError(
+            '{}'.format(error),
+            fb_error_code=error.fb_error_code,
+            fb_error_message=error.fb_error_message,
+            request_status_code=error.request_status_code
+        )
+    else:
+        rtn = FBchatException('{}'.format(error))
+    rtn.__cause__ = error
+    return rtn
+
+
+class LookupCache(object):
+    """
+    Deduplicates concurrent lookups of the same IDs, so they share one request,
+    and remembers the IDs that failed for a short while, so they aren't retried on every call.
+    Used by :func:`Client.fetchThreadInfo`
+
+    :param error_ttl: Seconds to remember a failed lookup for. Set to 0 to disable
+    """
+    def __init__(self, error_ttl=30):
+        self.error_ttl = error_ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._errors = {}
+
+    def forget(self, *keys):
+        """Forgets failed lookups, so they will be retried. If no keys are given, every failed lookup is forgotten"""
+        with self._lock:
+            if len(keys) == 0:
+                self._errors.clear()
+            for key in keys:
+                self._errors.pop(key, None)
+
+    def lookup(self, keys, fetch):
+        """
+        Looks up `keys`, only fetching those that are not already being fetched by another thread
+
+        :param keys: The IDs to look up
+        :param fetch: Called with the IDs to fetch. Should return a tuple of the results and the exceptions for IDs that failed,
+            both labeled by their ID. If it raises, the exception is used for all the IDs, but not remembered
+        :return: The results, labeled by their ID
+        :rtype: dict
+        :raises: FBchatException chained to the exception of the first failed ID (a FBchatFacebookError if that was one).
+            If `fetch` raised, the caller that called it gets the original exception
+        """
+        own, waiting = {}, {}
+        with self._lock:
+            current = time()
+            for key in keys:
+                expires, error = self._errors.get(key, (0, None))
+                if expires > current:
+                    raise _chained(error)
+                self._errors.pop(key, None)
+
+            for key in keys:
+                if key in own or key in waiting:
+                    continue
+                if key in self._calls:
+                    waiting[key] = self._calls[key]
+                else:
+                    own[key] = self._calls[key] = _Call()
+
+        if len(own) > 0:
+            results, errors = {}, {}
+            remember = True
+            try:
+                results, errors = fetch(*own)
+            except BaseException as e:
+                errors = dict((key, e) for key in own)
+                remember = False
+
+            with self._lock:
+                for key, call in own.items():
+                    call.result = results.get(key)
+                    call.error = errors.get(key)
+                    if call.error is None and call.result is None:
+                        call.error = FBchatException('No result for {}'.format(key))
+                    if call.error is not None and remember and self.error_ttl > 0:
+                        self._errors[key] = (time() + self.error_ttl, call.error)
+                    del self._calls[key]
+                    call.done.set()
+
+        rtn = {}
+        for key in keys:
+            call = own.get(key) or waiting[key]
+            call.done.wait()
+            if call.error is not None:
+                if key in own and not remember:
+                    raise call.error
+                raise _chained(call.error)
+            rtn[key] = call.result
+        return rtn
+
+
+class UploadCache(object):
+    """
+    Remembers the IDs of uploaded files, so sending the same file again doesn't upload it again.
+    Local files are looked up by a hash of their content, and remote files by their URL and `ETag`.
+    Stored in SQLite, so it can be kept between sessions
+
+    Set it as :any:`Client.upload_cache` to use it with :func:`Client.sendLocalFile`, :func:`Client.sendLocalImage` and :func:`Client.sendRemoteImage`
+
+    :param path: Path of the database. Defaults to an in-memory database
+    :param max_entries: Max. amount of files to remember. The least recently used files are forgotten first
+    :param max_age: Seconds to remember a file for. Set to `None` to remember files until they're evicted
+    """
+    def __init__(self, path=':memory:', max_entries=10000, max_age=7*24*60*60):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._createTables()
+
+    def _createTables(self):
+        # File IDs are per account, so the user ID is part of the key
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                uid TEXT, key TEXT, file_id TEXT, mimetype TEXT, etag TEXT, created REAL, used REAL, PRIMARY KEY (uid, key)
+            )
+        """)
+        self._db.execute('CREATE INDEX IF NOT EXISTS uploads_used ON uploads (used)')
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM uploads').fetchone()[0]
+
+    def get(self, uid, key):
+        """
+        :param uid: ID of the account the file was uploaded with
+        :param key: The content hash (`sha256:...`) or URL (`url:...`) of the file
+        :return: A `(file ID, mimetype, ETag)` tuple, or `None` if the file isn't remembered
+        :rtype: tuple
+        """
+        current = time()
+        with self._lock:
+            row = self._db.execute('SELECT file_id, mimetype, etag, created FROM uploads WHERE uid = ? AND key = ?', (uid, key)).fetchone()
+            if row is None:
+                return None
+            if self.max_age is not None and row[3] + self.max_age < current:
+                self._db.execute('DELETE FROM uploads WHERE uid = ? AND key = ?', (uid, key))
+                self._db.commit()
+                return None
+            self._db.execute('UPDATE uploads SET used = ? WHERE uid = ? AND key = ?', (current, uid, key))
+            self._db.commit()
+        return row[:3]
+
+    def set(self, uid, key, file_id, mimetype, etag=None):
+        """
+        Remembers an uploaded file, evicting the least recently used files if there are more than `max_entries`
+
+        :param uid: ID of the account the file was uploaded with
+        :param key: The content hash (`sha256:...`) or URL (`url:...`) of the file
+        :param file_id: The ID Facebook gave the file
+        :param mimetype: The mimetype of the file
+        :param etag: The `ETag` of a remote file
+        """
+        current = time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO uploads (uid, key, file_id, mimetype, etag, created, used) VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                uid, key, file_id, mimetype, etag, current, current
+            ))
+            if self.max_age is not None:
+                self._db.execute('DELETE FROM uploads WHERE created < ?', (current - self.max_age,))
+            self._db.execute('DELETE FROM uploads WHERE rowid IN (SELECT rowid FROM uploads ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self._db.commit()
+
+    def forget(self, uid=None):
+        """Forgets the files uploaded with an account, or every file if `uid` is not given"""
+        with self._lock:
+            if uid is None:
+                self._db.execute('DELETE FROM uploads')
+            else:
+                self._db.execute('DELETE FROM uploads WHERE uid = ?', (uid,))
+            self._db.commit()
+
+    def afterFork(self):
+        """Reopens the database in a forked process. See :func:`Client.afterFork`"""
+        self._lock = threading.Lock()
+        self._db = _reopen(self._db, self.path)
+        self._createTables()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
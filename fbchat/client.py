@@ -6,14 +6,27 @@ import urllib
 from uuid import uuid1
 from random import choice
 from datetime import datetime
-from bs4 import BeautifulSoup as bs
 from mimetypes import guess_type
+from io import BytesIO
+from requests.compat import urlparse
+from concurrent.futures import ThreadPoolExecutor
 from .utils import *
 from .models import *
 from .graphql import *
+from .contacts import ContactTable
+from .cache import LookupCache
+from .sending import SendQueue, SEND_RETRY
+from .upload import MultipartEncoder, ResponseReader, hash_file, MAX_UPLOAD_SIZE
+from .metrics import endpoint_name, PULL_BUCKETS, COUNT_BUCKETS
+from .tracing import NOOP_SPAN
 import time
 
 
+def _soup(html):
+    """Parses a HTML page. BeautifulSoup and lxml are imported here, since they're slow to import and only needed to log in"""
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, "lxml")
+
 
 class Client(object):
     """A client for the Facebook Chat (Messenger).
@@ -30,8 +43,41 @@ class Client(object):
 
     Note: Modifying this results in undefined behaviour
     """
+    message_index = None
+    """
+    A :class:`index.MessageIndex`. If set, messages fetched with :func:`Client.fetchThreadMessages` or received while listening are added to it,
+    so they can be searched offline with :func:`Client.searchForMessages`
+    """
+    thread_index = None
+    """
+    A :class:`index.ThreadIndex`. If set, :func:`Client.searchForUsers`, :func:`Client.searchForPages`, :func:`Client.searchForGroups`
+    and :func:`Client.searchForThreads` search it first, and only send a request if fewer threads than `limit` were found
+    """
+    upload_cache = None
+    """
+    A :class:`cache.UploadCache`. If set, :func:`Client.sendLocalFile`, :func:`Client.sendLocalImage` and :func:`Client.sendRemoteImage`
+    reuse the IDs of files that were already uploaded, instead of uploading them again
+    """
+    metrics = None
+    """
+    A :class:`metrics.Metrics`. If set, the count, latency, size and errors of every request to Facebook are recorded in it
+    """
+    tracer = None
+    """
+    A :class:`tracing.Tracer`. If set, requests, response decoding, listening and hooks are traced with it
+    """
+    receipt_batcher = None
+    """
+    A :class:`sending.ReceiptBatcher`. If set, :func:`Client.markAsDelivered`, :func:`Client.markAsRead` and :func:`Client.markAsSeen`
+    queue their receipts in it, so they're coalesced and sent in the background
+    """
+    image_resizer = None
+    """
+    An :class:`upload.ImageResizer`. If set, images sent with :func:`Client.sendLocalFile`, :func:`Client.sendLocalFiles`
+    and :func:`Client.sendLocalImage` are downscaled and recompressed before they're uploaded
+    """
 
-    def __init__(self, email, password, user_agent=None, max_tries=5, session_cookies=None, logging_level=logging.INFO):
+    def __init__(self, email, password, user_agent=None, max_tries=5, session_cookies=None, logging_level=logging.INFO, state=None):
         """Initializes and logs in the client
 
         :param email: Facebook `email`, `id` or `phone number`
@@ -39,22 +85,29 @@ class Client(object):
         :param user_agent: Custom user agent to use when sending requests. If `None`, user agent will be chosen from a premade list (see :any:`utils.USER_AGENTS`)
         :param max_tries: Maximum number of times to try logging in
         :param session_cookies: Cookies from a previous session (Will default to login if these are invalid)
-        :param logging_level: Configures the `logging level <https://docs.python.org/3/library/logging.html#logging-levels>`_. Defaults to `INFO`
+        :param logging_level: Configures the `logging level <https://docs.python.org/3/library/logging.html#logging-levels>`_ of the console output. Defaults to `INFO`. If `None`, logging is left to be configured by the application, see :func:`utils.enable_logging`
         :type max_tries: int
+        :param state: The state of a logged in client, from :func:`Client.getState`. If set, the client is created from it without sending any requests
         :type session_cookies: dict
         :type logging_level: int
+        :type state: dict
         :raises: FBchatException on failed login
         """
 
         self.sticky, self.pool = (None, None)
         self._session = requests.session()
+        # Used for downloading remote files. Kept apart from `_session`, so the Facebook cookies aren't sent to other sites
+        self._download_session = requests.session()
         self.req_counter = 1
         self.seq = "0"
         self.payloadDefault = {}
+        self._hook_seconds = 0
         self.client = 'mercury'
         self.default_thread_id = None
         self.default_thread_type = None
         self.req_url = ReqUrl()
+        self.lookup_cache = LookupCache()
+        """A :class:`cache.LookupCache`, used by :func:`Client.fetchThreadInfo` to deduplicate concurrent lookups and remember failed ones"""
 
         if not user_agent:
             user_agent = choice(USER_AGENTS)
@@ -67,10 +120,15 @@ class Client(object):
             'Connection' : 'keep-alive',
         }
 
-        handler.setLevel(logging_level)
+        if logging_level is not None:
+            enable_logging(logging_level)
 
+        if state is not None:
+            self.setState(state)
+            self.email = email or state['email']
+            self.password = password
         # If session cookies aren't set, not properly loaded or gives us an invalid session, then do the login
-        if not session_cookies or not self.setSession(session_cookies) or not self.isLoggedIn():
+        elif not session_cookies or not self.setSession(session_cookies) or not self.isLoggedIn():
             self.login(email, password, max_tries)
         else:
             self.email = email
@@ -92,6 +150,51 @@ class Client(object):
         self.req_counter += 1
         return payload
 
+    def _request(self, method, url, **kwargs):
+        """Sends a request with the session, and records it in :any:`Client.metrics` and :any:`Client.tracer`"""
+        if self.metrics is None and self.tracer is None:
+            return self._session.request(method, url, **kwargs)
+        if self.metrics is not None:
+            endpoint = self.metrics.endpoint(self.req_url, url)
+        else:
+            endpoint = endpoint_name(self.req_url, url)
+        with self._span('{} {}'.format(method, endpoint)) as span:
+            start = time.time()
+            try:
+                r = self._session.request(method, url, **kwargs)
+            except Exception as e:
+                if self.metrics is not None:
+                    self.metrics.observeRequest(endpoint, method, time.time() - start, type(e).__name__)
+                raise
+            span.set('status', r.status_code)
+            if self.metrics is not None:
+                body = r.request.body
+                bytes_out = getattr(body, 'len', None) or (len(body) if isinstance(body, (bytes, type(''))) else 0)
+                self.metrics.observeRequest(endpoint, method, time.time() - start, r.status_code, bytes_out=bytes_out, bytes_in=len(r.content))
+        return r
+
+    def _traced(self, function):
+        """Returns `function`, continuing the active trace of :any:`Client.tracer` when it's called in another thread"""
+        if self.tracer is None:
+            return function
+        return self.tracer.wrap(function)
+
+    def _span(self, name, **attributes):
+        """Returns a span of :any:`Client.tracer`, or a span that does nothing if tracing is disabled"""
+        if self.tracer is None:
+            return NOOP_SPAN
+        return self.tracer.span(name, **attributes)
+
+    def _shouldRetry(self, url, error, error_retries):
+        """Records a Facebook error in :any:`Client.metrics`, and returns whether the request should be retried"""
+        retry = error_retries > 0 and self._fix_fb_errors(error.fb_error_code)
+        if self.metrics is not None:
+            endpoint = self.metrics.endpoint(self.req_url, url)
+            self.metrics.count('fbchat_facebook_errors_total', endpoint=endpoint, code=str(error.fb_error_code))
+            if retry:
+                self.metrics.count('fbchat_retries_total', endpoint=endpoint)
+        return retry
+
     def _fix_fb_errors(self, error_code):
         """
         This fixes "Please try closing and re-opening your browser window" errors (1357004)
@@ -106,57 +209,46 @@ class Client(object):
 
     def _get(self, url, query=None, timeout=30, fix_request=False, as_json=False, error_retries=3):
         payload = self._generatePayload(query)
-        r = self._session.get(url, headers=self._header, params=payload, timeout=timeout)
+        r = self._request('GET', url, headers=self._header, params=payload, timeout=timeout)
         if not fix_request:
             return r
         try:
-            return check_request(r, as_json=as_json)
+            with self._span('check_request'):
+                return check_request(r, as_json=as_json)
         except FBchatFacebookError as e:
-            if error_retries > 0 and self._fix_fb_errors(e.fb_error_code):
+            if self._shouldRetry(url, e, error_retries):
                 return self._get(url, query=query, timeout=timeout, fix_request=fix_request, as_json=as_json, error_retries=error_retries-1)
             raise e
 
     def _post(self, url, query=None, timeout=30, fix_request=False, as_json=False, error_retries=3):
         payload = self._generatePayload(query)
-        r = self._session.post(url, headers=self._header, data=payload, timeout=timeout)
+        r = self._request('POST', url, headers=self._header, data=payload, timeout=timeout)
         if not fix_request:
             return r
         try:
-            return check_request(r, as_json=as_json)
+            with self._span('check_request'):
+                return check_request(r, as_json=as_json)
         except FBchatFacebookError as e:
-            if error_retries > 0 and self._fix_fb_errors(e.fb_error_code):
+            if self._shouldRetry(url, e, error_retries):
                 return self._post(url, query=query, timeout=timeout, fix_request=fix_request, as_json=as_json, error_retries=error_retries-1)
             raise e
 
     def _graphql(self, payload, error_retries=3):
         content = self._post(self.req_url.GRAPHQL, payload, fix_request=True, as_json=False)
         try:
-            return graphql_response_to_json(content)
+            with self._span('graphql_response_to_json'):
+                return graphql_response_to_json(content)
         except FBchatFacebookError as e:
-            if error_retries > 0 and self._fix_fb_errors(e.fb_error_code):
+            if self._shouldRetry(self.req_url.GRAPHQL, e, error_retries):
                 return self._graphql(payload, error_retries=error_retries-1)
             raise e
 
     def _cleanGet(self, url, query=None, timeout=30):
-        return self._session.get(url, headers=self._header, params=query, timeout=timeout)
+        return self._request('GET', url, headers=self._header, params=query, timeout=timeout)
 
     def _cleanPost(self, url, query=None, timeout=30):
         self.req_counter += 1
-        return self._session.post(url, headers=self._header, data=query, timeout=timeout)
-
-    def _postFile(self, url, files=None, query=None, timeout=30, fix_request=False, as_json=False, error_retries=3):
-        payload=self._generatePayload(query)
-        # Removes 'Content-Type' from the header
-        headers = dict((i, self._header[i]) for i in self._header if i != 'Content-Type')
-        r = self._session.post(url, headers=headers, data=payload, timeout=timeout, files=files)
-        if not fix_request:
-            return r
-        try:
-            return check_request(r, as_json=as_json)
-        except FBchatFacebookError as e:
-            if error_retries > 0 and self._fix_fb_errors(e.fb_error_code):
-                return self._postFile(url, files=files, query=query, timeout=timeout, fix_request=fix_request, as_json=as_json, error_retries=error_retries-1)
-            raise e
+        return self._request('POST', url, headers=self._header, data=query, timeout=timeout)
 
     def graphql_requests(self, *queries):
         """
@@ -207,7 +299,7 @@ class Client(object):
         self.ttstamp = ''
 
         r = self._get(self.req_url.BASE)
-        soup = bs(r.text, "lxml")
+        soup = _soup(r.text)
         self.fb_dtsg = soup.find("input", {'name':'fb_dtsg'})['value']
         self.fb_h = soup.find("input", {'name':'h'})['value']
         for i in self.fb_dtsg:
@@ -240,7 +332,7 @@ class Client(object):
         if not (self.email and self.password):
             raise FBchatUserError("Email and password not found.")
 
-        soup = bs(self._get(self.req_url.MOBILE).text, "lxml")
+        soup = _soup(self._get(self.req_url.MOBILE).text)
         data = dict((elem['name'], elem['value']) for elem in soup.findAll("input") if elem.has_attr('value') and elem.has_attr('name'))
         data['email'] = self.email
         data['pass'] = self.password
@@ -265,7 +357,7 @@ class Client(object):
             return False, r.url
 
     def _2FA(self, r):
-        soup = bs(r.text, "lxml")
+        soup = _soup(r.text)
         data = dict()
 
         s = self.on2FACode()
@@ -358,6 +450,95 @@ class Client(object):
             return False
         return True
 
+    def getState(self):
+        """
+        Retrieves the state of the logged in client: The session, the values found when logging in, the listening position
+        and the threads in :any:`Client.thread_index`. Used to create clients without logging in again, e.g. in worker processes,
+        with `Client(email, password, state=state)`
+
+        The state can be pickled. It contains the session cookies, so keep it as safe as them
+
+        :return: The state
+        :rtype: dict
+        """
+        return {
+            'email': self.email,
+            'uid': self.uid,
+            'cookies': self.getSession(),
+            'user_agent': self._header['User-Agent'],
+            'payload_default': dict(self.payloadDefault),
+            'fb_dtsg': self.fb_dtsg,
+            'fb_h': self.fb_h,
+            'ttstamp': self.ttstamp,
+            'client_id': self.client_id,
+            'start_time': self.start_time,
+            'form': dict(self.form),
+            'seq': self.seq,
+            'sticky': self.sticky,
+            'pool': self.pool,
+            'pull_channel': self.req_url.pull_channel,
+            'threads': list(self.thread_index.threads.values()) if self.thread_index is not None else [],
+        }
+
+    def setState(self, state):
+        """
+        Loads a state from :func:`Client.getState`, without sending any requests.
+        The client then shares its client ID and listening position (`sticky` and `seq`) with the client the state comes from.
+        If both may be used at the same time, call :func:`Client.afterFork`, so they don't pull the same messages as the same tab
+
+        :param state: The state
+        :type state: dict
+        """
+        self._session.cookies = requests.cookies.merge_cookies(self._session.cookies, state['cookies'])
+        self._header['User-Agent'] = state['user_agent']
+        self.uid = state['uid']
+        self.user_channel = 'p_' + self.uid
+        self.payloadDefault = dict(state['payload_default'])
+        self.fb_dtsg = state['fb_dtsg']
+        self.fb_h = state['fb_h']
+        self.ttstamp = state['ttstamp']
+        self.client_id = state['client_id']
+        self.start_time = state['start_time']
+        self.form = dict(state['form'])
+        self.seq = state['seq']
+        self.sticky, self.pool = state['sticky'], state['pool']
+        if state['pull_channel'] != self.req_url.pull_channel:
+            self.req_url.change_pull_channel(state['pull_channel'])
+        if self.thread_index is not None and state['threads']:
+            self.thread_index.add(*state['threads'])
+        self.prev = self.tmp_prev = self.last_sync = now()
+
+    def afterFork(self):
+        """
+        Prepares a client for use in a forked process (e.g. a pre-forked worker), by giving it what must not be shared with the parent:
+        New connections, and a new client ID and request counter, so Facebook sees the processes as separate tabs.
+        The pull session (`sticky` and `pool`) of the parent is dropped, and a new one is fetched by :func:`Client.startListening`.
+        The session, the values found when logging in and `seq` are kept, so no requests are sent, and listening continues from the same message
+
+        The attributes of the client are prepared too, by calling their `afterFork` methods:
+        A forked process only has the thread that forked, so locks that other threads held are never released, and background threads are gone.
+        And SQLite connections can't be shared between processes. So the databases of :any:`Client.message_index` and :any:`Client.upload_cache` are reopened,
+        and the locks and threads of :any:`Client.thread_index`, :any:`Client.metrics`, :any:`Client.receipt_batcher`, :any:`Client.image_resizer` and :any:`Client.tracer` are replaced.
+        The metrics, queued receipts and active spans of the parent are dropped, and a :class:`tracing.TraceFileExporter` writes to a file of its own
+
+        Call it in the child process, before the client is used.
+        Objects that aren't attributes of the client, like a :class:`sending.TypingManager`, have an `afterFork` method that has to be called too
+        """
+        cookies = self._session.cookies.copy()
+        self._session = requests.session()
+        self._session.cookies = cookies
+        self._download_session = requests.session()
+        self.req_counter = 1
+        self.client_id = hex(int(random()*2147483648))[2:]
+        self.form['clientid'] = self.client_id
+        self._hook_seconds = 0
+        # Its locks could have been held by another thread when the process forked
+        self.lookup_cache = LookupCache(error_ttl=self.lookup_cache.error_ttl)
+        self.sticky, self.pool = (None, None)
+        for attribute in (self.message_index, self.upload_cache, self.thread_index, self.metrics, self.receipt_batcher, self.image_resizer, self.tracer):
+            if attribute is not None:
+                attribute.afterFork()
+
     def login(self, email, password, max_tries=5):
         """
         Uses `email` and `password` to login the user (If the user is already logged in, this will do a re-login)
@@ -465,24 +646,61 @@ class Client(object):
         :raises: FBchatException if request failed
         """
 
+        payload = self._fetchAllUsersPayload()
+        users = []
+
+        for key in payload:
+            k = payload[key]
+            if k['type'] in ['user', 'friend']:
+                if k['id'] in ['0', 0]:
+                    # Skip invalid users
+                    pass
+                users.append(User(k['id'], first_name=k.get('firstName'), url=k.get('uri'), photo=k.get('thumbSrc'), name=k.get('name'), is_friend=k.get('is_friend'), gender=GENDERS[k.get('gender')]))
+
+        return self._addToIndex(users)
+
+    def _fetchAllUsersPayload(self):
         data = {
             'viewer': self.uid,
         }
         j = self._post(self.req_url.ALL_USERS, query=data, fix_request=True, as_json=True)
         if j.get('payload') is None:
             raise FBchatException('Missing payload while fetching users: {}'.format(j))
+        return j['payload']
 
-        users = []
+    def fetchContactTable(self, table=None):
+        """
+        Gets all users the client is currently chatting with, like :func:`Client.fetchAllUsers`,
+        but stores them in a compact :class:`contacts.ContactTable` instead of as :class:`models.User` objects
 
-        for key in j['payload']:
-            k = j['payload'][key]
-            if k['type'] in ['user', 'friend']:
-                if k['id'] in ['0', 0]:
-                    # Skip invalid users
-                    pass
-                users.append(User(k['id'], first_name=k.get('firstName'), url=k.get('uri'), photo=k.get('thumbSrc'), name=k.get('name'), is_friend=k.get('is_friend'), gender=GENDERS[k.get('gender')]))
+        :param table: A previously fetched table to refresh. Only the changed rows are rewritten
+        :type table: contacts.ContactTable
+        :return: The refreshed table, or a new table if `table` wasn't given
+        :rtype: contacts.ContactTable
+        :raises: FBchatException if request failed
+        """
+        if table is None:
+            table = ContactTable()
+        added, changed, removed = table.update(self._fetchAllUsersPayload())
+        log.debug('Contact table refreshed: {} added, {} changed, {} removed'.format(added, changed, removed))
+        return table
 
-        return users
+    def _searchIndex(self, name, limit, thread_type=None):
+        """Searches :any:`Client.thread_index`, if it's set"""
+        if self.thread_index is None:
+            return []
+        return self.thread_index.search(name, limit=limit, thread_type=thread_type)
+
+    def _addToIndex(self, threads, found=None, limit=None):
+        """
+        Adds the threads to :any:`Client.thread_index`, if it's set.
+        Returns the threads `found` in the index, followed by the others, up to `limit`
+        """
+        if self.thread_index is not None:
+            self.thread_index.add(*threads)
+        found = found or []
+        uids = set(thread.uid for thread in found)
+        return (found + [thread for thread in threads if thread.uid not in uids])[:limit]
 
     def searchForUsers(self, name, limit=1):
         """
@@ -495,9 +713,13 @@ class Client(object):
         :raises: FBchatException if request failed
         """
 
+        users = self._searchIndex(name, limit, ThreadType.USER)
+        if len(users) >= limit:
+            return users
+
         j = self.graphql_request(GraphQL(query=GraphQL.SEARCH_USER, params={'search': name, 'limit': limit}))
 
-        return [graphql_to_user(node) for node in j[name]['users']['nodes']]
+        return self._addToIndex([graphql_to_user(node) for node in j[name]['users']['nodes']], users, limit)
 
     def searchForPages(self, name, limit=1):
         """
@@ -509,9 +731,13 @@ class Client(object):
         :raises: FBchatException if request failed
         """
 
+        pages = self._searchIndex(name, limit, ThreadType.PAGE)
+        if len(pages) >= limit:
+            return pages
+
         j = self.graphql_request(GraphQL(query=GraphQL.SEARCH_PAGE, params={'search': name, 'limit': limit}))
 
-        return [graphql_to_page(node) for node in j[name]['pages']['nodes']]
+        return self._addToIndex([graphql_to_page(node) for node in j[name]['pages']['nodes']], pages, limit)
 
     def searchForGroups(self, name, limit=1):
         """
@@ -524,9 +750,13 @@ class Client(object):
         :raises: FBchatException if request failed
         """
 
+        groups = self._searchIndex(name, limit, ThreadType.GROUP)
+        if len(groups) >= limit:
+            return groups
+
         j = self.graphql_request(GraphQL(query=GraphQL.SEARCH_GROUP, params={'search': name, 'limit': limit}))
 
-        return [graphql_to_group(node) for node in j['viewer']['groups']['nodes']]
+        return self._addToIndex([graphql_to_group(node) for node in j['viewer']['groups']['nodes']], groups, limit)
 
     def searchForThreads(self, name, limit=1):
         """
@@ -539,6 +769,10 @@ class Client(object):
         :raises: FBchatException if request failed
         """
 
+        threads = self._searchIndex(name, limit)
+        if len(threads) >= limit:
+            return threads
+
         j = self.graphql_request(GraphQL(query=GraphQL.SEARCH_THREAD, params={'search': name, 'limit': limit}))
 
         rtn = []
@@ -556,6 +790,59 @@ class Client(object):
             else:
                 log.warning('Unknown __typename: {} in {}'.format(repr(node['__typename']), node))
 
+        return self._addToIndex(rtn, threads, limit)
+
+    def searchForMessages(self, query, thread_id=None, limit=20, fallback=False):
+        """
+        Find messages containing `query`, using the local :any:`Client.message_index`
+
+        :param query: Text to search for
+        :param thread_id: User/Group ID to search in. If `None`, all indexed threads are searched. See :ref:`intro_threads`
+        :param limit: Max. number of messages to retrieve
+        :param fallback: Whether to search on Facebook's servers if nothing is found locally (or no index is set)
+        :type limit: int
+        :type fallback: bool
+        :return: :class:`models.Message` objects, newest first, labeled by their thread ID
+        :rtype: dict
+        :raises: FBchatException if request failed
+        """
+        rtn = {}
+        if self.message_index is not None:
+            rtn = self.message_index.search(query, thread_id=thread_id, limit=limit)
+        if len(rtn) == 0 and fallback:
+            rtn = self._searchForMessagesRemote(query, thread_id=thread_id, limit=limit)
+        return rtn
+
+    def _searchForMessagesRemote(self, query, thread_id=None, limit=20):
+        data = {
+            'query': query,
+            'snippetOffset': 0,
+            'snippetLimit': limit,
+        }
+        if thread_id is not None:
+            data['identifier'] = 'thread_fbid'
+            data['thread_fbid'] = thread_id
+
+        j = self._post(self.req_url.SEARCH_MESSAGES, data, fix_request=True, as_json=True)
+        try:
+            results = j['payload']['search_snippets'][query]
+        except (KeyError, TypeError):
+            raise FBchatException('Missing search results: {}'.format(j))
+
+        rtn = {}
+        for _thread_id in results:
+            messages = []
+            for snippet in results[_thread_id].get('snippets', []):
+                author = snippet.get('author')
+                messages.append(Message(
+                    snippet.get('message_id'),
+                    author=author.replace('fbid:', '') if author else None,
+                    timestamp=str(snippet['timestamp']) if snippet.get('timestamp') is not None else None,
+                    text=snippet.get('body')
+                ))
+            rtn[_thread_id] = messages
+            if self.message_index is not None:
+                self.message_index.add(_thread_id, *messages)
         return rtn
 
     def _fetchInfo(self, *ids):
@@ -665,6 +952,9 @@ class Client(object):
         """
         Get threads' info from IDs, unordered
 
+        Concurrent calls share the requests for the IDs they have in common,
+        and IDs that failed are not retried for a while, see :any:`Client.lookup_cache`
+
         .. warning::
             Sends two requests if users or pages are present, to fetch all available info!
 
@@ -674,6 +964,14 @@ class Client(object):
         :raises: FBchatException if request failed
         """
 
+        thread_ids = [str(thread_id) for thread_id in thread_ids]
+        rtn = self.lookup_cache.lookup(thread_ids, self._fetchThreadInfo)
+
+        self._addToIndex(list(rtn.values()))
+        return rtn
+
+    def _fetchThreadInfo(self, *thread_ids):
+        """Returns the fetched threads, and the exceptions for the threads that could not be fetched, both labeled by their ID"""
         queries = []
         for thread_id in thread_ids:
             queries.append(GraphQL(doc_id='1386147188135407', params={
@@ -702,6 +1000,7 @@ class Client(object):
             pages_and_users = self._fetchInfo(*pages_and_user_ids)
 
         rtn = {}
+        errors = {}
         for i, entry in enumerate(j):
             entry = entry['message_thread']
             if entry.get('thread_type') == 'GROUP':
@@ -710,16 +1009,17 @@ class Client(object):
             elif entry.get('thread_type') == 'ONE_TO_ONE':
                 _id = entry['thread_key']['other_user_id']
                 if pages_and_users.get(_id) is None:
-                    raise FBchatException('Could not fetch thread {}'.format(_id))
+                    errors[thread_ids[i]] = FBchatException('Could not fetch thread {}'.format(_id))
+                    continue
                 entry.update(pages_and_users[_id])
                 if entry['type'] == ThreadType.USER:
                     rtn[_id] = graphql_to_user(entry)
                 else:
                     rtn[_id] = graphql_to_page(entry)
             else:
-                raise FBchatException('{} had an unknown thread type: {}'.format(thread_ids[i], entry))
+                errors[thread_ids[i]] = FBchatException('{} had an unknown thread type: {}'.format(thread_ids[i], entry))
 
-        return rtn
+        return rtn, errors
 
     def fetchThreadMessages(self, thread_id=None, limit=20, before=None):
         """
@@ -746,7 +1046,10 @@ class Client(object):
         if j.get('message_thread') is None:
             raise FBchatException('Could not fetch thread {}: {}'.format(thread_id, j))
 
-        return list(reversed([graphql_to_message(message) for message in j['message_thread']['messages']['nodes']]))
+        messages = list(reversed([graphql_to_message(message) for message in j['message_thread']['messages']['nodes']]))
+        if self.message_index is not None and thread_id is not None:
+            self.message_index.add(thread_id, *messages)
+        return messages
 
     def fetchThreadList(self, offset=0, limit=20):
         """Get thread list of your facebook account
@@ -794,7 +1097,7 @@ class Client(object):
             else:
                 raise FBchatException('A thread had an unknown thread type: {}'.format(k))
 
-        return entries
+        return self._addToIndex(entries)
 
     def fetchUnread(self):
         """
@@ -827,15 +1130,10 @@ class Client(object):
 
     def _getSendData(self, thread_id=None, thread_type=ThreadType.USER):
         """Returns the data needed to send a request to `SendURL`"""
-        messageAndOTID = generateOfflineThreadingID()
-        timestamp = now()
-        date = datetime.now()
         data = {
             'client': self.client,
             'author' : 'fbid:' + str(self.uid),
-            'timestamp' : timestamp,
             'timestamp_absolute' : 'Today',
-            'timestamp_relative' : str(date.hour) + ":" + str(date.minute).zfill(2),
             'timestamp_time_passed' : '0',
             'is_unread' : False,
             'is_cleared' : False,
@@ -851,22 +1149,31 @@ class Client(object):
             'html_body' : False,
             'ui_push_phase' : 'V3',
             'status' : '0',
-            'offline_threading_id': messageAndOTID,
-            'message_id' : messageAndOTID,
-            'threading_id': generateMessageID(self.client_id),
             'ephemeral_ttl_mode:': '0',
             'manual_retry_cnt' : '0',
-            'signatureID' : getSignatureID()
         }
+        self._setSendIDs(data)
+        self._setRecipient(data, thread_id, thread_type)
+        return data
 
-        # Set recipient
+    def _setSendIDs(self, data):
+        """Sets the timestamps and IDs, which have to be unique for every message, in the send data"""
+        timestamp = now()
+        messageAndOTID = generateOfflineThreadingID(timestamp)
+        date = time.localtime(timestamp // 1000)
+        data['timestamp'] = timestamp
+        data['timestamp_relative'] = '{}:{:02d}'.format(date.tm_hour, date.tm_min)
+        data['offline_threading_id'] = messageAndOTID
+        data['message_id'] = messageAndOTID
+        data['threading_id'] = generateMessageID(self.client_id, timestamp)
+        data['signatureID'] = getSignatureID()
+
+    def _setRecipient(self, data, thread_id, thread_type):
         if thread_type in [ThreadType.USER, ThreadType.PAGE]:
             data["other_user_fbid"] = thread_id
         elif thread_type == ThreadType.GROUP:
             data["thread_fbid"] = thread_id
 
-        return data
-
     def _doSendRequest(self, data):
         """Sends the data to `SendURL`, and returns the message ID or None on failure"""
         j = self._post(self.req_url.SEND, data, fix_request=True, as_json=True)
@@ -900,15 +1207,61 @@ class Client(object):
         :raises: FBchatException if request failed
         """
         thread_id, thread_type = self._getThread(thread_id, thread_type)
-        data = self._getSendData(thread_id, thread_type)
+        return self._doSendRequest(self._getMessageData(message, thread_id, thread_type))
 
+    def _getMessageData(self, message, thread_id, thread_type):
+        """Returns the send data of a message. Used by :func:`Client.sendMessage` and :class:`sending.SendQueue`"""
+        data = self._getSendData(thread_id, thread_type)
         data['action_type'] = 'ma-type:user-generated-message'
         data['body'] = message or ''
         data['has_attachment'] = False
         data['specific_to_list[0]'] = 'fbid:' + thread_id
         data['specific_to_list[1]'] = 'fbid:' + self.uid
+        return data
 
-        return self._doSendRequest(data)
+    def sendMessageToMany(self, message, targets, workers=8, rate=10, max_retries=3):
+        """
+        Sends the same message to multiple threads, in parallel
+
+        The send data is only built once, and only the IDs and the recipient are changed for each thread
+
+        :param message: Message to send
+        :param targets: :class:`models.Thread` objects, or `(thread_id, thread_type)` tuples, to send to. See :ref:`intro_threads`.
+            A thread that's given more than once is only sent to once
+        :param workers: Amount of messages to send concurrently
+        :param rate: Max. amount of requests per second
+        :param max_retries: Amount of times to retry a failed send
+        :return: The :ref:`Message ID <intro_message_ids>` of each sent message, or the exception that occured, labeled by thread ID
+        :rtype: dict
+        """
+        base = self._getSendData(thread_type=None)
+        base['action_type'] = 'ma-type:user-generated-message'
+        base['body'] = message or ''
+        base['has_attachment'] = False
+        base['specific_to_list[1]'] = 'fbid:' + self.uid
+
+        futures = {}
+        with SendQueue(self, workers=workers, rate=rate, max_retries=max_retries) as queue:
+            for target in targets:
+                if isinstance(target, Thread):
+                    thread_id, thread_type = target.uid, target.type
+                else:
+                    thread_id, thread_type = target
+                if thread_id in futures:
+                    continue
+                data = base.copy()
+                self._setSendIDs(data)
+                self._setRecipient(data, thread_id, thread_type)
+                data['specific_to_list[0]'] = 'fbid:' + thread_id
+                futures[thread_id] = queue.submit(thread_id, self._doSendRequest, (data,), retry=SEND_RETRY)
+
+        rtn = {}
+        for thread_id, future in futures.items():
+            try:
+                rtn[thread_id] = future.result()
+            except Exception as e:
+                rtn[thread_id] = e
+        return rtn
 
     def sendEmoji(self, emoji=None, size=EmojiSize.SMALL, thread_id=None, thread_type=ThreadType.USER):
         """
@@ -924,6 +1277,10 @@ class Client(object):
         :raises: FBchatException if request failed
         """
         thread_id, thread_type = self._getThread(thread_id, thread_type)
+        return self._doSendRequest(self._getEmojiData(emoji, size, thread_id, thread_type))
+
+    def _getEmojiData(self, emoji, size, thread_id, thread_type):
+        """Returns the send data of an emoji. Used by :func:`Client.sendEmoji` and :class:`sending.SendQueue`"""
         data = self._getSendData(thread_id, thread_type)
         data['action_type'] = 'ma-type:user-generated-message'
         data['has_attachment'] = False
@@ -935,21 +1292,67 @@ class Client(object):
             data['tags[0]'] = 'hot_emoji_size:' + size.name.lower()
         else:
             data["sticker_id"] = size.value
+        return data
 
-        return self._doSendRequest(data)
+    def _upload(self, files, callback=None, error_retries=3):
+        """
+        Uploads files to Facebook. The files are streamed from their current position, and not closed
+
+        :param files: `(filename, file object, mimetype)` tuples
+        :param callback: Called with the amount of bytes uploaded, and the total amount of bytes (or `None` if unknown), while uploading
+        :return: `(file ID, mimetype)` tuples, in the order of `files`
+        :rtype: list
+        :raises: FBchatException if request failed
+        """
+        body = MultipartEncoder(self._generatePayload(None).items(), [
+            ('upload_{}'.format(i), filename, f, mimetype) for i, (filename, f, mimetype) in enumerate(files)
+        ], callback=callback)
+        # Replaces 'Content-Type' in the header with the multipart boundary
+        headers = dict(self._header, **{'Content-Type': body.content_type})
+        r = self._request('POST', self.req_url.UPLOAD, headers=headers, data=body, timeout=30)
+        try:
+            j = check_request(r, as_json=True)
+        except FBchatFacebookError as e:
+            if body.rewindable and self._shouldRetry(self.req_url.UPLOAD, e, error_retries):
+                body.rewind()
+                return self._upload(files, callback=callback, error_retries=error_retries-1)
+            raise e
+
+        try:
+            metadata = j['payload']['metadata']
+            rtn = []
+            for i, (filename, f, mimetype) in enumerate(files):
+                mimetype = metadata[i].get('filetype') or mimetype
+                rtn.append((metadata[i][mimetype_to_key(mimetype)], mimetype))
+            return rtn
+        except (KeyError, IndexError, TypeError) as e:
+            raise FBchatException('Error when uploading files: No file IDs could be found: {}'.format(j))
 
     def _uploadImage(self, image_path, data, mimetype):
         """Upload an image and get the image_id for sending in a message"""
+        if isinstance(data, bytes):
+            data = BytesIO(data)
+        return self._upload([(image_path, data, mimetype)])[0][0]
 
-        j = self._postFile(self.req_url.UPLOAD, {
-            'file': (
-                image_path,
-                data,
-                mimetype
-            )
-        }, fix_request=True, as_json=True)
-        # Return the image_id
-        return j['payload']['metadata'][0]['image_id']
+    def _sendFiles(self, files, message=None, thread_id=None, thread_type=ThreadType.USER):
+        """
+        Sends already uploaded files to a thread, in one message
+
+        :param files: `(file ID, mimetype)` tuples, as returned by :func:`Client._upload`
+        """
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
+        data = self._getSendData(thread_id, thread_type)
+
+        data['action_type'] = 'ma-type:user-generated-message'
+        data['body'] = message or ''
+        data['has_attachment'] = True
+        data['specific_to_list[0]'] = 'fbid:' + str(thread_id)
+        data['specific_to_list[1]'] = 'fbid:' + str(self.uid)
+
+        for i, (file_id, mimetype) in enumerate(files):
+            data['{}s[{}]'.format(mimetype_to_key(mimetype), i)] = file_id
+
+        return self._doSendRequest(data)
 
     def sendImage(self, image_id, message=None, thread_id=None, thread_type=ThreadType.USER):
         """
@@ -964,6 +1367,10 @@ class Client(object):
         :raises: FBchatException if request failed
         """
         thread_id, thread_type = self._getThread(thread_id, thread_type)
+        return self._doSendRequest(self._getImageData(image_id, message, thread_id, thread_type))
+
+    def _getImageData(self, image_id, message, thread_id, thread_type):
+        """Returns the send data of an uploaded image. Used by :func:`Client.sendImage` and :class:`sending.SendQueue`"""
         data = self._getSendData(thread_id, thread_type)
 
         data['action_type'] = 'ma-type:user-generated-message'
@@ -973,28 +1380,134 @@ class Client(object):
         data['specific_to_list[1]'] = 'fbid:' + str(self.uid)
 
         data['image_ids[0]'] = image_id
+        return data
 
-        return self._doSendRequest(data)
+    def _uploadLocal(self, file_paths, callback=None):
+        """
+        Uploads local files to Facebook in one request, except for those in :any:`Client.upload_cache`
+
+        :param file_paths: Paths of the files
+        :param callback: See :func:`Client._upload`
+        :return: `(file ID, mimetype)` tuples, in the order of `file_paths`
+        :rtype: list
+        :raises: FBchatException if request failed
+        """
+        rtn = [None] * len(file_paths)
+        opened, files, pending = [], [], []
+        try:
+            for i, file_path in enumerate(file_paths):
+                f = open(file_path, 'rb')
+                opened.append(f)
+                key = None
+                if self.upload_cache is not None:
+                    key = 'sha256:' + hash_file(f)
+                    cached = self.upload_cache.get(self.uid, key)
+                    if cached is not None:
+                        rtn[i] = cached[:2]
+                        continue
+                files.append((file_path, f, guess_type(file_path)[0]))
+                pending.append((i, key))
+
+            if len(files) > 0 and self.image_resizer is not None:
+                resized = self.image_resizer.resizeMany([(f, mimetype) for file_path, f, mimetype in files])
+                opened.extend(resized)
+                files = [(file_path, f, mimetype) for (file_path, _, mimetype), f in zip(files, resized)]
+
+            if len(files) > 0:
+                for (i, key), uploaded in zip(pending, self._upload(files, callback=callback)):
+                    rtn[i] = uploaded
+                    if key is not None:
+                        self.upload_cache.set(self.uid, key, *uploaded)
+        finally:
+            for f in opened:
+                f.close()
+        return rtn
+
+    def _uploadRemote(self, url, max_size=MAX_UPLOAD_SIZE, timeout=30, callback=None):
+        """
+        Uploads a remote file to Facebook. The file is uploaded while it's being downloaded, without being buffered in memory
+
+        If the file is in :any:`Client.upload_cache`, and the remote server confirms with its `ETag` that it hasn't changed, it isn't uploaded again
+
+        :param url: URL of the file
+        :param max_size: Max. size of the file in bytes. `None` means no limit
+        :param timeout: Seconds to wait for the remote server to connect and to send data
+        :param callback: See :func:`Client._upload`
+        :return: A `(file ID, mimetype)` tuple
+        :raises: FBchatUserError if the file is larger than `max_size`
+        :raises: FBchatException if the download or upload failed
+        """
+        headers = {}
+        cached = None
+        if self.upload_cache is not None:
+            cached = self.upload_cache.get(self.uid, 'url:' + url)
+            if cached is not None and cached[2] is not None:
+                headers['If-None-Match'] = cached[2]
+
+        r = self._download_session.get(url, headers=headers, stream=True, timeout=timeout)
+        try:
+            if r.status_code == 304 and cached is not None:
+                return cached[:2]
+            if not r.ok:
+                raise FBchatException('Error when downloading {}: Got {} response'.format(url, r.status_code))
+            mimetype = guess_type(url)[0] or r.headers.get('Content-Type', '').split(';')[0].strip() or None
+            filename = urlparse(url).path.rstrip('/') or url
+            reader = ResponseReader(r, max_size=max_size)
+            rtn = self._upload([(filename, reader, mimetype)], callback=callback)[0]
+        finally:
+            r.close()
+
+        if self.upload_cache is not None:
+            self.upload_cache.set(self.uid, 'sha256:' + reader.digest.hexdigest(), *rtn)
+            # Without an `ETag`, there's no way to know whether the file changed
+            if r.headers.get('ETag'):
+                self.upload_cache.set(self.uid, 'url:' + url, rtn[0], rtn[1], etag=r.headers['ETag'])
+        return rtn
 
-    def sendRemoteImage(self, image_url, message=None, thread_id=None, thread_type=ThreadType.USER):
+    def sendRemoteImage(self, image_url, message=None, thread_id=None, thread_type=ThreadType.USER, max_size=MAX_UPLOAD_SIZE, timeout=30, callback=None):
         """
-        Sends an image from a URL to a thread
+        Sends an image from a URL to a thread.
+        The image is uploaded while it's being downloaded, without being buffered in memory
 
         :param image_url: URL of an image to upload and send
         :param message: Additional message
         :param thread_id: User/Group ID to send to. See :ref:`intro_threads`
         :param thread_type: See :ref:`intro_threads`
+        :param max_size: Max. size of the image in bytes. `None` means no limit
+        :param timeout: Seconds to wait for the remote server to connect and to send data
+        :param callback: Called with the amount of bytes uploaded, and the total amount of bytes (or `None` if unknown), while uploading
         :type thread_type: models.ThreadType
         :return: :ref:`Message ID <intro_message_ids>` of the sent image
+        :raises: FBchatUserError if the image is larger than `max_size`
+        :raises: FBchatException if request failed
+        """
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
+        files = [self._uploadRemote(image_url, max_size=max_size, timeout=timeout, callback=callback)]
+        return self._sendFiles(files, message=message, thread_id=thread_id, thread_type=thread_type)
+
+    def sendRemoteFiles(self, file_urls, message=None, thread_id=None, thread_type=ThreadType.USER, workers=4, max_size=MAX_UPLOAD_SIZE, timeout=30):
+        """
+        Sends files from URLs (e.g. images, videos or audio clips) to a thread, as one message.
+        The files are downloaded and uploaded concurrently, see :func:`Client.sendRemoteImage`
+
+        :param file_urls: URLs of the files to upload and send
+        :param message: Additional message
+        :param thread_id: User/Group ID to send to. See :ref:`intro_threads`
+        :param thread_type: See :ref:`intro_threads`
+        :param workers: Amount of files to upload concurrently
+        :param max_size: Max. size of each file in bytes. `None` means no limit
+        :param timeout: Seconds to wait for the remote servers to connect and to send data
+        :type thread_type: models.ThreadType
+        :return: :ref:`Message ID <intro_message_ids>` of the sent files
+        :raises: FBchatUserError if a file is larger than `max_size`
         :raises: FBchatException if request failed
         """
         thread_id, thread_type = self._getThread(thread_id, thread_type)
-        mimetype = guess_type(image_url)[0]
-        remote_image = requests.get(image_url).content
-        image_id = self._uploadImage(image_url, remote_image, mimetype)
-        return self.sendImage(image_id=image_id, message=message, thread_id=thread_id, thread_type=thread_type)
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(file_urls)))) as executor:
+            files = list(executor.map(self._traced(lambda url: self._uploadRemote(url, max_size=max_size, timeout=timeout)), file_urls))
+        return self._sendFiles(files, message=message, thread_id=thread_id, thread_type=thread_type)
 
-    def sendLocalImage(self, image_path, message=None, thread_id=None, thread_type=ThreadType.USER):
+    def sendLocalImage(self, image_path, message=None, thread_id=None, thread_type=ThreadType.USER, callback=None):
         """
         Sends a local image to a thread
 
@@ -1002,14 +1515,48 @@ class Client(object):
         :param message: Additional message
         :param thread_id: User/Group ID to send to. See :ref:`intro_threads`
         :param thread_type: See :ref:`intro_threads`
+        :param callback: Called with the amount of bytes uploaded, and the total amount of bytes, while uploading
         :type thread_type: models.ThreadType
         :return: :ref:`Message ID <intro_message_ids>` of the sent image
         :raises: FBchatException if request failed
         """
+        return self.sendLocalFile(image_path, message=message, thread_id=thread_id, thread_type=thread_type, callback=callback)
+
+    def sendLocalFile(self, file_path, message=None, thread_id=None, thread_type=ThreadType.USER, callback=None):
+        """
+        Sends a local file (e.g. an image, a video, an audio clip or a document) to a thread.
+        The file is read from disk in chunks while it's uploaded, so large files aren't loaded into memory
+
+        :param file_path: Path of a file to upload and send
+        :param message: Additional message
+        :param thread_id: User/Group ID to send to. See :ref:`intro_threads`
+        :param thread_type: See :ref:`intro_threads`
+        :param callback: Called with the amount of bytes uploaded, and the total amount of bytes, while uploading
+        :type thread_type: models.ThreadType
+        :return: :ref:`Message ID <intro_message_ids>` of the sent file
+        :raises: FBchatException if request failed
+        """
         thread_id, thread_type = self._getThread(thread_id, thread_type)
-        mimetype = guess_type(image_path)[0]
-        image_id = self._uploadImage(image_path, open(image_path, 'rb'), mimetype)
-        return self.sendImage(image_id=image_id, message=message, thread_id=thread_id, thread_type=thread_type)
+        files = self._uploadLocal([file_path], callback=callback)
+        return self._sendFiles(files, message=message, thread_id=thread_id, thread_type=thread_type)
+
+    def sendLocalFiles(self, file_paths, message=None, thread_id=None, thread_type=ThreadType.USER, callback=None):
+        """
+        Sends local files (e.g. images, videos or audio clips) to a thread, as one message.
+        The files are uploaded in a single request, and read from disk in chunks while they're uploaded
+
+        :param file_paths: Paths of the files to upload and send
+        :param message: Additional message
+        :param thread_id: User/Group ID to send to. See :ref:`intro_threads`
+        :param thread_type: See :ref:`intro_threads`
+        :param callback: Called with the amount of bytes uploaded, and the total amount of bytes, while uploading
+        :type thread_type: models.ThreadType
+        :return: :ref:`Message ID <intro_message_ids>` of the sent files
+        :raises: FBchatException if request failed
+        """
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
+        files = self._uploadLocal(file_paths, callback=callback)
+        return self._sendFiles(files, message=message, thread_id=thread_id, thread_type=thread_type)
 
     def addUsersToGroup(self, user_ids, thread_id=None):
         """
@@ -1059,6 +1606,80 @@ class Client(object):
 
         j = self._post(self.req_url.REMOVE_USER, data, fix_request=True, as_json=True)
 
+    def removeUsersFromGroup(self, user_ids, thread_id=None, workers=4):
+        """
+        Removes users from a group, concurrently (Facebook only allows removing one user per request)
+
+        :param user_ids: User IDs to remove
+        :param thread_id: Group ID to remove people from. See :ref:`intro_threads`
+        :param workers: Amount of users to remove concurrently
+        :type user_ids: list
+        :return: `None` for each removed user, or the exception that occured, labeled by user ID
+        :rtype: dict
+        """
+        thread_id, thread_type = self._getThread(thread_id, None)
+        user_ids = list(set(str(user_id) for user_id in user_ids))
+
+        def remove(user_id):
+            try:
+                self.removeUserFromGroup(user_id, thread_id=thread_id)
+            except Exception as e:
+                return e
+
+        if len(user_ids) == 0:
+            return {}
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(user_ids)))) as executor:
+            return dict(zip(user_ids, executor.map(self._traced(remove), user_ids)))
+
+    def setGroupParticipants(self, user_ids, thread_id=None, group=None, workers=4):
+        """
+        Adds and removes users, so the participants of a group are exactly `user_ids` (and the client itself).
+        The participants are compared with `group.participants`, and only the missing users are added (in one request),
+        while the extra users are removed (concurrently)
+
+        :param user_ids: User IDs that should be in the group
+        :param thread_id: Group ID to change. See :ref:`intro_threads`
+        :param group: A :class:`models.Group` with the current participants, e.g. from :func:`Client.fetchGroupInfo`.
+            If not given, the group is fetched. Its `participants` are updated with the changes that succeeded
+        :param workers: Amount of users to remove concurrently
+        :type user_ids: list
+        :type group: models.Group
+        :return: Whether each user was added (`True`) or removed (`False`), or the exception that occured, labeled by user ID
+        :rtype: dict
+        :raises: FBchatException if the group could not be fetched
+        """
+        if group is not None:
+            thread_id = group.uid
+        thread_id, thread_type = self._getThread(thread_id, None)
+        if group is None:
+            group = self.fetchGroupInfo(thread_id)[thread_id]
+
+        current = set(str(user_id) for user_id in group.participants)
+        wanted = set(str(user_id) for user_id in user_ids)
+        # The client can't add itself, and removing itself would mean leaving the group
+        to_add = wanted - current - {self.uid}
+        to_remove = current - wanted - {self.uid}
+
+        rtn = {}
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # The users are added while the others are being removed
+            added = executor.submit(self._traced(self.addUsersToGroup), list(to_add), thread_id=thread_id) if len(to_add) > 0 else None
+            for user_id, error in self.removeUsersFromGroup(to_remove, thread_id=thread_id, workers=workers).items():
+                rtn[user_id] = False if error is None else error
+            if added is not None:
+                error = added.exception()
+                for user_id in to_add:
+                    rtn[user_id] = True if error is None else error
+
+        participants = set(group.participants)
+        for user_id, result in rtn.items():
+            if result is True:
+                participants.add(user_id)
+            elif result is False:
+                participants.discard(user_id)
+        group.participants = participants
+        return rtn
+
     def changeThreadTitle(self, title, thread_id=None, thread_type=ThreadType.USER):
         """
         Changes title of a thread.
@@ -1186,7 +1807,7 @@ class Client(object):
         :type thread_type: models.ThreadType
         :raises: FBchatException if request failed
         """
-        thread_id, thread_type = self._getThread(thread_id, None)
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
 
         data = {
             "typ": status.value,
@@ -1201,40 +1822,62 @@ class Client(object):
     END SEND METHODS
     """
 
+    def _sendDeliveredReceipts(self, thread_id, message_ids):
+        data = {}
+        for i, message_id in enumerate(message_ids):
+            data["message_ids[%s]" % i] = message_id
+            data["thread_ids[%s][%s]" % (thread_id, i)] = message_id
+        r = self._post(self.req_url.DELIVERED, data)
+        return r.ok
+
+    def _sendReadReceipt(self, thread_id, watermark):
+        data = {
+            "watermarkTimestamp": watermark,
+            "shouldSendReadReceipt": True,
+            "ids[%s]" % thread_id: True
+        }
+        r = self._post(self.req_url.READ_STATUS, data)
+        return r.ok
+
+    def _sendSeenReceipt(self):
+        r = self._post(self.req_url.MARK_SEEN, {"seen_timestamp": 0})
+        return r.ok
+
     def markAsDelivered(self, userID, threadID):
         """
         .. todo::
             Documenting this
-        """
-        data = {
-            "message_ids[0]": threadID,
-            "thread_ids[%s][0]" % userID: threadID
-        }
 
-        r = self._post(self.req_url.DELIVERED, data)
-        return r.ok
+        If :any:`Client.receipt_batcher` is set, the receipt is queued, and `True` is returned
+        """
+        if self.receipt_batcher is not None:
+            self.receipt_batcher.markAsDelivered(userID, threadID)
+            return True
+        return self._sendDeliveredReceipts(userID, [threadID])
 
     def markAsRead(self, userID):
         """
         .. todo::
             Documenting this
-        """
-        data = {
-            "watermarkTimestamp": now(),
-            "shouldSendReadReceipt": True,
-            "ids[%s]" % userID: True
-        }
 
-        r = self._post(self.req_url.READ_STATUS, data)
-        return r.ok
+        If :any:`Client.receipt_batcher` is set, the receipt is queued, and `True` is returned
+        """
+        if self.receipt_batcher is not None:
+            self.receipt_batcher.markAsRead(userID, now())
+            return True
+        return self._sendReadReceipt(userID, now())
 
     def markAsSeen(self):
         """
         .. todo::
             Documenting this
+
+        If :any:`Client.receipt_batcher` is set, the receipt is queued, and `True` is returned
         """
-        r = self._post(self.req_url.MARK_SEEN, {"seen_timestamp": 0})
-        return r.ok
+        if self.receipt_batcher is not None:
+            self.receipt_batcher.markAsSeen()
+            return True
+        return self._sendSeenReceipt()
 
     def friendConnect(self, friend_id):
         """
@@ -1294,11 +1937,41 @@ class Client(object):
             "clientid": self.client_id,
         }
 
-        j = self._get(ReqUrl.STICKY, data, fix_request=True, as_json=True)
+        start = time.time()
+        j = self._get(self.req_url.STICKY, data, fix_request=True, as_json=True)
+
+        if self.metrics is not None:
+            channel = str(self.req_url.pull_channel)
+            self.metrics.observe('fbchat_pull_duration_seconds', time.time() - start, buckets=PULL_BUCKETS, channel=channel)
+            self.metrics.observe('fbchat_pull_messages', len(j.get('ms', [])), buckets=COUNT_BUCKETS)
 
         self.seq = j.get('seq', '0')
         return j
 
+    def _callHook(self, hook, **kwargs):
+        """Calls one of the `on*` hooks, and records it in :any:`Client.metrics` and :any:`Client.tracer`"""
+        if self.metrics is None and self.tracer is None:
+            return hook(**kwargs)
+        name = getattr(hook, '__name__', 'unknown')
+        start = time.time()
+        try:
+            with self._span(name):
+                return hook(**kwargs)
+        finally:
+            if self.metrics is not None:
+                seconds = time.time() - start
+                self._hook_seconds += seconds
+                self.metrics.observe('fbchat_handler_duration_seconds', seconds, hook=name)
+
+    def _observeMessage(self, metrics, m, start):
+        """Records the parse time and lag of a message from the pull api in `metrics`"""
+        delta = m.get('delta') or {}
+        mtype = (delta.get('type') or delta.get('class') or 'unknown') if m.get('type') == 'delta' else m.get('type')
+        metrics.observe('fbchat_parse_duration_seconds', time.time() - start - self._hook_seconds, type=mtype)
+        timestamp = (delta.get('messageMetadata') or {}).get('timestamp')
+        if timestamp is not None:
+            metrics.observe('fbchat_delta_lag_seconds', max(0, start - int(timestamp) / 1000.0), type=mtype)
+
     def _parseMessage(self, content):
         """Get message and author name from content. May contain multiple messages in the content."""
 
@@ -1306,6 +1979,11 @@ class Client(object):
 
         for m in content["ms"]:
             mtype = m.get("type")
+            # Read once, since `Client.metrics` can be set or unset by a hook while the message is parsed
+            metrics = self.metrics
+            if metrics is not None:
+                start = time.time()
+                self._hook_seconds = 0
             try:
                 # Things that directly change chat
                 if mtype == "delta":
@@ -1335,45 +2013,45 @@ class Client(object):
                     if 'addedParticipants' in delta:
                         added_ids = [str(x['userFbId']) for x in delta['addedParticipants']]
                         thread_id = str(metadata['threadKey']['threadFbId'])
-                        self.onPeopleAdded(mid=mid, added_ids=added_ids, author_id=author_id, thread_id=thread_id,
-                                           ts=ts, msg=m)
+                        self._callHook(self.onPeopleAdded, mid=mid, added_ids=added_ids, author_id=author_id, thread_id=thread_id,
+                                       ts=ts, msg=m)
 
                     # Left/removed participants
                     elif 'leftParticipantFbId' in delta:
                         removed_id = str(delta['leftParticipantFbId'])
                         thread_id = str(metadata['threadKey']['threadFbId'])
-                        self.onPersonRemoved(mid=mid, removed_id=removed_id, author_id=author_id, thread_id=thread_id,
-                                             ts=ts, msg=m)
+                        self._callHook(self.onPersonRemoved, mid=mid, removed_id=removed_id, author_id=author_id, thread_id=thread_id,
+                                       ts=ts, msg=m)
 
                     # Color change
                     elif delta_type == "change_thread_theme":
                         new_color = graphql_color_to_enum(delta["untypedData"]["theme_color"])
                         thread_id, thread_type = getThreadIdAndThreadType(metadata)
-                        self.onColorChange(mid=mid, author_id=author_id, new_color=new_color, thread_id=thread_id,
-                                           thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
+                        self._callHook(self.onColorChange, mid=mid, author_id=author_id, new_color=new_color, thread_id=thread_id,
+                                       thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
 
                     # Emoji change
                     elif delta_type == "change_thread_icon":
                         new_emoji = delta["untypedData"]["thread_icon"]
                         thread_id, thread_type = getThreadIdAndThreadType(metadata)
-                        self.onEmojiChange(mid=mid, author_id=author_id, new_emoji=new_emoji, thread_id=thread_id,
-                                           thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
+                        self._callHook(self.onEmojiChange, mid=mid, author_id=author_id, new_emoji=new_emoji, thread_id=thread_id,
+                                       thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
 
                     # Thread title change
                     elif delta.get("class") == "ThreadName":
                         new_title = delta["name"]
                         thread_id, thread_type = getThreadIdAndThreadType(metadata)
-                        self.onTitleChange(mid=mid, author_id=author_id, new_title=new_title, thread_id=thread_id,
-                                           thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
+                        self._callHook(self.onTitleChange, mid=mid, author_id=author_id, new_title=new_title, thread_id=thread_id,
+                                       thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
 
                     # Nickname change
                     elif delta_type == "change_thread_nickname":
                         changed_for = str(delta["untypedData"]["participant_id"])
                         new_nickname = delta["untypedData"]["nickname"]
                         thread_id, thread_type = getThreadIdAndThreadType(metadata)
-                        self.onNicknameChange(mid=mid, author_id=author_id, changed_for=changed_for,
-                                              new_nickname=new_nickname,
-                                              thread_id=thread_id, thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
+                        self._callHook(self.onNicknameChange, mid=mid, author_id=author_id, changed_for=changed_for,
+                                       new_nickname=new_nickname,
+                                       thread_id=thread_id, thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
 
                     # Message delivered
                     elif delta.get("class") == "DeliveryReceipt":
@@ -1381,8 +2059,8 @@ class Client(object):
                         delivered_for = str(delta.get("actorFbId") or delta["threadKey"]["otherUserFbId"])
                         ts = int(delta["deliveredWatermarkTimestampMs"])
                         thread_id, thread_type = getThreadIdAndThreadType(delta)
-                        self.onMessageDelivered(msg_ids=message_ids, delivered_for=delivered_for,
-                                                thread_id=thread_id, thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
+                        self._callHook(self.onMessageDelivered, msg_ids=message_ids, delivered_for=delivered_for,
+                                       thread_id=thread_id, thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
 
                     # Message seen
                     elif delta.get("class") == "ReadReceipt":
@@ -1390,8 +2068,8 @@ class Client(object):
                         seen_ts = int(delta["actionTimestampMs"])
                         delivered_ts = int(delta["watermarkTimestampMs"])
                         thread_id, thread_type = getThreadIdAndThreadType(delta)
-                        self.onMessageSeen(seen_by=seen_by, thread_id=thread_id, thread_type=thread_type,
-                                           seen_ts=seen_ts, ts=delivered_ts, metadata=metadata, msg=m)
+                        self._callHook(self.onMessageSeen, seen_by=seen_by, thread_id=thread_id, thread_type=thread_type,
+                                       seen_ts=seen_ts, ts=delivered_ts, metadata=metadata, msg=m)
 
                     # Messages marked as seen
                     elif delta.get("class") == "MarkRead":
@@ -1403,22 +2081,24 @@ class Client(object):
                             threads = [getThreadIdAndThreadType({"threadKey": thr}) for thr in delta.get("threadKeys")]
 
                         # thread_id, thread_type = getThreadIdAndThreadType(delta)
-                        self.onMarkedSeen(threads=threads, seen_ts=seen_ts, ts=delivered_ts, metadata=delta, msg=m)
+                        self._callHook(self.onMarkedSeen, threads=threads, seen_ts=seen_ts, ts=delivered_ts, metadata=delta, msg=m)
 
                     # New message
                     elif delta.get("class") == "NewMessage":
                         message = delta.get('body', '')
                         thread_id, thread_type = getThreadIdAndThreadType(metadata)
-                        self.onMessage(mid=mid, author_id=author_id, message=message,
+                        if self.message_index is not None:
+                            self.message_index.add(thread_id, Message(mid, author=author_id, timestamp=str(ts), text=message))
+                        self._callHook(self.onMessage, mid=mid, author_id=author_id, message=message,
                                        thread_id=thread_id, thread_type=thread_type, ts=ts, metadata=metadata, msg=m)
 
                     # Unknown message type
                     else:
-                        self.onUnknownMesssageType(msg=m)
+                        self._callHook(self.onUnknownMesssageType, msg=m)
 
                 # Inbox
                 elif mtype == "inbox":
-                    self.onInbox(unseen=m["unseen"], unread=m["unread"], recent_unread=m["recent_unread"], msg=m)
+                    self._callHook(self.onInbox, unseen=m["unseen"], unread=m["unread"], recent_unread=m["recent_unread"], msg=m)
 
                 # Typing
                 # elif mtype == "typ":
@@ -1439,7 +2119,7 @@ class Client(object):
 
                 # Happens on every login
                 elif mtype == "qprimer":
-                    self.onQprimer(ts=m.get("made"), msg=m)
+                    self._callHook(self.onQprimer, ts=m.get("made"), msg=m)
 
                 # Is sent before any other message
                 elif mtype == "deltaflow":
@@ -1451,14 +2131,17 @@ class Client(object):
                     for _id in m.get('buddyList', {}):
                         payload = m['buddyList'][_id]
                         buddylist[_id] = payload.get('lat')
-                    self.onChatTimestamp(buddylist=buddylist, msg=m)
+                    self._callHook(self.onChatTimestamp, buddylist=buddylist, msg=m)
 
                 # Unknown message type
                 else:
-                    self.onUnknownMesssageType(msg=m)
+                    self._callHook(self.onUnknownMesssageType, msg=m)
 
             except Exception as e:
-                self.onMessageError(exception=e, msg=m)
+                self._callHook(self.onMessageError, exception=e, msg=m)
+
+            if metrics is not None:
+                self._observeMessage(metrics, m, start)
 
     def startListening(self):
         """
@@ -1480,11 +2163,13 @@ class Client(object):
         :rtype: bool
         """
         try:
-            if markAlive:
-                self._ping(self.sticky, self.pool)
-            content = self._pullMessage(self.sticky, self.pool)
-            if content:
-                self._parseMessage(content)
+            with self._span('doOneListen'):
+                if markAlive:
+                    self._ping(self.sticky, self.pool)
+                content = self._pullMessage(self.sticky, self.pool)
+                if content:
+                    with self._span('_parseMessage', messages=len(content.get('ms', []))):
+                        self._parseMessage(content)
         except KeyboardInterrupt:
             return False
         except requests.Timeout:
@@ -1505,9 +2190,11 @@ class Client(object):
         return True
 
     def stopListening(self):
-        """Cleans up the variables from startListening"""
+        """Cleans up the variables from startListening, and sends the receipts queued in :any:`Client.receipt_batcher`"""
         self.listening = False
         self.sticky, self.pool = (None, None)
+        if self.receipt_batcher is not None:
+            self.receipt_batcher.flush()
 
     def listen(self, markAlive=True):
         """
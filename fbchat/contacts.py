@@ -0,0 +1,276 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import io
+import json
+import mmap
+import struct
+from array import array
+from .utils import *
+from .models import *
+
+MAGIC = b'FBCT1\n'
+
+#: The string columns of a :class:`ContactTable`, in the order they're stored
+STRING_COLUMNS = ('uid', 'name', 'first_name', 'url', 'photo', 'gender')
+
+_FRIEND = {None: -1, False: 0, True: 1}
+_FRIEND_VALUES = {-1: None, 0: False, 1: True}
+
+
+# Python 2 can't cast memoryviews, and its `mmap` can't be wrapped in one
+_CAN_CAST = hasattr(memoryview, 'cast')
+
+
+def _view(buffer, typecode):
+    """
+    Returns a zero-copy view of `buffer` as an array of `typecode`.
+    On Python 2, `buffer` is a `str` sliced from the `mmap`, which is copied into an `array`
+    """
+    if _CAN_CAST:
+        return memoryview(buffer).cast(str(typecode))
+    rtn = array(str(typecode))
+    rtn.fromstring(buffer)
+    return rtn
+
+
+def _to_bytes(values):
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+
+class _MappedStrings(object):
+    """A read-only string pool, decoded on access from a memory-mapped file"""
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        # Index 0 is `None`, so string `i` is found between offsets `i-1` and `i`
+        if i == 0:
+            return None
+        return bytes(self._blob[self._offsets[i-1]:self._offsets[i]]).decode(facebookEncoding)
+
+
+class ContactTable(object):
+    """
+    A compact, column-oriented table of the users returned by :func:`Client.fetchAllUsers`.
+    Used by :func:`Client.fetchContactTable`
+
+    Instead of a :class:`models.User` object per contact, each column is an `array` of indices into a shared pool of interned strings,
+    and :class:`models.User` objects are only created when they're accessed.
+    The table can be saved to disk with :func:`ContactTable.save`, and memory-mapped with :func:`ContactTable.load`
+    """
+    def __init__(self):
+        # Index 0 is reserved for `None`
+        self._strings = [None]
+        self._string_ids = {None: 0}
+        self._columns = dict((name, array(str('i'))) for name in STRING_COLUMNS)
+        self._is_friend = array(str('b'))
+        #: Row numbers, labeled by user ID
+        self.rows = {}
+        self._mapped = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, uid):
+        return uid in self.rows
+
+    def __iter__(self):
+        for row in range(len(self.rows)):
+            yield self._user(row)
+
+    def _string(self, value):
+        """Returns the index of `value` in the string pool, adding it if needed"""
+        _id = self._string_ids.get(value)
+        if _id is None:
+            _id = self._string_ids[value] = len(self._strings)
+            self._strings.append(value)
+        return _id
+
+    def _materialize(self):
+        """Copies a memory-mapped table into memory, so it can be modified"""
+        if self._mapped is None:
+            return
+        self._strings = [None] + [self._strings[i] for i in range(1, len(self._strings))]
+        self._string_ids = dict((s, i) for i, s in enumerate(self._strings))
+        self._columns = dict((name, array(str('i'), self._columns[name])) for name in STRING_COLUMNS)
+        self._is_friend = array(str('b'), self._is_friend)
+        # The file is unmapped once the views into it are garbage collected
+        self._mapped = None
+
+    def _user(self, row):
+        values = dict((name, self._strings[self._columns[name][row]]) for name in STRING_COLUMNS)
+        return User(
+            values['uid'],
+            first_name=values['first_name'],
+            url=values['url'],
+            photo=values['photo'],
+            name=values['name'],
+            is_friend=_FRIEND_VALUES[self._is_friend[row]],
+            gender=values['gender']
+        )
+
+    def get(self, uid):
+        """
+        :param uid: The user's ID
+        :return: A :class:`models.User` object, or `None` if the user is not in the table
+        """
+        row = self.rows.get(uid)
+        if row is None:
+            return None
+        return self._user(row)
+
+    def column(self, name):
+        """
+        :param name: One of `uid`, `name`, `first_name`, `url`, `photo`, `gender` or `is_friend`
+        :return: The values of the column, in row order
+        :rtype: list
+        """
+        if name == 'is_friend':
+            return [_FRIEND_VALUES[v] for v in self._is_friend]
+        return [self._strings[i] for i in self._columns[name]]
+
+    def _removeRow(self, row):
+        """Removes a row by moving the last row into its place"""
+        last = len(self._is_friend) - 1
+        if row != last:
+            for name in STRING_COLUMNS:
+                self._columns[name][row] = self._columns[name][last]
+            self._is_friend[row] = self._is_friend[last]
+            self.rows[self._strings[self._columns['uid'][row]]] = row
+        for name in STRING_COLUMNS:
+            self._columns[name].pop()
+        self._is_friend.pop()
+
+    def update(self, payload):
+        """
+        Updates the table from the payload of an `ALL_USERS` request. Only changed rows are rewritten
+
+        :param payload: The `payload` of the response
+        :type payload: dict
+        :return: The amount of added, changed and removed users
+        :rtype: tuple
+        """
+        self._materialize()
+        added, changed = 0, 0
+        seen = set()
+
+        for key in payload:
+            k = payload[key]
+            if k['type'] not in ['user', 'friend'] or k['id'] in ['0', 0]:
+                continue
+            uid = str(k['id'])
+            seen.add(uid)
+            values = {
+                'uid': self._string(uid),
+                'name': self._string(k.get('name')),
+                'first_name': self._string(k.get('firstName')),
+                'url': self._string(k.get('uri')),
+                'photo': self._string(k.get('thumbSrc')),
+                'gender': self._string(GENDERS[k.get('gender')]),
+            }
+            is_friend = _FRIEND[k.get('is_friend')]
+
+            row = self.rows.get(uid)
+            if row is None:
+                self.rows[uid] = len(self.rows)
+                for name in STRING_COLUMNS:
+                    self._columns[name].append(values[name])
+                self._is_friend.append(is_friend)
+                added += 1
+            elif is_friend != self._is_friend[row] or any(self._columns[name][row] != values[name] for name in STRING_COLUMNS):
+                for name in STRING_COLUMNS:
+                    self._columns[name][row] = values[name]
+                self._is_friend[row] = is_friend
+                changed += 1
+
+        removed = [uid for uid in self.rows if uid not in seen]
+        for uid in removed:
+            self._removeRow(self.rows.pop(uid))
+
+        return added, changed, len(removed)
+
+    def save(self, path):
+        """
+        Saves the table to disk. Unused strings are left out
+
+        :param path: Path of the file
+        """
+        strings = [None]
+        string_ids = {None: 0}
+        columns = {}
+        for name in STRING_COLUMNS:
+            column = array(str('i'))
+            for i in self._columns[name]:
+                value = self._strings[i]
+                if value not in string_ids:
+                    string_ids[value] = len(strings)
+                    strings.append(value)
+                column.append(string_ids[value])
+            columns[name] = column
+
+        offsets = array(str('i'), [0])
+        blob = io.BytesIO()
+        for value in strings[1:]:
+            blob.write(value.encode(facebookEncoding))
+            offsets.append(blob.tell())
+        blob = blob.getvalue()
+        blob += b'\0' * (-len(blob) % 4)
+
+        header = json.dumps({'rows': len(self.rows), 'strings': len(strings) - 1, 'blob': len(blob)}).encode(facebookEncoding)
+        header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 4)
+
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack(str('<I'), len(header)))
+            f.write(header)
+            f.write(_to_bytes(offsets))
+            f.write(blob)
+            for name in STRING_COLUMNS:
+                f.write(_to_bytes(columns[name]))
+            f.write(_to_bytes(self._is_friend))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps a table saved with :func:`ContactTable.save`.
+        Nothing but the user IDs is read until it's accessed, and the table is only copied into memory if it's updated.
+        On Python 2, the columns are copied into memory when loading, since its `mmap` can't be viewed without copying
+
+        :param path: Path of the file
+        :rtype: ContactTable
+        :raises: FBchatException if the file is not a saved table
+        """
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(MAGIC)] != MAGIC:
+            mapped.close()
+            raise FBchatException('{} is not a saved ContactTable'.format(path))
+
+        pos = len(MAGIC)
+        header_length, = struct.unpack(str('<I'), mapped[pos:pos+4])
+        pos += 4
+        header = json.loads(mapped[pos:pos+header_length].decode(facebookEncoding))
+        pos += header_length
+
+        # On Python 2, slicing the `mmap` copies the slice into a `str`
+        buffer = memoryview(mapped) if _CAN_CAST else mapped
+        rows = header['rows']
+        offsets = _view(buffer[pos:pos+4*(header['strings']+1)], 'i')
+        pos += 4*(header['strings']+1)
+        blob = buffer[pos:pos+header['blob']]
+        pos += header['blob']
+
+        table = cls()
+        table._strings = _MappedStrings(offsets, blob)
+        for name in STRING_COLUMNS:
+            table._columns[name] = _view(buffer[pos:pos+4*rows], 'i')
+            pos += 4*rows
+        table._is_friend = _view(buffer[pos:pos+rows], 'b')
+        table._mapped = mapped
+        table.rows = dict((table._strings[i], row) for row, i in enumerate(table._columns['uid']))
+        return table
@@ -0,0 +1,328 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import io
+import os
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .utils import *
+from .models import *
+
+
+def model_to_dict(model):
+    """Converts a model (e.g. :class:`models.Message` or :class:`models.Thread`) into JSON-serializable values"""
+    if isinstance(model, Enum):
+        return model.name
+    if isinstance(model, (set, frozenset)):
+        return sorted(model_to_dict(v) for v in model)
+    if isinstance(model, (list, tuple)):
+        return [model_to_dict(v) for v in model]
+    if isinstance(model, dict):
+        return dict((k, model_to_dict(v)) for k, v in model.items())
+    if hasattr(model, '__dict__'):
+        return dict((k, model_to_dict(v)) for k, v in vars(model).items())
+    return model
+
+
+class JSONLinesWriter(object):
+    """
+    Writes exported threads and messages as newline-delimited JSON
+
+    Each line is an object with a `record` key, being either `thread` or `message`.
+    High-water marks are kept in a `<path>.state` file next to the export.
+
+    .. note::
+        If an export is interrupted, the messages of the unfinished threads are exported again the next time,
+        so duplicate lines (with the same `uid`) are possible
+
+    :param path: Path of the file to append to
+    """
+    def __init__(self, path):
+        self.path = path
+        self.state_path = path + '.state'
+        self._lock = threading.Lock()
+        self._file = io.open(path, 'a', encoding=facebookEncoding)
+        self._watermarks = {}
+        if os.path.exists(self.state_path):
+            with io.open(self.state_path, 'r', encoding=facebookEncoding) as f:
+                self._watermarks = json.load(f)
+
+    def _writeRecord(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def getWatermark(self, thread_id):
+        """
+        Returns the timestamp of the newest exported message in the thread, or None,
+        and the IDs of the exported messages with that timestamp
+
+        :rtype: tuple
+        """
+        with self._lock:
+            watermark = self._watermarks.get(thread_id)
+        if watermark is None:
+            return None, set()
+        # State files of older versions only have the timestamp
+        if not isinstance(watermark, dict):
+            return watermark, set()
+        return watermark['timestamp'], set(watermark['boundary'])
+
+    def setWatermark(self, thread_id, timestamp, boundary=()):
+        with self._lock:
+            self._file.flush()
+            self._watermarks[thread_id] = {'timestamp': timestamp, 'boundary': sorted(boundary)}
+            tmp_path = self.state_path + '.tmp'
+            with io.open(tmp_path, 'w', encoding=facebookEncoding) as f:
+                f.write(json.dumps(self._watermarks, ensure_ascii=False))
+            replace_file(tmp_path, self.state_path)
+
+    def writeThread(self, thread):
+        record = model_to_dict(thread)
+        record['record'] = 'thread'
+        with self._lock:
+            self._writeRecord(record)
+
+    def writeMessages(self, thread_id, messages):
+        with self._lock:
+            for message in messages:
+                record = model_to_dict(message)
+                record['record'] = 'message'
+                record['thread_id'] = thread_id
+                self._writeRecord(record)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SQLiteWriter(object):
+    """
+    Writes exported threads and messages to a SQLite database, with batched inserts
+
+    Messages are keyed by their ID, so exporting a message twice just replaces the row.
+    High-water marks are committed together with the messages they cover.
+
+    :param path: Path of the database
+    :param batch_size: Amount of messages to buffer before inserting them
+    """
+    def __init__(self, path, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = []
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS threads (
+                id TEXT PRIMARY KEY, type TEXT, name TEXT, data TEXT
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY, thread_id TEXT, author TEXT, timestamp INTEGER, text TEXT, data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread_id, timestamp);
+            CREATE TABLE IF NOT EXISTS watermarks (
+                thread_id TEXT PRIMARY KEY, timestamp INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS watermark_messages (
+                thread_id TEXT, id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS watermark_messages_thread ON watermark_messages (thread_id);
+        """)
+
+    def _flushPending(self):
+        if self._pending:
+            self._db.executemany('INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)', self._pending)
+            self._pending = []
+        self._db.commit()
+
+    def getWatermark(self, thread_id):
+        """
+        Returns the timestamp of the newest exported message in the thread, or None,
+        and the IDs of the exported messages with that timestamp
+
+        :rtype: tuple
+        """
+        with self._lock:
+            row = self._db.execute('SELECT timestamp FROM watermarks WHERE thread_id = ?', (thread_id,)).fetchone()
+            boundary = set(r[0] for r in self._db.execute('SELECT id FROM watermark_messages WHERE thread_id = ?', (thread_id,)))
+        return (row[0] if row else None), boundary
+
+    def setWatermark(self, thread_id, timestamp, boundary=()):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?)', (thread_id, timestamp))
+            self._db.execute('DELETE FROM watermark_messages WHERE thread_id = ?', (thread_id,))
+            self._db.executemany('INSERT INTO watermark_messages VALUES (?, ?)', [(thread_id, uid) for uid in boundary])
+            self._flushPending()
+
+    def writeThread(self, thread):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?)', (
+                thread.uid, thread.type.name, thread.name, json.dumps(model_to_dict(thread), ensure_ascii=False)
+            ))
+
+    def writeMessages(self, thread_id, messages):
+        with self._lock:
+            for message in messages:
+                self._pending.append((
+                    message.uid,
+                    thread_id,
+                    message.author,
+                    int(message.timestamp) if message.timestamp else None,
+                    message.text,
+                    json.dumps(model_to_dict(message), ensure_ascii=False)
+                ))
+            if len(self._pending) >= self.batch_size:
+                self._flushPending()
+
+    def flush(self):
+        with self._lock:
+            self._flushPending()
+
+    def close(self):
+        with self._lock:
+            self._flushPending()
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Exporter(object):
+    """
+    Exports threads and their messages, using :func:`Client.fetchThreadList` and :func:`Client.fetchThreadMessages`
+
+    Exports are resumable: the writer remembers the timestamp of the newest exported message in each thread,
+    and later exports only fetch messages newer than that.
+    Multiple threads are exported in parallel, while all requests share the same rate limit.
+
+    :param client: A logged in :class:`Client`
+    :param writer: A :class:`JSONLinesWriter` or a :class:`SQLiteWriter`
+    :param workers: Amount of threads to export in parallel
+    :param rate: Max. amount of requests per second
+    :param page_size: Amount of messages to fetch per request
+    """
+    def __init__(self, client, writer, workers=4, rate=2, page_size=100):
+        self.client = client
+        self.writer = writer
+        self.workers = workers
+        self.page_size = page_size
+        #: Timestamps of which not every message could be exported, labeled by thread ID.
+        #: A page only holds :any:`Exporter.page_size` messages, and pages are selected by timestamp,
+        #: so if more messages than that have the same timestamp, the rest of them can't be fetched
+        self.incomplete = {}
+        self._limiter = RateLimiter(rate)
+
+    def fetchThreads(self):
+        """Yields every thread in the thread list, see :func:`Client.fetchThreadList`"""
+        offset = 0
+        while True:
+            self._limiter.wait()
+            threads = self.client.fetchThreadList(offset=offset, limit=20)
+            for thread in threads:
+                yield thread
+            if len(threads) < 20:
+                return
+            offset += len(threads)
+
+    def exportThread(self, thread):
+        """
+        Exports the messages of a thread, which are newer than the thread's high-water mark
+
+        :param thread: A :class:`models.Thread` object
+        :return: Amount of exported messages
+        :rtype: int
+        :raises: FBchatException if request failed
+        """
+        self.writer.writeThread(thread)
+        # Messages with the watermark's timestamp may be new, unless they're in `exported`
+        watermark, exported = self.writer.getWatermark(thread.uid)
+        newest, newest_uids = None, set()
+        before = None
+        boundary = set()
+        incomplete = []
+        count = 0
+
+        while True:
+            self._limiter.wait()
+            # Messages are returned newest first, and `before` is inclusive
+            messages = self.client.fetchThreadMessages(thread_id=thread.uid, limit=self.page_size, before=before)
+            done = len(messages) < self.page_size
+            batch = []
+            for message in messages:
+                timestamp = int(message.timestamp)
+                if watermark is not None and timestamp < watermark:
+                    done = True
+                    break
+                if message.uid in boundary or message.uid in exported:
+                    continue
+                batch.append(message)
+                if newest is None or timestamp > newest:
+                    newest, newest_uids = timestamp, set()
+                if timestamp == newest:
+                    newest_uids.add(message.uid)
+
+            if len(batch) > 0:
+                self.writer.writeMessages(thread.uid, batch)
+                count += len(batch)
+            if done:
+                break
+            oldest = int(messages[-1].timestamp)
+            if len(batch) == 0:
+                # The whole page has the timestamp the previous one ended with, so fetching from it again returns the same page.
+                # Step past it; messages with that timestamp beyond a page can't be fetched
+                log.warning('Some messages of thread {} with timestamp {} could not be exported'.format(thread.uid, oldest))
+                incomplete.append(oldest)
+                before, boundary = oldest - 1, set()
+            else:
+                before = oldest
+                boundary = set(m.uid for m in messages if int(m.timestamp) == before)
+
+        if incomplete:
+            self.incomplete[thread.uid] = incomplete
+            # Everything older than the oldest incomplete timestamp is exported, so the next export starts from there
+            if watermark is None or min(incomplete) - 1 > watermark:
+                self.writer.setWatermark(thread.uid, min(incomplete) - 1)
+        elif newest is not None:
+            if newest == watermark:
+                newest_uids |= exported
+            self.writer.setWatermark(thread.uid, newest, newest_uids)
+        log.debug('Exported {} messages from {}'.format(count, thread.uid))
+        return count
+
+    def export(self, threads=None):
+        """
+        Exports threads in parallel
+
+        :param threads: :class:`models.Thread` objects to export. If `None`, every thread in the thread list is exported
+        :return: The amount of exported messages, or the exception that occured, labeled by thread ID
+        :rtype: dict
+        """
+        if threads is None:
+            threads = list(self.fetchThreads())
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = dict((executor.submit(self.exportThread, thread), thread.uid) for thread in threads)
+            for future in as_completed(futures):
+                thread_id = futures[future]
+                try:
+                    results[thread_id] = future.result()
+                except Exception as e:
+                    log.exception('Failed exporting thread {}'.format(thread_id))
+                    results[thread_id] = e
+
+        self.writer.flush()
+        return results
@@ -0,0 +1,296 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import re
+import sqlite3
+import threading
+import unicodedata
+from bisect import bisect_left
+from .utils import *
+from .models import *
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def _escape_like(text):
+    """Escapes the wildcards of a `LIKE` pattern (e.g. `_`, which is part of a word), for use with `ESCAPE '\\'`"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def normalize(text):
+    """Lowercases `text`, and strips it of accents, so e.g. `Tést` and `test` are equal"""
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def _create_fts_table(db):
+    """Creates the full-text table with the best engine this SQLite build supports, and returns the engine's name"""
+    for engine, statement in [
+        ('fts5', 'CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, tokenize=unicode61)'),
+        ('fts4', 'CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts4(text, tokenize=unicode61)'),
+        ('fts4', 'CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts4(text)'),
+    ]:
+        try:
+            db.execute(statement)
+            return engine
+        except sqlite3.OperationalError:
+            pass
+    return None
+
+
+def _reopen(db, path):
+    """
+    Returns a new connection to the database of `db`, that was opened with `path`.
+    In-memory databases are copied into the new connection, except on Python 2, which can't copy them, so they start empty
+    """
+    rtn = sqlite3.connect(path, check_same_thread=False)
+    if path == ':memory:' and hasattr(db, 'backup'):
+        db.backup(rtn)
+    return rtn
+
+
+class MessageIndex(object):
+    """
+    A local, incrementally updated full-text index of messages, stored in SQLite.
+    Uses FTS5 or FTS4 if the SQLite build supports it, and falls back to (slower) `LIKE` queries otherwise.
+
+    Set it as :any:`Client.message_index` to index messages, and use :func:`Client.searchForMessages` to search them
+
+    :param path: Path of the database. Defaults to an in-memory database
+    """
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._createTables()
+
+    def _createTables(self):
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                rowid INTEGER PRIMARY KEY, id TEXT UNIQUE, thread_id TEXT, author TEXT, timestamp INTEGER, text TEXT
+            )
+        """)
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread_id, timestamp)')
+        self.engine = _create_fts_table(self._db)
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def _add(self, thread_id, message):
+        if not message.uid or not message.text:
+            return
+        cursor = self._db.execute('INSERT OR IGNORE INTO messages (id, thread_id, author, timestamp, text) VALUES (?, ?, ?, ?, ?)', (
+            message.uid,
+            str(thread_id),
+            message.author,
+            int(message.timestamp) if message.timestamp else None,
+            message.text
+        ))
+        if cursor.rowcount == 1 and self.engine is not None:
+            self._db.execute('INSERT INTO messages_fts (rowid, text) VALUES (?, ?)', (cursor.lastrowid, message.text))
+
+    def add(self, thread_id, *messages):
+        """
+        Adds messages to the index. Messages that are already indexed, or have no text, are skipped
+
+        :param thread_id: The thread the messages were sent in
+        :param messages: :class:`models.Message` objects
+        """
+        with self._lock:
+            for message in messages:
+                self._add(thread_id, message)
+            self._db.commit()
+
+    def search(self, query, thread_id=None, limit=20):
+        """
+        Searches the indexed messages. All words in `query` must be present, the last one may be a prefix
+
+        :param query: Text to search for
+        :param thread_id: If set, only messages in this thread are searched
+        :param limit: Max. number of messages to return
+        :return: :class:`models.Message` objects, newest first, labeled by their thread ID
+        :rtype: dict
+        """
+        words = [w.lower() for w in WORD.findall(query)]
+        if len(words) == 0:
+            return {}
+
+        if self.engine is not None:
+            sql = 'SELECT m.id, m.thread_id, m.author, m.timestamp, m.text FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid WHERE messages_fts MATCH ?'
+            params = [' '.join(words) + '*']
+        else:
+            sql = 'SELECT id, thread_id, author, timestamp, text FROM messages m WHERE ' + ' AND '.join(["m.text LIKE ? ESCAPE '\\'"] * len(words))
+            params = ['%{}%'.format(_escape_like(w)) for w in words]
+        if thread_id is not None:
+            sql += ' AND m.thread_id = ?'
+            params.append(str(thread_id))
+        sql += ' ORDER BY m.timestamp DESC LIMIT ?'
+        params.append(limit)
+
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+
+        rtn = {}
+        for _id, _thread_id, author, timestamp, text in rows:
+            rtn.setdefault(_thread_id, []).append(Message(_id, author=author, timestamp=str(timestamp) if timestamp is not None else None, text=text))
+        return rtn
+
+    def afterFork(self):
+        """Reopens the database in a forked process. See :func:`Client.afterFork`"""
+        self._lock = threading.Lock()
+        self._db = _reopen(self._db, self.path)
+        self._createTables()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ThreadIndex(object):
+    """
+    An in-process prefix index of known users, groups and pages, used to answer searches by name without sending requests.
+
+    Set it as :any:`Client.thread_index`, and the search functions (e.g. :func:`Client.searchForUsers`) will use it,
+    only sending requests when fewer threads than asked for were found locally.
+    The index is filled by the results of :func:`Client.fetchAllUsers`, :func:`Client.fetchThreadList`,
+    :func:`Client.fetchThreadInfo` and the searches themselves, and can be refreshed in the background with :func:`ThreadIndex.startRefreshing`
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        #: :class:`models.Thread` objects, labeled by their ID
+        self.threads = {}
+        # Sorted list of `(word, thread ID)` tuples, searched with bisect
+        self._words = []
+        self._refresher = None
+        self._refreshing = None
+        self._stop_refreshing = threading.Event()
+
+    def __len__(self):
+        return len(self.threads)
+
+    def add(self, *threads):
+        """
+        Adds threads to the index, replacing the previous versions of them
+
+        :param threads: :class:`models.User`, :class:`models.Group` and :class:`models.Page` objects
+        """
+        threads = dict((thread.uid, thread) for thread in threads)
+        with self._lock:
+            replaced = set(uid for uid in threads if uid in self.threads)
+            if replaced:
+                self._words = [entry for entry in self._words if entry[1] not in replaced]
+            for uid, thread in threads.items():
+                self.threads[uid] = thread
+                self._words.extend((word, uid) for word in set(WORD.findall(normalize(thread.name))))
+            # Sorted once per call, so adding many threads at once (e.g. in `refresh`) doesn't take quadratic time
+            self._words.sort()
+
+    def _prefixed(self, prefix):
+        """Returns the IDs of the threads with a word starting with `prefix`"""
+        rtn = set()
+        for i in range(bisect_left(self._words, (prefix,)), len(self._words)):
+            word, uid = self._words[i]
+            if not word.startswith(prefix):
+                break
+            rtn.add(uid)
+        return rtn
+
+    def search(self, name, limit=1, thread_type=None):
+        """
+        Find threads by their name. Every word in `name` must be the beginning of a word in the thread's name
+
+        Results are ordered by relevance: Exact matches first, then names starting with `name`, then other matches.
+        Ties are broken by the user's affinity and the thread's message count
+
+        :param name: Name of the thread
+        :param limit: The max. amount of threads to return
+        :param thread_type: If set, only threads of this type are returned
+        :type thread_type: models.ThreadType
+        :return: :class:`models.Thread` objects, ordered by relevance
+        :rtype: list
+        """
+        query = normalize(name).strip()
+        words = WORD.findall(query)
+        if len(words) == 0:
+            return []
+
+        with self._lock:
+            uids = None
+            for word in words:
+                uids = self._prefixed(word) if uids is None else uids & self._prefixed(word)
+                if len(uids) == 0:
+                    return []
+            threads = [self.threads[uid] for uid in uids]
+
+        if thread_type is not None:
+            threads = [thread for thread in threads if thread.type == thread_type]
+
+        def relevance(thread):
+            thread_name = normalize(thread.name)
+            if thread_name == query:
+                rank = 0
+            elif thread_name.startswith(query):
+                # Prefer whole words, e.g. `Mark Zuckerberg` over `Marko` when searching for `Mark`
+                rank = 1 if thread_name[len(query)].isspace() else 2
+            else:
+                rank = 3
+            return (rank, -(getattr(thread, 'affinity', None) or 0), -(thread.message_count or 0), thread_name)
+
+        return sorted(threads, key=relevance)[:limit]
+
+    def refresh(self, client, thread_pages=5):
+        """
+        Fills the index with the client's users and recent threads
+
+        :param client: A logged in :class:`Client`
+        :param thread_pages: Amount of pages (of 20 threads) to fetch with :func:`Client.fetchThreadList`
+        :raises: FBchatException if request failed
+        """
+        self.add(*client.fetchAllUsers())
+        for page in range(thread_pages):
+            threads = client.fetchThreadList(offset=page*20, limit=20)
+            self.add(*threads)
+            if len(threads) < 20:
+                break
+
+    def startRefreshing(self, client, interval=600, thread_pages=5):
+        """
+        Refreshes the index in a background thread, every `interval` seconds. See :func:`ThreadIndex.refresh`
+
+        :param client: A logged in :class:`Client`
+        :param interval: Seconds between each refresh
+        """
+        if self._refresher is not None:
+            raise FBchatUserError('The index is already being refreshed')
+        self._stop_refreshing.clear()
+        self._refreshing = (client, interval, thread_pages)
+
+        def run():
+            while not self._stop_refreshing.is_set():
+                try:
+                    self.refresh(client, thread_pages=thread_pages)
+                except Exception:
+                    log.exception('Failed refreshing thread index')
+                self._stop_refreshing.wait(interval)
+
+        self._refresher = threading.Thread(target=run, name='fbchat-thread-index')
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def stopRefreshing(self):
+        """Stops the background refreshing started by :func:`ThreadIndex.startRefreshing`"""
+        if self._refresher is not None:
+            self._stop_refreshing.set()
+            self._refresher.join()
+            self._refresher = None
+
+    def afterFork(self):
+        """Replaces the lock in a forked process, and restarts the background refreshing if it was started. See :func:`Client.afterFork`"""
+        self._lock = threading.Lock()
+        self._stop_refreshing = threading.Event()
+        if self._refresher is not None:
+            self._refresher = None
+            client, interval, thread_pages = self._refreshing
+            self.startRefreshing(client, interval=interval, thread_pages=thread_pages)
@@ -0,0 +1,358 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import threading
+from bisect import bisect_left
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+from .utils import *
+from .models import *
+
+
+#: Upper bounds of the buckets of the latency histograms, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+#: Upper bounds of the buckets of the pull durations, in seconds. Pulls are long polls, that are held open until there's something new
+PULL_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60)
+#: Upper bounds of the buckets of the amount of messages per pull
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+
+
+def endpoint_name(req_url, url):
+    """
+    Returns the name of the :class:`utils.ReqUrl` attribute `url` belongs to (e.g. `SEND`),
+    or the path of the URL if it's not one of them
+    """
+    base = url.split('?', 1)[0]
+    for name in dir(req_url):
+        if name.isupper():
+            value = getattr(req_url, name)
+            if isinstance(value, type('')) and value.split('?', 1)[0] == base:
+                return name
+    return urlparse(base).path or '/'
+
+
+class Histogram(object):
+    """
+    Counts observed values in buckets, like a Prometheus histogram
+
+    :param buckets: Upper bounds of the buckets, in increasing order. Larger values are counted in an implicit `+Inf` bucket
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimates the `q`-quantile (e.g. `0.99`) of the observed values, by interpolating within the bucket it falls in
+
+        :return: The estimate, or `None` if nothing was observed
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                lower = self.buckets[i-1] if i > 0 else 0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics(object):
+    """
+    Thread-safe counters and histograms, labeled by name and a set of labels.
+    Set it as :any:`Client.metrics` to record the following metrics of every request to Facebook:
+
+    - `fbchat_requests_total`: Requests, labeled by `endpoint`, `method` and `status` (the HTTP status, or the name of the exception)
+    - `fbchat_request_duration_seconds`: Histogram of the request latencies, labeled by `endpoint`
+    - `fbchat_request_bytes_total` and `fbchat_response_bytes_total`: Bytes sent and received, labeled by `endpoint`
+    - `fbchat_facebook_errors_total`: Errors returned by Facebook, labeled by `endpoint` and `code`
+    - `fbchat_retries_total`: Requests that were retried after an error, labeled by `endpoint`
+
+    And while listening:
+
+    - `fbchat_pull_duration_seconds`: Histogram of the round-trip times of the pulls, labeled by the edge-chat `channel`
+    - `fbchat_pull_messages`: Histogram of the amount of messages received per pull
+    - `fbchat_parse_duration_seconds`: Histogram of the time spent parsing a message, without the hooks, labeled by `type`
+    - `fbchat_handler_duration_seconds`: Histogram of the time spent in each hook (e.g. :func:`Client.onMessage`), labeled by `hook`
+    - `fbchat_delta_lag_seconds`: Histogram of the time between a message being sent, and it being dispatched to a hook, labeled by `type`
+
+    Metrics can be read with :func:`Metrics.snapshot`, or exported with an :class:`Exporter`
+
+    :param buckets: Upper bounds of the buckets of the histograms, in seconds
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._endpoints = {}
+        self._exporting = None
+        self._stop_exporting = threading.Event()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def count(self, name, amount=1, **labels):
+        """Adds `amount` to a counter"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=None, **labels):
+        """
+        Adds a value to a histogram
+
+        :param buckets: Upper bounds of the buckets, used if the histogram doesn't exist yet. Defaults to the buckets of the metrics
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets or self.buckets)
+            histogram.observe(value)
+
+    def histogram(self, name, **labels):
+        """
+        :return: A copy of a histogram, or `None` if nothing was observed
+        :rtype: Histogram
+        """
+        with self._lock:
+            histogram = self._histograms.get(self._key(name, labels))
+            if histogram is None:
+                return None
+            rtn = Histogram(histogram.buckets)
+            rtn.counts, rtn.sum, rtn.count = list(histogram.counts), histogram.sum, histogram.count
+            return rtn
+
+    def endpoint(self, req_url, url):
+        """Returns the `endpoint` label of a URL, see :func:`endpoint_name`"""
+        name = self._endpoints.get(url)
+        if name is None:
+            name = endpoint_name(req_url, url)
+            # URLs with query strings could make this grow without bounds
+            if len(self._endpoints) < 1000:
+                self._endpoints[url] = name
+        return name
+
+    def observeRequest(self, endpoint, method, seconds, status, bytes_out=0, bytes_in=0):
+        """Records a request. Used by :func:`Client._request`"""
+        self.count('fbchat_requests_total', endpoint=endpoint, method=method, status=str(status))
+        self.observe('fbchat_request_duration_seconds', seconds, endpoint=endpoint)
+        if bytes_out:
+            self.count('fbchat_request_bytes_total', bytes_out, endpoint=endpoint)
+        if bytes_in:
+            self.count('fbchat_response_bytes_total', bytes_in, endpoint=endpoint)
+
+    def snapshot(self, reset=False):
+        """
+        Returns the current values of the metrics::
+
+            {
+                'counters': {name: [{'labels': {...}, 'value': 1}, ...]},
+                'histograms': {name: [{'labels': {...}, 'buckets': [[upper bound, cumulative count], ...], 'sum': 0.1, 'count': 1}, ...]},
+            }
+
+        :param reset: Whether to remove the metrics after reading them, so the next snapshot only has what was recorded since.
+            Nothing recorded in between is lost
+        :rtype: dict
+        """
+        counters, histograms = {}, {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in self._histograms.items():
+                cumulative, buckets = 0, []
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    buckets.append([bound, cumulative])
+                histograms.setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'buckets': buckets,
+                    'sum': histogram.sum,
+                    'count': histogram.count,
+                })
+            if reset:
+                self._counters.clear()
+                self._histograms.clear()
+        return {'counters': counters, 'histograms': histograms}
+
+    def merge(self, snapshot, **labels):
+        """
+        Adds the values of a snapshot to these metrics, e.g. to collect the metrics of other processes.
+        Histograms of the same name and labels must have the same buckets
+
+        :param snapshot: See :func:`Metrics.snapshot`
+        :param labels: Labels added to every merged metric
+        :raises: FBchatUserError if the buckets of a histogram don't match
+        """
+        with self._lock:
+            for name, samples in snapshot['counters'].items():
+                for sample in samples:
+                    key = self._key(name, dict(sample['labels'], **labels))
+                    self._counters[key] = self._counters.get(key, 0) + sample['value']
+            for name, samples in snapshot['histograms'].items():
+                for sample in samples:
+                    key = self._key(name, dict(sample['labels'], **labels))
+                    buckets = tuple(bound for bound, count in sample['buckets'][:-1])
+                    histogram = self._histograms.get(key)
+                    if histogram is None:
+                        histogram = self._histograms[key] = Histogram(buckets)
+                    elif histogram.buckets != buckets:
+                        raise FBchatUserError('The buckets of {} differ: {} and {}'.format(name, histogram.buckets, buckets))
+                    previous = 0
+                    for i, (bound, cumulative) in enumerate(sample['buckets']):
+                        histogram.counts[i] += cumulative - previous
+                        previous = cumulative
+                    histogram.sum += sample['sum']
+                    histogram.count += sample['count']
+
+    def reset(self):
+        """Removes every metric"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def export(self, *exporters):
+        """Passes a :func:`Metrics.snapshot` to each exporter"""
+        snapshot = self.snapshot()
+        for exporter in exporters:
+            exporter.export(snapshot)
+
+    def startExporting(self, exporters, interval=15):
+        """
+        Exports the metrics every `interval` seconds in a background thread. See :func:`Metrics.export`
+
+        :param exporters: :class:`Exporter` objects
+        """
+        if self._exporting is not None:
+            raise FBchatUserError('The metrics are already being exported')
+        self._stop_exporting.clear()
+
+        def run():
+            while not self._stop_exporting.wait(interval):
+                try:
+                    self.export(*exporters)
+                except Exception:
+                    log.exception('Failed exporting metrics')
+
+        self._exporting = threading.Thread(target=run, name='fbchat-metrics')
+        self._exporting.daemon = True
+        self._exporting.start()
+
+    def stopExporting(self):
+        """Stops the background exporting started by :func:`Metrics.startExporting`"""
+        if self._exporting is not None:
+            self._stop_exporting.set()
+            self._exporting.join()
+            self._exporting = None
+
+    def afterFork(self):
+        """
+        Replaces the lock in a forked process, and removes the metrics recorded by the parent, so they aren't counted twice. See :func:`Client.afterFork`
+
+        The exporting is not restarted, since the processes would overwrite each other's exports. Start it again with exporters of this process
+        """
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._exporting = None
+        self._stop_exporting = threading.Event()
+
+
+class Exporter(object):
+    """Base class of the exporters. Subclasses implement :func:`Exporter.export`"""
+    def export(self, snapshot):
+        """
+        :param snapshot: See :func:`Metrics.snapshot`
+        :type snapshot: dict
+        """
+        raise NotImplementedError
+
+
+class SnapshotExporter(Exporter):
+    """
+    Keeps the latest snapshot in memory, e.g. for a status page
+
+    :param callback: If set, called with every snapshot
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        #: The latest snapshot, see :func:`Metrics.snapshot`
+        self.snapshot = None
+
+    def export(self, snapshot):
+        self.snapshot = snapshot
+        if self.callback is not None:
+            self.callback(snapshot)
+
+
+def _escape(value):
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(labels[k])) for k in sorted(labels)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class PrometheusExporter(Exporter):
+    """
+    Formats metrics in the `Prometheus text format <https://prometheus.io/docs/instrumenting/exposition_formats/>`_
+
+    :param path: If set, the metrics are written to this file on every export (replacing it atomically),
+        e.g. for the `textfile` collector of the node exporter
+    """
+    def __init__(self, path=None):
+        self.path = path
+        #: The latest formatted metrics
+        self.text = ''
+
+    @staticmethod
+    def render(snapshot):
+        """
+        :param snapshot: See :func:`Metrics.snapshot`
+        :return: The metrics, in the Prometheus text format
+        """
+        lines = []
+        for name in sorted(snapshot['counters']):
+            lines.append('# TYPE {} counter'.format(name))
+            for sample in snapshot['counters'][name]:
+                lines.append('{}{} {}'.format(name, _labels(sample['labels']), _number(sample['value'])))
+        for name in sorted(snapshot['histograms']):
+            lines.append('# TYPE {} histogram'.format(name))
+            for sample in snapshot['histograms'][name]:
+                for bound, count in sample['buckets']:
+                    lines.append('{}_bucket{} {}'.format(name, _labels(sample['labels'], le=_number(bound)), count))
+                lines.append('{}_sum{} {}'.format(name, _labels(sample['labels']), _number(sample['sum'])))
+                lines.append('{}_count{} {}'.format(name, _labels(sample['labels']), sample['count']))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, snapshot):
+        self.text = self.render(snapshot)
+        if self.path is not None:
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                f.write(self.text)
+            replace_file(temporary, self.path)
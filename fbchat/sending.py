@@ -0,0 +1,421 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import threading
+from collections import deque
+from concurrent.futures import Future
+import requests
+from requests import RequestException
+from .utils import *
+from .models import *
+
+#: Errors that are retried by default, see :func:`SendQueue.submit`
+RETRY = (FBchatException, RequestException)
+#: Errors that messages are retried on: Only failed connections, since after other errors Facebook may have received the message.
+#: The same send data (with the same offline threading ID) is sent again, so Facebook can recognize a message it got twice
+SEND_RETRY = (requests.ConnectionError,)
+
+
+class SendQueue(object):
+    """
+    Sends messages in the background, concurrently across threads, while keeping the order of the messages sent to each thread.
+    Failed sends are retried with exponential backoff. Messages are only retried if connecting to Facebook failed,
+    since they could otherwise be sent twice, see :any:`SEND_RETRY`
+
+    Every send method returns a `Future <https://docs.python.org/3/library/concurrent.futures.html#future-objects>`_,
+    which resolves to the :ref:`Message ID <intro_message_ids>` of the sent message::
+
+        with SendQueue(client) as queue:
+            futures = [queue.sendMessage('Hi!', thread_id=thread_id, thread_type=ThreadType.USER) for thread_id in thread_ids]
+        message_ids = [future.result() for future in futures]
+
+    :param client: A logged in :class:`Client`
+    :param workers: Amount of messages to send concurrently
+    :param rate: Max. amount of requests per second
+    :param max_retries: Amount of times to retry a failed send
+    :param backoff: Seconds to wait before the first retry. Doubled on every retry
+    """
+    def __init__(self, client, workers=4, rate=5, max_retries=3, backoff=1):
+        self.client = client
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._limiter = RateLimiter(rate, burst=workers)
+        self._condition = threading.Condition()
+        # Jobs labeled by thread ID. A thread is only handled by one worker at a time
+        self._queues = {}
+        # Threads with jobs, that no worker is handling
+        self._ready = deque()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, name='fbchat-send-{}'.format(i)) for i in range(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def _send(self, function, args, kwargs, retry):
+        for attempt in range(self.max_retries + 1):
+            self._limiter.wait()
+            try:
+                return function(*args, **kwargs)
+            except FBchatUserError:
+                raise
+            except retry as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * 2**attempt
+                log.warning('Failed sending ({}), retrying in {}s'.format(e, delay))
+                sleep(delay)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while len(self._ready) == 0 and not self._closed:
+                    self._condition.wait()
+                if len(self._ready) == 0:
+                    return
+                thread_id = self._ready.popleft()
+                future, function, args, kwargs, retry = self._queues[thread_id].popleft()
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self._send(function, args, kwargs, retry))
+                except Exception as e:
+                    future.set_exception(e)
+
+            with self._condition:
+                if len(self._queues[thread_id]) > 0:
+                    self._ready.append(thread_id)
+                    self._condition.notify()
+                else:
+                    del self._queues[thread_id]
+
+    def submit(self, thread_id, function, args=(), kwargs={}, retry=RETRY):
+        """
+        Queues `function(*args, **kwargs)`. Functions submitted with the same `thread_id` are called in order
+
+        :param thread_id: The thread the function sends to
+        :param function: The function to call, e.g. :func:`Client.changeThreadTitle`
+        :param args: Positional arguments for the function
+        :param kwargs: Keyword arguments for the function
+        :param retry: The exceptions the function is retried on. Use :any:`SEND_RETRY` for functions that aren't safe to call twice
+        :type args: tuple
+        :type kwargs: dict
+        :type retry: tuple
+        :return: A future, resolving to the return value of the function
+        :raises: FBchatUserError if the queue is closed
+        """
+        future = Future()
+        # Continue the trace of the caller (e.g. an `onMessage` hook) in the worker thread
+        function = self.client._traced(function)
+        with self._condition:
+            if self._closed:
+                raise FBchatUserError('Cannot send: The queue is closed')
+            if thread_id not in self._queues:
+                self._queues[thread_id] = deque()
+                self._ready.append(thread_id)
+                self._condition.notify()
+            self._queues[thread_id].append((future, function, args, kwargs, retry))
+        return future
+
+    def _submitSend(self, thread_id, data):
+        # The send data is built once, so retries send the same IDs
+        return self.submit(thread_id, self.client._doSendRequest, (data,), retry=SEND_RETRY)
+
+    def sendMessage(self, message, thread_id=None, thread_type=ThreadType.USER):
+        """Queues a message. See :func:`Client.sendMessage`"""
+        thread_id, thread_type = self.client._getThread(thread_id, thread_type)
+        return self._submitSend(thread_id, self.client._getMessageData(message, thread_id, thread_type))
+
+    def sendEmoji(self, emoji=None, size=EmojiSize.SMALL, thread_id=None, thread_type=ThreadType.USER):
+        """Queues an emoji. See :func:`Client.sendEmoji`"""
+        thread_id, thread_type = self.client._getThread(thread_id, thread_type)
+        return self._submitSend(thread_id, self.client._getEmojiData(emoji, size, thread_id, thread_type))
+
+    def sendImage(self, image_id, message=None, thread_id=None, thread_type=ThreadType.USER):
+        """Queues an already uploaded image. See :func:`Client.sendImage`"""
+        thread_id, thread_type = self.client._getThread(thread_id, thread_type)
+        return self._submitSend(thread_id, self.client._getImageData(image_id, message, thread_id, thread_type))
+
+    def close(self, wait=True):
+        """
+        Stops accepting messages. The queued messages are still sent
+
+        :param wait: Whether to wait for the queued messages to be sent
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReceiptBatcher(object):
+    """
+    Coalesces delivered, read and seen receipts, and sends them every `interval` seconds in a background thread:
+    One delivered receipt per thread, with all its messages, one read receipt per thread, with the latest watermark,
+    and one seen receipt. Failed receipts are logged, and not retried
+
+    Set it as :any:`Client.receipt_batcher`, and :func:`Client.markAsDelivered`, :func:`Client.markAsRead`
+    and :func:`Client.markAsSeen` will queue receipts instead of sending them.
+    Queued receipts are flushed when the client stops listening, and when the batcher is closed
+
+    :param client: A logged in :class:`Client`
+    :param interval: Seconds to collect receipts for, before sending them
+    """
+    def __init__(self, client, interval=1):
+        self.client = client
+        self.interval = interval
+        self._lock = threading.Lock()
+        # Message IDs, labeled by thread ID
+        self._delivered = {}
+        # Watermarks, labeled by thread ID
+        self._read = {}
+        self._seen = False
+        self._timer = None
+        self._closed = False
+
+    def __len__(self):
+        """The amount of requests needed to send the queued receipts"""
+        with self._lock:
+            return len(self._delivered) + len(self._read) + int(self._seen)
+
+    def _schedule(self):
+        """Flushes after `interval` seconds, unless a flush is already scheduled. Must be called with the lock held"""
+        if self._closed:
+            raise FBchatUserError('Cannot queue receipts: The batcher is closed')
+        if self._timer is None:
+            self._timer = threading.Timer(self.interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def markAsDelivered(self, thread_id, message_id):
+        """Queues a delivered receipt. See :func:`Client.markAsDelivered`"""
+        with self._lock:
+            self._delivered.setdefault(thread_id, [])
+            if message_id not in self._delivered[thread_id]:
+                self._delivered[thread_id].append(message_id)
+            self._schedule()
+
+    def markAsRead(self, thread_id, watermark=None):
+        """Queues a read receipt. See :func:`Client.markAsRead`"""
+        watermark = watermark or now()
+        with self._lock:
+            self._read[thread_id] = max(watermark, self._read.get(thread_id, 0))
+            self._schedule()
+
+    def markAsSeen(self):
+        """Queues a seen receipt. See :func:`Client.markAsSeen`"""
+        with self._lock:
+            self._seen = True
+            self._schedule()
+
+    def flush(self):
+        """
+        Sends the queued receipts
+
+        :return: The amount of requests that failed
+        :rtype: int
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            delivered, self._delivered = self._delivered, {}
+            read, self._read = self._read, {}
+            seen, self._seen = self._seen, False
+
+        pending = [(self.client._sendDeliveredReceipts, (thread_id, message_ids)) for thread_id, message_ids in delivered.items()]
+        pending += [(self.client._sendReadReceipt, (thread_id, watermark)) for thread_id, watermark in read.items()]
+        if seen:
+            pending.append((self.client._sendSeenReceipt, ()))
+
+        failed = 0
+        for function, args in pending:
+            try:
+                if not function(*args):
+                    failed += 1
+            except Exception:
+                log.exception('Failed sending receipt')
+                failed += 1
+        return failed
+
+    def afterFork(self):
+        """Replaces the lock and the timer in a forked process, and drops the receipts queued by the parent, which sends them. See :func:`Client.afterFork`"""
+        self._lock = threading.Lock()
+        self._delivered = {}
+        self._read = {}
+        self._seen = False
+        self._timer = None
+
+    def close(self):
+        """Sends the queued receipts, and stops accepting new ones"""
+        with self._lock:
+            self._closed = True
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _Typing(object):
+    """The typing state of a thread"""
+    def __init__(self, thread_type):
+        self.thread_type = thread_type
+        # Amount of open `with` blocks
+        self.holds = 0
+        self.deadline = None
+
+
+class TypingManager(object):
+    """
+    Shows typing indicators without sending a request for every reply. Per thread, `TYPING` is only sent if the indicator isn't already shown,
+    and `STOPPED` is sent in a background thread once the thread has been idle for a while.
+    The requests are sent in the background, so the caller never waits for them::
+
+        with TypingManager(client) as typing:
+            for text in replies:
+                with typing(thread_id, ThreadType.USER):
+                    client.sendMessage(text, thread_id=thread_id, thread_type=ThreadType.USER)
+
+    :param client: A logged in :class:`Client`
+    :param idle: Seconds after the last call to :func:`TypingManager.typing` to send `STOPPED`, if it's not used in a `with` block
+    :param linger: Seconds after a `with` block ends to send `STOPPED`, unless the thread is typing again by then
+    """
+    def __init__(self, client, idle=5, linger=1):
+        self.client = client
+        self.idle = idle
+        self.linger = linger
+        self._condition = threading.Condition()
+        # Threads with the indicator shown, labeled by thread ID
+        self._threads = {}
+        # `(thread ID, thread type, status)` tuples to send
+        self._outgoing = deque()
+        self._closed = False
+        self._start()
+
+    def _start(self):
+        self._worker = threading.Thread(target=self._work, name='fbchat-typing')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _expired(self, current):
+        """Removes the threads that have been idle long enough, and queues their `STOPPED`. Must be called with the lock held"""
+        for thread_id, state in list(self._threads.items()):
+            if state.holds == 0 and state.deadline is not None and state.deadline <= current:
+                del self._threads[thread_id]
+                self._outgoing.append((thread_id, state.thread_type, TypingStatus.STOPPED))
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while True:
+                    self._expired(time())
+                    if len(self._outgoing) > 0 or (self._closed and len(self._threads) == 0):
+                        break
+                    deadlines = [state.deadline for state in self._threads.values() if state.holds == 0 and state.deadline is not None]
+                    self._condition.wait(max(0, min(deadlines) - time()) if deadlines else None)
+                if len(self._outgoing) == 0:
+                    return
+                thread_id, thread_type, status = self._outgoing.popleft()
+            try:
+                self.client.setTypingStatus(status, thread_id=thread_id, thread_type=thread_type)
+            except Exception:
+                log.exception('Failed setting typing status')
+
+    def typing(self, thread_id, thread_type=ThreadType.USER):
+        """
+        Shows the typing indicator in a thread, if it's not already shown.
+        `STOPPED` is sent after `idle` seconds, unless this is called again
+
+        Can be used as a `with` block, to keep the indicator shown until the block ends, and then `linger` more seconds
+
+        :param thread_id: User/Group ID to show the indicator in. See :ref:`intro_threads`
+        :param thread_type: See :ref:`intro_threads`
+        :type thread_type: models.ThreadType
+        :raises: FBchatUserError if the manager is closed
+        """
+        with self._condition:
+            if self._closed:
+                raise FBchatUserError('Cannot set typing status: The manager is closed')
+            state = self._threads.get(thread_id)
+            if state is None:
+                state = self._threads[thread_id] = _Typing(thread_type)
+                self._outgoing.append((thread_id, thread_type, TypingStatus.TYPING))
+            state.deadline = time() + self.idle
+            self._condition.notify()
+        return _TypingBlock(self, thread_id)
+
+    __call__ = typing
+
+    def _hold(self, thread_id, amount):
+        with self._condition:
+            state = self._threads.get(thread_id)
+            if state is None:
+                return
+            state.holds = max(0, state.holds + amount)
+            if state.holds == 0:
+                state.deadline = time() + self.linger
+            self._condition.notify()
+
+    def stop(self, thread_id):
+        """Hides the typing indicator in a thread right away, if it's shown"""
+        with self._condition:
+            state = self._threads.pop(thread_id, None)
+            if state is not None:
+                self._outgoing.append((thread_id, state.thread_type, TypingStatus.STOPPED))
+                self._condition.notify()
+
+    def close(self, wait=True):
+        """
+        Hides every typing indicator, and stops the background thread
+
+        :param wait: Whether to wait for the remaining requests to be sent
+        """
+        with self._condition:
+            self._closed = True
+            for state in self._threads.values():
+                state.holds = 0
+                state.deadline = 0
+            self._condition.notify()
+        if wait:
+            self._worker.join()
+
+    def afterFork(self):
+        """
+        Replaces the condition and the background thread in a forked process, and forgets the indicators shown by the parent.
+        Not called by :func:`Client.afterFork`, so call it in the child process, before the manager is used. See :func:`Client.afterFork`
+        """
+        self._condition = threading.Condition()
+        self._threads = {}
+        self._outgoing = deque()
+        if not self._closed:
+            self._start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _TypingBlock(object):
+    """Keeps the typing indicator of a thread shown, while used as a `with` block"""
+    def __init__(self, manager, thread_id):
+        self.manager = manager
+        self.thread_id = thread_id
+
+    def __enter__(self):
+        self.manager._hold(self.thread_id, 1)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.manager._hold(self.thread_id, -1)
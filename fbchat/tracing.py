@@ -0,0 +1,279 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import os
+import json
+import threading
+from random import getrandbits
+from functools import wraps
+from .utils import *
+from .models import *
+
+
+def _new_id():
+    return '{:016x}'.format(getrandbits(64))
+
+
+class Span(object):
+    """
+    A timed operation, e.g. a request or a call to a hook. Used as a context manager, see :func:`Tracer.span`
+
+    Spans started while another span is active in the same thread become its children,
+    so e.g. a :func:`Client.sendMessage` called from :func:`Client.onMessage` is traced as part of the pull that received the message
+    """
+    def __init__(self, tracer, name, parent=None, attributes=None):
+        self.tracer = tracer
+        #: The name of the operation, e.g. `POST SEND` or `onMessage`
+        self.name = name
+        #: ID shared by a span and all its descendants
+        self.trace_id = parent.trace_id if parent is not None else _new_id()
+        self.span_id = _new_id()
+        self.parent_id = parent.span_id if parent is not None else None
+        #: Extra information about the operation, e.g. the HTTP status of a request
+        self.attributes = attributes or {}
+        #: Start and end of the span, as a Unix timestamp
+        self.start = None
+        self.end = None
+        #: The thread the span ran in
+        self.thread_id = None
+
+    @property
+    def duration(self):
+        """The duration of the span in seconds, or `None` if it hasn't ended"""
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def set(self, key, value):
+        """Sets an attribute of the span"""
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.thread_id = threading.current_thread().ident
+        self.tracer._push(self)
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.tracer._pop(self)
+        self.tracer._finish(self)
+
+
+class _NoopSpan(object):
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+#: A span that does nothing, used when tracing is disabled
+NOOP_SPAN = _NoopSpan()
+
+
+class _Activated(object):
+    def __init__(self, tracer, span):
+        self.tracer = tracer
+        self.span = span
+
+    def __enter__(self):
+        self.tracer._push(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._pop(self.span)
+
+
+class Tracer(object):
+    """
+    Records spans, and passes them to the exporters when they end.
+    Set it as :any:`Client.tracer` to trace the following operations:
+
+    - Every request to Facebook, named by the method and the :class:`utils.ReqUrl` attribute, e.g. `POST SEND`
+    - `check_request` and `graphql_response_to_json`: Decoding the responses
+    - `doOneListen`: A cycle of the listening loop, with the `_parseMessage` of the messages it received
+    - Every call to an `on*` hook, named after the hook
+
+    :param exporters: :class:`SpanExporter` objects
+    """
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _push(self, span):
+        self._stack().append(span)
+
+    def _pop(self, span):
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        elif span in stack:
+            stack.remove(span)
+
+    def _finish(self, span):
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                log.exception('Failed exporting span {}'.format(span.name))
+
+    def current(self):
+        """Returns the active span of the current thread, or `None`"""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def span(self, name, parent=None, **attributes):
+        """
+        Returns a new span, to be used as a context manager::
+
+            with tracer.span('reply', thread_id=thread_id) as span:
+                ...
+
+        :param name: The name of the span
+        :param parent: The parent span. Defaults to the active span of the current thread
+        :param attributes: Attributes of the span
+        :rtype: Span
+        """
+        if parent is None:
+            parent = self.current()
+        return Span(self, name, parent=parent, attributes=attributes)
+
+    def activate(self, span):
+        """
+        Returns a context manager, that makes `span` the active span of the current thread, without ending it.
+        Used to continue a trace in another thread
+        """
+        return _Activated(self, span)
+
+    def wrap(self, function):
+        """
+        Returns a function that calls `function` with the span that's active now as the active span,
+        so spans it starts in another thread (e.g. in a `ThreadPoolExecutor`) are part of the same trace
+        """
+        parent = self.current()
+        if parent is None:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.activate(parent):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def afterFork(self):
+        """Forgets the spans that were active in the parent process, and calls :func:`SpanExporter.afterFork` of the exporters. See :func:`Client.afterFork`"""
+        self._local = threading.local()
+        for exporter in self.exporters:
+            exporter.afterFork()
+
+    def close(self):
+        """Closes the exporters"""
+        for exporter in self.exporters:
+            exporter.close()
+
+
+class SpanExporter(object):
+    """Base class of the span exporters. Subclasses implement :func:`SpanExporter.export`"""
+    def export(self, span):
+        """
+        Called with every span that ended
+
+        :type span: Span
+        """
+        raise NotImplementedError
+
+    def afterFork(self):
+        """Called by :func:`Tracer.afterFork` in a forked process"""
+        pass
+
+    def close(self):
+        pass
+
+
+class MemorySpanExporter(SpanExporter):
+    """Keeps the ended spans in memory, e.g. for tests"""
+    def __init__(self):
+        #: The ended spans, in the order they ended
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def afterFork(self):
+        """Replaces the lock, and forgets the spans of the parent process"""
+        self._lock = threading.Lock()
+        self.spans = []
+
+
+class TraceFileExporter(SpanExporter):
+    """
+    Writes the spans to a file in the `Trace Event Format <https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU>`_,
+    which can be opened as a flame chart in `Perfetto <https://ui.perfetto.dev>`_, `speedscope <https://www.speedscope.app>`_ or `chrome://tracing`
+
+    Spans are appended as they end, so the file can be read while it's written, and doesn't get lost if the process crashes.
+    In a forked process, spans are written to a file of their own, see :func:`TraceFileExporter.afterFork`
+
+    :param path: The file to write to. It's replaced if it exists
+    """
+    def __init__(self, path):
+        #: The file the spans are written to
+        self.path = path
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self._pid = os.getpid()
+        self._file = open(self.path, 'w')
+        # The closing bracket is optional in this format
+        self._file.write('[\n')
+        self._file.flush()
+
+    def export(self, span):
+        event = {
+            'name': span.name,
+            'cat': 'fbchat',
+            'ph': 'X',
+            'ts': int(span.start * 1000000),
+            'dur': int(span.duration * 1000000),
+            'pid': self._pid,
+            'tid': span.thread_id,
+            'args': dict(span.attributes, trace_id=span.trace_id, span_id=span.span_id, parent_id=span.parent_id),
+        }
+        line = json.dumps(event, default=str) + ',\n'
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+                self._file.flush()
+
+    def afterFork(self):
+        """
+        Writes the spans of this process to a new file, named after the original and the process ID (e.g. `trace.1234.json`),
+        so the processes don't write over each other. :any:`TraceFileExporter.path` is set to the new file
+        """
+        self._lock = threading.Lock()
+        if self._file is None:
+            return
+        # Only closes this process's copy of the file. Nothing is left to write, since every span is flushed
+        self._file.close()
+        root, extension = os.path.splitext(self.path)
+        self.path = '{}.{}{}'.format(root, os.getpid(), extension)
+        self._open()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,294 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import os
+import hashlib
+import threading
+from io import BytesIO
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from .utils import *
+from .models import *
+
+# Imported by `_import_pillow`, since Pillow is slow to import and only needed by `ImageResizer`
+Image = ImageOps = None
+
+#: Amount of bytes read from a file at a time
+CHUNK_SIZE = 64 * 1024
+#: The max. size of a file downloaded by :func:`Client.sendRemoteImage`, in bytes. Facebook doesn't accept attachments larger than 25 MB
+MAX_UPLOAD_SIZE = 25 * 1024 * 1024
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return '{}'.format(value).encode(facebookEncoding)
+
+
+def _remaining(f):
+    """Returns the amount of bytes left in the file object `f`, or `None` if it can't be determined"""
+    if isinstance(f, ResponseReader):
+        return f.len
+    try:
+        return os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    try:
+        position = f.tell()
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        f.seek(position)
+        return end - position
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+def _import_pillow():
+    global Image, ImageOps
+    if Image is None:
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            raise FBchatUserError('Resizing images requires Pillow: pip install Pillow')
+
+
+def hash_file(f, chunk_size=CHUNK_SIZE):
+    """Returns the SHA-256 hex digest of the rest of the file object `f`, and moves it back to its current position"""
+    position = f.tell()
+    digest = hashlib.sha256()
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    f.seek(position)
+    return digest.hexdigest()
+
+
+class ResponseReader(object):
+    """
+    A file object, that reads the body of a streamed `requests` response as it's downloaded.
+    Used to pipe a download straight into an upload with :class:`MultipartEncoder`
+
+    :param response: A response, requested with `stream=True`
+    :param max_size: Max. amount of bytes to read. `None` means no limit
+    :raises: FBchatUserError if the response is larger than `max_size`
+    """
+    def __init__(self, response, max_size=None):
+        self.response = response
+        self.max_size = max_size
+        #: SHA-256 hash of the bytes read so far
+        self.digest = hashlib.sha256()
+        #: Amount of bytes read so far
+        self.position = 0
+        #: The size of the body, or `None` if the server didn't send it
+        self.len = None
+        # With a `Content-Encoding`, the `Content-Length` is the size of the encoded body
+        length = response.headers.get('Content-Length')
+        if length is not None and length.isdigit() and not response.headers.get('Content-Encoding'):
+            self.len = int(length)
+        if self.len is not None and max_size is not None and self.len > max_size:
+            raise FBchatUserError('{} is too large: {} bytes, max. {}'.format(response.url, self.len, max_size))
+
+    def read(self, size=CHUNK_SIZE):
+        chunk = self.response.raw.read(size, decode_content=True)
+        self.position += len(chunk)
+        self.digest.update(chunk)
+        if self.max_size is not None and self.position > self.max_size:
+            raise FBchatUserError('{} is too large: More than {} bytes'.format(self.response.url, self.max_size))
+        if not chunk and self.len is not None and self.position < self.len:
+            raise FBchatException('Download of {} ended after {} of {} bytes'.format(self.response.url, self.position, self.len))
+        return chunk
+
+
+class MultipartEncoder(object):
+    """
+    A `multipart/form-data` request body, that is read from the files in chunks while it's being sent,
+    instead of being built in memory. Pass it as the `data` of a `requests` request, with :any:`MultipartEncoder.content_type` as the `Content-Type`
+
+    If the size of every file is known, `requests` sends it with a `Content-Length`, otherwise with chunked transfer encoding.
+    The body can be sent multiple times (e.g. when a request is retried), if the files are seekable
+
+    :param fields: The form fields, as `(name, value)` pairs. Fields with a value of `None` are left out
+    :param files: The files, as `(name, filename, file object, mimetype)` tuples. The files are read from their current position
+    :param callback: Called with the amount of bytes sent so far, and the total amount of bytes (or `None` if unknown), after every chunk
+    :param chunk_size: Amount of bytes to read from a file at a time
+    """
+    def __init__(self, fields, files, callback=None, chunk_size=CHUNK_SIZE):
+        self.boundary = uuid4().hex
+        #: The `Content-Type` header of the body
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        self.callback = callback
+        self.chunk_size = chunk_size
+        # `(header, content, length)` tuples, where content is `bytes` or a file object
+        self._parts = []
+
+        for name, value in fields:
+            if value is None:
+                continue
+            header = '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n'.format(self.boundary, name)
+            value = _to_bytes(value)
+            self._parts.append((_to_bytes(header), value, len(value)))
+
+        for name, filename, f, mimetype in files:
+            filename = os.path.basename(filename or name).replace('"', '%22')
+            header = '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: {}\r\n\r\n'.format(
+                self.boundary, name, filename, mimetype or 'application/octet-stream'
+            )
+            self._parts.append((_to_bytes(header), f, _remaining(f)))
+        self._end = _to_bytes('--{}--\r\n'.format(self.boundary))
+
+        # Only set if known, since `requests` uses it as the `Content-Length`
+        if all(length is not None for header, content, length in self._parts):
+            self.len = sum(len(header) + length + 2 for header, content, length in self._parts) + len(self._end)
+        self._starts = {}
+        for header, content, length in self._parts:
+            try:
+                if not isinstance(content, bytes):
+                    self._starts[id(content)] = content.tell()
+            except (AttributeError, IOError, OSError, ValueError):
+                pass
+
+    @property
+    def rewindable(self):
+        """Whether the body can be sent again, which requires every file to be seekable"""
+        return all(isinstance(content, bytes) or id(content) in self._starts for header, content, length in self._parts)
+
+    def rewind(self):
+        """Moves the files back to the positions they were read from"""
+        for header, content, length in self._parts:
+            if id(content) in self._starts:
+                content.seek(self._starts[id(content)])
+
+    def _chunks(self):
+        self.rewind()
+        for header, content, length in self._parts:
+            yield header
+            if isinstance(content, bytes):
+                yield content
+            else:
+                while True:
+                    chunk = content.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            yield b'\r\n'
+        yield self._end
+
+    def __iter__(self):
+        total = getattr(self, 'len', None)
+        sent = 0
+        for chunk in self._chunks():
+            yield chunk
+            sent += len(chunk)
+            if self.callback is not None:
+                self.callback(sent, total)
+
+
+class ImageResizer(object):
+    """
+    Downscales and recompresses JPEG, PNG and WebP images before they're uploaded, to save bandwidth. Requires `Pillow <https://pillow.readthedocs.io>`_
+
+    Set it as :any:`Client.image_resizer` to use it with :func:`Client.sendLocalFile`, :func:`Client.sendLocalFiles` and :func:`Client.sendLocalImage`.
+    Images are only replaced if that makes them smaller. Animated images and other files are left alone
+
+    :param max_dimension: Images wider or higher than this (in pixels) are downscaled to fit
+    :param quality: JPEG and WebP quality to recompress with, from 1 to 95
+    :param min_size: Images smaller than this (in bytes) are left alone
+    :param workers: Amount of images to resize concurrently. Pillow releases the GIL while resizing and encoding
+    :param callback: Called with the size of an image before and after it was replaced, in bytes, for every replaced image
+    :raises: FBchatUserError if Pillow isn't installed
+    """
+    #: Formats that are recompressed, labeled by their mimetype
+    FORMATS = {'image/jpeg': 'JPEG', 'image/png': 'PNG', 'image/webp': 'WEBP'}
+
+    def __init__(self, max_dimension=2048, quality=85, min_size=100*1024, workers=2, callback=None):
+        _import_pillow()
+        self.callback = callback
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.min_size = min_size
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        #: Amount of images that were replaced
+        self.images = 0
+        #: Size of the replaced images, in bytes
+        self.bytes_before = 0
+        #: Size of the images that replaced them, in bytes
+        self.bytes_after = 0
+
+    @property
+    def bytes_saved(self):
+        """Amount of bytes that didn't have to be uploaded"""
+        return self.bytes_before - self.bytes_after
+
+    def resize(self, f, mimetype):
+        """
+        Downscales and recompresses an image, if that makes it smaller
+
+        :param f: The image, as a file object. Read from its current position
+        :param mimetype: The mimetype of the image
+        :return: A file object with the new image, or `f` if the image was left alone
+        """
+        image_format = self.FORMATS.get(mimetype)
+        size = _remaining(f)
+        if image_format is None or size is None or size < self.min_size:
+            return f
+        position = f.tell()
+        try:
+            # Pillow reads images from the start of the file
+            image = Image.open(f if position == 0 else BytesIO(f.read()))
+            if getattr(image, 'is_animated', False):
+                # Opening the image read its header, so rewind to upload it as is
+                f.seek(position)
+                return f
+            # Apply the EXIF orientation, since it's lost when the image is re-encoded
+            if hasattr(ImageOps, 'exif_transpose'):
+                image = ImageOps.exif_transpose(image)
+            image.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+
+            resized = BytesIO()
+            if image_format == 'JPEG':
+                image.convert('RGB').save(resized, 'JPEG', quality=self.quality, optimize=True, progressive=True)
+            elif image_format == 'WEBP':
+                image.save(resized, 'WEBP', quality=self.quality)
+            else:
+                image.save(resized, 'PNG', optimize=True)
+        # Pillow refuses to open images with too many pixels, which could use up the memory. Old versions only warn about them
+        except (IOError, OSError, ValueError, getattr(Image, 'DecompressionBombError', ValueError)) as e:
+            log.warning('Could not resize image, uploading it as is: {}'.format(e))
+            f.seek(position)
+            return f
+
+        if resized.tell() >= size:
+            f.seek(position)
+            return f
+        with self._lock:
+            self.images += 1
+            self.bytes_before += size
+            self.bytes_after += resized.tell()
+        log.debug('Resized image from {} to {} bytes'.format(size, resized.tell()))
+        if self.callback is not None:
+            self.callback(size, resized.tell())
+        resized.seek(0)
+        return resized
+
+    def resizeMany(self, files):
+        """
+        Resizes images concurrently. See :func:`ImageResizer.resize`
+
+        :param files: `(file object, mimetype)` tuples
+        :return: File objects, in the order of `files`
+        :rtype: list
+        """
+        return list(self._executor.map(lambda args: self.resize(*args), files))
+
+    def afterFork(self):
+        """Replaces the worker threads and the lock in a forked process. See :func:`Client.afterFork`"""
+        self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Stops the worker threads"""
+        self._executor.shutdown()
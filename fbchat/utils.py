@@ -1,9 +1,11 @@
 # -*- coding: UTF-8 -*-
 
 from __future__ import unicode_literals
+import os
 import re
 import json
-from time import time
+import threading
+from time import time, sleep
 from random import random
 import warnings
 import logging
@@ -17,10 +19,20 @@ except NameError:
 
 # Log settings
 log = logging.getLogger("client")
-log.setLevel(logging.DEBUG)
-# Creates the console handler
+#: The console handler. Only added to `log` by :func:`enable_logging`, so importing `fbchat` doesn't configure logging
 handler = logging.StreamHandler()
-log.addHandler(handler)
+
+def enable_logging(level=logging.INFO):
+    """
+    Prints the log messages of `fbchat` to the console. Called by :class:`Client`, unless its `logging_level` is `None`
+
+    :param level: The minimum `logging level <https://docs.python.org/3/library/logging.html#logging-levels>`_ to print
+    """
+    # The handler filters by level, so every message has to get to it
+    log.setLevel(logging.DEBUG)
+    handler.setLevel(level)
+    if handler not in log.handlers:
+        log.addHandler(handler)
 
 #: Default list of user agents
 USER_AGENTS = [
@@ -66,6 +78,7 @@ GENDERS = {
 class ReqUrl(object):
     """A class containing all urls used by `fbchat`"""
     SEARCH = "https://www.facebook.com/ajax/typeahead/search.php"
+    SEARCH_MESSAGES = "https://www.facebook.com/ajax/mercury/search_snippets.php?dpr=1"
     LOGIN = "https://m.facebook.com/login.php?login_attempt=1"
     SEND = "https://www.facebook.com/messaging/send/"
     THREAD_SYNC = "https://www.facebook.com/ajax/mercury/thread_sync.php"
@@ -104,6 +117,49 @@ class ReqUrl(object):
         self.PING = "https://{}-edge-chat.facebook.com/active_ping".format(self.pull_channel)
 
 
+class RateLimiter(object):
+    """
+    A thread-safe token bucket, used to keep concurrent requests within an account's rate limit
+
+    :param rate: Amount of requests allowed per second
+    :param burst: Amount of requests that may be sent at once, before the rate applies
+    """
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise FBchatUserError('`rate` should be greater than 0')
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until a request may be sent"""
+        while True:
+            with self._lock:
+                current = time()
+                self._tokens = min(self.burst, self._tokens + (current - self._last) * self.rate)
+                self._last = current
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            sleep(delay)
+
+
+def replace_file(src, dst):
+    """
+    Moves the file `src` to `dst`, replacing `dst` if it exists. Used to write a file by writing to `src` first, so it's never half-written.
+    Atomic on POSIX. Python 2 has no `os.replace`, and its `os.rename` can't replace a file on Windows, so there `dst` is removed first
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
 facebookEncoding = 'UTF-8'
 
 def now():
@@ -137,20 +193,30 @@ def str_base(number, base):
         return str_base(d, base) + digitToChar(m)
     return digitToChar(m)
 
-def generateMessageID(client_id=None):
-    k = now()
+def generateMessageID(client_id=None, timestamp=None):
+    k = timestamp or now()
     l = int(random() * 4294967295)
     return "<{}:{}-{}@mail.projektitan.com>".format(k, l, client_id)
 
 def getSignatureID():
     return hex(int(random() * 2147483648))
 
-def generateOfflineThreadingID():
-    ret = now()
+def generateOfflineThreadingID(timestamp=None):
+    ret = timestamp or now()
     value = int(random() * 4294967295)
-    string = ("0000000000000000000000" + format(value, 'b'))[-22:]
-    msgs = format(ret, 'b') + string
-    return str(int(msgs, 2))
+    # The timestamp, followed by the last 22 bits of the random value
+    return str((ret << 22) | (value & 0x3fffff))
+
+def mimetype_to_key(mimetype):
+    """Returns the key Facebook uses for the ID of an uploaded file with the given mimetype, e.g. `image_id`"""
+    if not mimetype:
+        return 'file_id'
+    if mimetype == 'image/gif':
+        return 'gif_id'
+    x = mimetype.split('/')
+    if x[0] in ['video', 'image', 'audio']:
+        return '{}_id'.format(x[0])
+    return 'file_id'
 
 def check_json(j):
     if j.get('error') is None:
@@ -0,0 +1,334 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import io
+import os
+import json
+import threading
+import multiprocessing
+from time import time
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+from .utils import *
+from .models import *
+from .metrics import Metrics
+
+
+#: Seconds a crashed worker waits before being restarted the first time. Doubled on every crash in a row, up to `MAX_RESTART_DELAY`
+RESTART_DELAY = 1
+#: The longest a crashed worker waits before being restarted, in seconds
+MAX_RESTART_DELAY = 60
+
+
+class Account(object):
+    """
+    An account run by a :class:`Supervisor`
+
+    :param email: Facebook `email`, `id` or `phone number`
+    :param password: Facebook account password. Only needed if there's no valid session
+    :param session_file: A JSON file with the session cookies (see :func:`Client.getSession`).
+        Used to log in if it exists, and kept up to date by the supervisor
+    :param state: The state of a logged in client, see :func:`Client.getState`. Used instead of logging in
+    """
+    def __init__(self, email, password=None, session_file=None, state=None):
+        self.email = email
+        self.password = password
+        self.session_file = session_file
+        self.state = state
+
+    def loadSession(self):
+        """Returns the cookies in the session file, or `None` if there are none"""
+        if self.session_file is None or not os.path.exists(self.session_file):
+            return None
+        try:
+            with io.open(self.session_file, 'r', encoding=facebookEncoding) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning('Ignoring the invalid session file {}'.format(self.session_file))
+            return None
+
+    def saveSession(self, cookies):
+        """Replaces the cookies in the session file"""
+        if self.session_file is None:
+            return
+        tmp_path = self.session_file + '.tmp'
+        with io.open(tmp_path, 'w', encoding=facebookEncoding) as f:
+            f.write(json.dumps(cookies, ensure_ascii=False))
+        replace_file(tmp_path, self.session_file)
+
+    def client(self, client_class, state=None, **kwargs):
+        """
+        Creates a client of the account, from `state` if set, else from the state or session file of the account
+
+        :param client_class: :class:`Client`, or a subclass of it
+        :param kwargs: Passed to the client, e.g. `logging_level`
+        """
+        state = state or self.state
+        if state is not None:
+            return client_class(self.email, self.password, state=state, **kwargs)
+        return client_class(self.email, self.password, session_cookies=self.loadSession(), **kwargs)
+
+    def __repr__(self):
+        return '<Account {}>'.format(self.email)
+
+
+def _listen(client, crashed):
+    try:
+        client.listen()
+    except Exception:
+        log.exception('{} stopped listening'.format(client.uid))
+        crashed.set()
+
+
+def work(shard, accounts, client_class, client_kwargs, queue, stop, interval):
+    """
+    Runs the listening loops of a shard of accounts, each in a thread. The target of the worker processes of a :class:`Supervisor`
+
+    Every `interval` seconds, the states of the clients and the metrics recorded since the last time are sent to the supervisor.
+    The process exits with the code `1` if a listening loop crashed, so the supervisor restarts it
+
+    :param accounts: `(index, account, state)` tuples, with the checkpointed states of the accounts (or `None`)
+    :param stop: The receiving end of a pipe, the worker stops when something is sent through it.
+        (A `multiprocessing.Event` can't be set anymore after a process died waiting for it)
+    """
+    metrics = Metrics()
+    clients, threads = {}, []
+    crashed = threading.Event()
+    for index, account, state in accounts:
+        try:
+            client = account.client(client_class, state=state, **client_kwargs)
+        except Exception as e:
+            queue.put(('failed', shard, index, '{}'.format(e)))
+            continue
+        client.metrics = metrics
+        clients[index] = client
+        thread = threading.Thread(target=_listen, args=(client, crashed), name='fbchat-listen-{}'.format(client.uid))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    def checkpoint():
+        states = dict((index, client.getState()) for index, client in clients.items())
+        queue.put(('checkpoint', shard, states, metrics.snapshot(reset=True)))
+
+    checkpoint()
+    last = time()
+    while not crashed.is_set() and any(thread.is_alive() for thread in threads):
+        if stop.poll(min(interval, 1)):
+            break
+        if time() - last >= interval:
+            checkpoint()
+            last = time()
+
+    for client in clients.values():
+        client.listening = False
+    # A pull can be held open for a while, so don't wait longer than a checkpoint interval for the loops to notice
+    deadline = time() + interval
+    for thread in threads:
+        thread.join(max(0, deadline - time()))
+    checkpoint()
+    queue.close()
+    queue.join_thread()
+    if crashed.is_set():
+        raise SystemExit(1)
+
+
+class Supervisor(object):
+    """
+    Runs the listening loops of many accounts in a pool of worker processes, sized to the CPU cores by default.
+    The accounts are sharded between the workers, and each worker listens with its accounts in threads, see :func:`work`
+
+    The workers regularly checkpoint the states of their clients (see :func:`Client.getState`) to the supervisor.
+    A worker that crashes (or whose listening loop raises an exception) is restarted with the checkpointed states,
+    so its clients continue from their last `seq` without logging in again. The metrics of the workers are collected in :any:`Supervisor.metrics`
+
+    Use :func:`Supervisor.start` and :func:`Supervisor.stop`, or :func:`Supervisor.run` to run until interrupted::
+
+        accounts = [Account('<email>', '<password>', session_file='session.json'), ...]
+        Supervisor(accounts, client_class=EchoBot).run()
+
+    .. note::
+        The clients are created in the workers, so `client_class` and its hooks run there.
+        `client_class` has to be importable by the workers (not defined in `__main__`) if processes are spawned rather than forked
+
+    :param accounts: :class:`Account` objects
+    :param client_class: :class:`Client`, or a subclass of it
+    :param processes: Amount of worker processes. Defaults to the amount of CPU cores, but no more than the amount of accounts
+    :param checkpoint_interval: Seconds between the checkpoints of the workers
+    :param client_kwargs: Passed to the clients, e.g. `logging_level`
+    :param context: A `multiprocessing` context, e.g. `multiprocessing.get_context('spawn')`. Defaults to the `multiprocessing` module
+    :type accounts: list
+    """
+    def __init__(self, accounts, client_class=None, processes=None, checkpoint_interval=10, client_kwargs=None, context=None):
+        if client_class is None:
+            from .client import Client as client_class
+        self.accounts = list(accounts)
+        self.client_class = client_class
+        self.processes = max(1, min(processes or multiprocessing.cpu_count(), len(self.accounts)))
+        self.checkpoint_interval = checkpoint_interval
+        self.client_kwargs = client_kwargs or {}
+        self._context = context or multiprocessing
+        #: The metrics of the workers, see :class:`metrics.Metrics`. Also counts the restarts, as `fbchat_worker_restarts_total`, labeled by `shard`
+        self.metrics = Metrics()
+        #: The checkpointed states of the accounts, by their index in `accounts`
+        self.states = {}
+        #: The errors of the accounts that couldn't be logged in, by their index in `accounts`
+        self.failed = {}
+        self._queue = None
+        self._workers = []
+        self._stops = []
+        self._crashes = []
+        self._started_at = []
+        self._restart_at = []
+        self._monitor = None
+        self._stopping = threading.Event()
+
+    def shard(self, index):
+        """Returns the `(index, account)` pairs of the accounts in a shard"""
+        return [(i, account) for i, account in enumerate(self.accounts) if i % self.processes == index]
+
+    def _startWorker(self, shard):
+        accounts = [(i, account, self.states.get(i)) for i, account in self.shard(shard) if i not in self.failed]
+        stop, stopper = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=work,
+            args=(shard, accounts, self.client_class, self.client_kwargs, self._queue, stop, self.checkpoint_interval),
+            name='fbchat-worker-{}'.format(shard),
+        )
+        process.daemon = True
+        process.start()
+        stop.close()
+        self._workers[shard] = process
+        self._stops[shard] = stopper
+        self._started_at[shard] = time()
+        self.onWorkerStarted(shard=shard, pid=process.pid)
+
+    def start(self):
+        """Starts the workers, and a thread in this process that restarts them when they crash"""
+        if self._monitor is not None:
+            raise FBchatUserError('The supervisor is already running')
+        self._queue = self._context.Queue()
+        self._stopping.clear()
+        self._workers = [None] * self.processes
+        self._stops = [None] * self.processes
+        self._crashes = [0] * self.processes
+        self._started_at = [None] * self.processes
+        self._restart_at = [None] * self.processes
+        for shard in range(self.processes):
+            self._startWorker(shard)
+        self._monitor = threading.Thread(target=self._supervise, name='fbchat-supervisor')
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    def _receive(self, timeout):
+        try:
+            message = self._queue.get(timeout=timeout)
+        except Empty:
+            return
+        if message[0] == 'checkpoint':
+            shard, states, snapshot = message[1:]
+            for index, state in states.items():
+                previous = self.states.get(index)
+                self.states[index] = state
+                if previous is None or previous['cookies'] != state['cookies']:
+                    self.accounts[index].saveSession(state['cookies'])
+            self.metrics.merge(snapshot)
+        elif message[0] == 'failed':
+            shard, index, error = message[1:]
+            self.failed[index] = error
+            self.onAccountFailed(account=self.accounts[index], error=error)
+
+    def _supervise(self):
+        while True:
+            self._receive(0.5)
+            if self._stopping.is_set() or all(process is None for process in self._workers):
+                break
+            for shard, process in enumerate(self._workers):
+                if self._restart_at[shard] is not None:
+                    if time() >= self._restart_at[shard]:
+                        self._restart_at[shard] = None
+                        self.metrics.count('fbchat_worker_restarts_total', shard=str(shard))
+                        self._startWorker(shard)
+                elif process is not None and not process.is_alive():
+                    process.join()
+                    # Workers exit cleanly when all their accounts stopped listening, or couldn't be logged in
+                    if process.exitcode == 0:
+                        self._workers[shard] = None
+                        continue
+                    # A worker that ran for a while isn't crashing in a loop, so it's restarted quickly again
+                    if time() - self._started_at[shard] > MAX_RESTART_DELAY:
+                        self._crashes[shard] = 0
+                    delay = min(RESTART_DELAY * 2 ** self._crashes[shard], MAX_RESTART_DELAY)
+                    self._crashes[shard] += 1
+                    self._restart_at[shard] = time() + delay
+                    self.onWorkerCrashed(shard=shard, exitcode=process.exitcode, delay=delay)
+
+    def stop(self, timeout=60):
+        """
+        Stops the workers, after their clients stop listening and send a last checkpoint.
+        Workers that haven't stopped after `timeout` seconds are terminated
+        """
+        if self._monitor is None:
+            return
+        self._stopping.set()
+        self._monitor.join()
+        for process, stopper in zip(self._workers, self._stops):
+            if process is not None and process.is_alive():
+                stopper.send(True)
+        deadline = time() + timeout
+        # Keep reading, since workers can't exit before what they've sent is read
+        while any(process is not None and process.is_alive() for process in self._workers) and time() < deadline:
+            self._receive(0.1)
+        for process in self._workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+            if process is not None:
+                process.join()
+        while not self._queue.empty():
+            self._receive(0)
+        self._monitor = None
+
+    def run(self):
+        """Starts the workers, and supervises them until interrupted (e.g. with Ctrl+C)"""
+        self.start()
+        try:
+            while self._monitor.is_alive():
+                self._monitor.join(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    """
+    EVENTS
+    """
+
+    def onWorkerStarted(self, shard=None, pid=None):
+        """
+        Called when a worker is started or restarted
+
+        :param shard: The index of the shard of the worker
+        :param pid: The process ID of the worker
+        """
+        log.info('Started worker {} (pid {})'.format(shard, pid))
+
+    def onWorkerCrashed(self, shard=None, exitcode=None, delay=None):
+        """
+        Called when a worker crashed, before it's restarted
+
+        :param shard: The index of the shard of the worker
+        :param exitcode: The exit code of the worker. Negative if it was killed by a signal
+        :param delay: Seconds until it's restarted
+        """
+        log.warning('Worker {} exited with {}, restarting it in {}s'.format(shard, exitcode, delay))
+
+    def onAccountFailed(self, account=None, error=None):
+        """
+        Called when an account couldn't be logged in. It's skipped when its worker is restarted
+
+        :param account: The :class:`Account`
+        :param error: The error, as a string
+        """
+        log.error('Failed logging in {}: {}'.format(account.email, error))
@@ -20,7 +20,8 @@ requirements = [
     'requests',
     'lxml',
     'beautifulsoup4',
-    "enum34; python_version == '2.7'"
+    "enum34; python_version == '2.7'",
+    "futures; python_version == '2.7'"
 ]
 
 version = None
@@ -77,6 +78,9 @@ setup(
     include_package_data=True,
     packages=['fbchat'],
     install_requires=requirements,
+    extras_require={
+        'images': ['Pillow'],
+    },
     url=source,
     version=version,
     zip_safe=True,
@@ -0,0 +1,813 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import os
+import sys
+import json
+import select
+import logging
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+from io import BytesIO
+from time import sleep, time
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+import requests
+from fbchat import Client
+from fbchat.models import *
+from fbchat.graphql import graphql_to_user
+from fbchat.export import Exporter, SQLiteWriter
+from fbchat.index import MessageIndex, ThreadIndex
+from fbchat.contacts import ContactTable
+from fbchat.cache import LookupCache, UploadCache
+from fbchat.sending import SendQueue, ReceiptBatcher, TypingManager
+from fbchat.upload import ImageResizer
+from fbchat.metrics import Metrics, PrometheusExporter
+from fbchat.utils import RateLimiter
+from fbchat.tracing import Tracer, MemorySpanExporter, TraceFileExporter
+from fbchat import workers
+from fbchat.workers import Supervisor, Account
+from benchmarks import payloads
+from benchmarks.fakefb import FakeFacebook, _json
+
+"""
+
+Tests of `fbchat` that don't need a Facebook account, unlike `tests.py`.
+Run with `python -m pytest test_offline.py` or `python -m unittest test_offline`
+
+"""
+
+
+class FakeTestCase(unittest.TestCase):
+    """Runs a fake Facebook server, with `client` logged in to it"""
+    def setUp(self):
+        self.fake = FakeFacebook().start()
+        self.client = self.fake.client()
+        # Only count the requests sent by the tests
+        self.fake.counts.clear()
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def record(self, name):
+        """Records the `(args, kwargs)` of every call to the client's method `name`, before calling it"""
+        calls = []
+        method = getattr(self.client, name)
+
+        def recorded(*args, **kwargs):
+            calls.append((args, kwargs))
+            return method(*args, **kwargs)
+
+        setattr(self.client, name, recorded)
+        return calls
+
+
+
+class TestImports(unittest.TestCase):
+    def run_python(self, code):
+        """Runs `code` in a new interpreter, so the modules imported by other tests don't count, and returns what it printed"""
+        return subprocess.check_output([sys.executable, '-c', code]).decode('utf-8').split()
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'The client is only imported lazily from Python 3.7')
+    def test_lazyImports(self):
+        modules = self.run_python('import sys, fbchat; print(" ".join(m for m in ("requests", "bs4", "fbchat.client") if m in sys.modules))')
+        self.assertEqual(modules, [])
+
+    def test_names(self):
+        names = self.run_python('import fbchat; print(fbchat.Client.__name__, fbchat.models.Message.__name__, fbchat.__version__)')
+        self.assertEqual(names[:2], ['Client', 'Message'])
+        names = self.run_python('from fbchat import *; print(Client.__name__)')
+        self.assertEqual(names, ['Client'])
+
+    def test_noLogLevel(self):
+        # Importing `fbchat` leaves logging to the application, until a client is created
+        level = self.run_python('import logging, fbchat.utils; print(logging.getLogger("client").level)')
+        self.assertEqual(level, [str(logging.NOTSET)])
+
+
+class FakeHistory(object):
+    """Answers :func:`Client.fetchThreadMessages` from a list of messages, like Facebook does: Newest first, with an inclusive `before`"""
+    def __init__(self, messages):
+        self.messages = sorted(messages, key=lambda m: -int(m.timestamp))
+        self.requests = 0
+
+    def fetchThreadMessages(self, thread_id=None, limit=20, before=None):
+        self.requests += 1
+        return [m for m in self.messages if before is None or int(m.timestamp) <= before][:limit]
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def export(self, messages, page_size):
+        thread = Thread(ThreadType.USER, '1234')
+        with SQLiteWriter(os.path.join(self.directory, 'export.db')) as writer:
+            self.exporter = Exporter(FakeHistory(messages), writer, rate=1000, page_size=page_size)
+            count = self.exporter.exportThread(thread)
+            writer.flush()
+            uids = set(row[0] for row in writer._db.execute('SELECT id FROM messages'))
+            self.watermark = writer.getWatermark(thread.uid)
+        return count, uids
+
+    def test_pages(self):
+        messages = [Message('mid.{}'.format(i), timestamp=str(1000 + i)) for i in range(25)]
+        count, uids = self.export(messages, page_size=10)
+        self.assertEqual(count, 25)
+        self.assertEqual(uids, set(m.uid for m in messages))
+        self.assertEqual(self.watermark, (1024, {'mid.24'}))
+
+    def test_pageWithOneTimestamp(self):
+        # A whole page shares the timestamp the previous page ended with
+        messages = [Message('mid.new{}'.format(i), timestamp=str(2000 + i)) for i in range(5)]
+        messages += [Message('mid.same{}'.format(i), timestamp='1500') for i in range(5)]
+        messages += [Message('mid.old{}'.format(i), timestamp=str(1000 + i)) for i in range(5)]
+        count, uids = self.export(messages, page_size=5)
+        self.assertEqual(uids, set(m.uid for m in messages))
+        self.assertEqual(count, 15)
+        # There might have been more messages with that timestamp, so the next export starts before it
+        self.assertEqual(self.exporter.incomplete, {'1234': [1500]})
+        self.assertEqual(self.watermark, (1499, set()))
+
+    def test_resume(self):
+        messages = [Message('mid.{}'.format(i), timestamp=str(1000 + i)) for i in range(10)]
+        messages.append(Message('mid.last', timestamp='1009'))
+        self.export(messages, page_size=4)
+        self.assertEqual(self.watermark, (1009, {'mid.9', 'mid.last'}))
+        # New messages, one of them in the same millisecond as the watermark
+        messages += [Message('mid.late', timestamp='1009'), Message('mid.next', timestamp='1010')]
+        count, uids = self.export(messages, page_size=4)
+        self.assertEqual(count, 2)
+        self.assertEqual(uids, set(m.uid for m in messages))
+        self.assertEqual(self.watermark, (1010, {'mid.next'}))
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_burst(self):
+        limiter = RateLimiter(50, burst=5)
+        start = time()
+        for i in range(5):
+            limiter.wait()
+        self.assertLess(time() - start, 0.05)
+        for i in range(5):
+            limiter.wait()
+        # The other 5 are sent at the rate, one every 20 ms
+        self.assertGreaterEqual(time() - start, 0.08)
+
+    def test_invalidRate(self):
+        self.assertRaises(FBchatUserError, RateLimiter, 0)
+
+
+class TestMessageIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = MessageIndex()
+        self.index.add('1', Message('mid.1', author='10', timestamp='1000', text='Hello there'))
+        self.index.add('2', Message('mid.2', author='20', timestamp='2000', text='hello again'), Message('mid.3', timestamp='3000', text='bye'))
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_add(self):
+        # Messages that are already indexed, or have no text, are skipped
+        self.index.add('1', Message('mid.1', timestamp='1000', text='Hello there'), Message('mid.4', timestamp='4000'))
+        self.assertEqual(len(self.index), 3)
+
+    def test_search(self):
+        results = self.index.search('HELL')
+        self.assertEqual(sorted(results), ['1', '2'])
+        message = results['1'][0]
+        self.assertEqual((message.uid, message.author, message.timestamp, message.text), ('mid.1', '10', '1000', 'Hello there'))
+        self.assertEqual(list(self.index.search('hello', thread_id='2')), ['2'])
+        # Every word must be present
+        self.assertEqual([(thread_id, [m.uid for m in messages]) for thread_id, messages in self.index.search('hello there').items()], [('1', ['mid.1'])])
+        self.assertEqual(self.index.search('missing'), {})
+        self.assertEqual(self.index.search('!?'), {})
+
+    def test_likeWildcards(self):
+        # Without full-text search, words are matched with `LIKE`, where `_` is a wildcard
+        index = MessageIndex()
+        index.engine = None
+        index.add('1', Message('mid.1', timestamp='1000', text='snake_case'), Message('mid.2', timestamp='2000', text='snakeXcase'))
+        self.assertEqual([m.uid for m in index.search('snake_case')['1']], ['mid.1'])
+        index.close()
+
+    def test_limit(self):
+        self.index.add('1', *[Message('mid.1{}'.format(i), timestamp=str(5000 + i), text='hello {}'.format(i)) for i in range(5)])
+        results = self.index.search('hello', thread_id='1', limit=3)
+        # Newest first
+        self.assertEqual([m.uid for m in results['1']], ['mid.14', 'mid.13', 'mid.12'])
+
+
+class TestThreadIndex(unittest.TestCase):
+    def test_search(self):
+        index = ThreadIndex()
+        index.add(User('1', first_name='Marko', name='Marko Polo'), User('2', name='Mark Zuckerberg'), User('3', name='Mark'))
+        index.add(Group('4', name='Márk ★ friends'))
+        self.assertEqual([t.uid for t in index.search('mark', limit=10)], ['3', '2', '4', '1'])
+        self.assertEqual([t.uid for t in index.search('mark z')], ['2'])
+        self.assertEqual([t.uid for t in index.search('mark', limit=10, thread_type=ThreadType.GROUP)], ['4'])
+        self.assertEqual(index.search('polo marko pig'), [])
+
+    def test_replace(self):
+        index = ThreadIndex()
+        index.add(*[User(str(i), name='User {}'.format(i)) for i in range(1000)])
+        index.add(User('5', name='Renamed'), User('6', name='First'), User('6', name='Second'))
+        self.assertEqual(len(index), 1000)
+        self.assertEqual([t.uid for t in index.search('renamed')], ['5'])
+        self.assertEqual([t.uid for t in index.search('second')], ['6'])
+        self.assertEqual(index.search('first'), [])
+        self.assertEqual(len(index.search('user', limit=2000)), 998)
+
+
+class TestSearch(FakeTestCase):
+    def test_searchFallback(self):
+        client = self.client
+        client.thread_index = ThreadIndex()
+        client.thread_index.add(graphql_to_user(payloads.user_node(1)))
+        remote = [payloads.user_node(i) for i in range(3)]
+
+        def search(query):
+            # Answers user searches with `remote`
+            params = query.value['query_params']
+            return {params['search']: {'users': {'nodes': remote[:params['limit']]}}}
+
+        client.graphql_request = search
+        searches = self.record('graphql_request')
+        # Enough is found locally
+        self.assertEqual([t.uid for t in client.searchForUsers('user')], [payloads.user_id(1)])
+        self.assertEqual(len(searches), 0)
+        # Too little is found locally, so the rest comes from Facebook
+        self.assertEqual([t.uid for t in client.searchForUsers('user', limit=3)], [payloads.user_id(i) for i in (1, 0, 2)])
+        self.assertEqual(len(searches), 1)
+        self.assertEqual(len(client.thread_index), 3)
+
+
+def contact(i, **kwargs):
+    """Returns a user, as in the payload of an `ALL_USERS` request"""
+    return dict({
+        'id': payloads.user_id(i), 'type': 'friend', 'name': 'User {} ★'.format(i), 'firstName': 'User',
+        'uri': 'https://www.facebook.com/{}'.format(i), 'thumbSrc': None, 'gender': 1, 'is_friend': i % 2 == 0,
+    }, **kwargs)
+
+
+class TestContactTable(unittest.TestCase):
+    def test_update(self):
+        table = ContactTable()
+        payload = dict((str(i), contact(i)) for i in range(10))
+        self.assertEqual(table.update(payload), (10, 0, 0))
+        self.assertEqual(table.update(payload), (0, 0, 0))
+        payload['3'] = contact(3, name='Renamed')
+        del payload['4']
+        self.assertEqual(table.update(payload), (0, 1, 1))
+        self.assertEqual(len(table), 9)
+        self.assertEqual(table.get(payloads.user_id(3)).name, 'Renamed')
+        self.assertIsNone(table.get(payloads.user_id(4)))
+        self.assertEqual(table.get(payloads.user_id(5)).name, 'User 5 ★')
+        self.assertEqual(sorted(table.column('uid')), sorted(c['id'] for c in payload.values()))
+
+    def test_saveLoad(self):
+        table = ContactTable()
+        table.update(dict((str(i), contact(i)) for i in range(100)))
+        directory = tempfile.mkdtemp()
+        try:
+            table_path = os.path.join(directory, 'contacts.bin')
+            table.save(table_path)
+            loaded = ContactTable.load(table_path)
+            self.assertEqual(len(loaded), 100)
+            for name in ('uid', 'name', 'first_name', 'url', 'photo', 'gender', 'is_friend'):
+                self.assertEqual(loaded.column(name), table.column(name))
+            # Updating a loaded table copies it out of the file
+            self.assertEqual(loaded.update({'1': contact(1)}), (0, 0, 99))
+            self.assertEqual(loaded.get(payloads.user_id(1)).name, 'User 1 ★')
+            del loaded
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestLookupCache(unittest.TestCase):
+    def test_concurrentLookups(self):
+        cache = LookupCache()
+        started, release = threading.Event(), threading.Event()
+        fetched = []
+
+        def fetch(*keys):
+            fetched.append(keys)
+            started.set()
+            release.wait()
+            return dict((key, key * 2) for key in keys), {}
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(cache.lookup([1, 2], fetch)))
+        first.start()
+        started.wait()
+        second = threading.Thread(target=lambda: results.append(cache.lookup([2, 3], fetch)))
+        second.start()
+        # The second lookup only fetches 3, and waits for 2
+        while len(fetched) < 2:
+            sleep(0.001)
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(sorted(fetched), [(1, 2), (3,)])
+        self.assertIn({2: 4, 3: 6}, results)
+
+    def test_failedLookups(self):
+        cache = LookupCache(error_ttl=60)
+        error = FBchatFacebookError('Not found', fb_error_code=1357031)
+        calls = []
+
+        def fetch(*keys):
+            calls.append(keys)
+            return {}, dict((key, error) for key in keys)
+
+        raised = []
+        for i in range(3):
+            with self.assertRaises(FBchatFacebookError) as context:
+                cache.lookup(['1'], fetch)
+            raised.append(context.exception)
+        # Remembered, so only fetched once, and every caller gets its own exception
+        self.assertEqual(calls, [('1',)])
+        self.assertEqual(len(set(id(e) for e in raised)), 3)
+        self.assertTrue(all(e.__cause__ is error and e.fb_error_code == '1357031' for e in raised))
+        cache.forget('1')
+        self.assertRaises(FBchatFacebookError, cache.lookup, ['1'], fetch)
+        self.assertEqual(len(calls), 2)
+
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+@unittest.skipIf(Image is None, 'Pillow is not installed')
+class TestImageResizer(unittest.TestCase):
+    def image(self, image_format, frames=1, size=(1200, 900), prefix=b'', **kwargs):
+        """Returns a noisy image, so it compresses badly, as a file object positioned after `prefix`"""
+        images = [Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3)) for i in range(frames)]
+        f = BytesIO()
+        f.write(prefix)
+        images[0].save(f, image_format, save_all=frames > 1, append_images=images[1:], **kwargs)
+        f.seek(len(prefix))
+        return f
+
+    def test_resize(self):
+        resizer = ImageResizer(max_dimension=600, min_size=1024, workers=1)
+        f = self.image('JPEG', prefix=b'prefix', quality=95)
+        resized = resizer.resize(f, 'image/jpeg')
+        self.assertIsNot(resized, f)
+        self.assertEqual(Image.open(resized).size, (600, 450))
+        self.assertEqual(resizer.images, 1)
+        self.assertGreater(resizer.bytes_saved, 0)
+
+    def test_animated(self):
+        resizer = ImageResizer(max_dimension=100, min_size=1024, workers=1)
+        for image_format, mimetype in [('GIF', 'image/gif'), ('PNG', 'image/png'), ('WEBP', 'image/webp')]:
+            f = self.image(image_format, frames=3, size=(300, 200))
+            original = f.getvalue()
+            resized = resizer.resize(f, mimetype)
+            # Left alone, and read from where it was
+            self.assertIs(resized, f)
+            self.assertEqual(resized.read(), original)
+        self.assertEqual(resizer.images, 0)
+
+    def test_decompressionBomb(self):
+        resizer = ImageResizer(max_dimension=100, min_size=1024, workers=1)
+        f = self.image('PNG', prefix=b'prefix', size=(300, 200))
+        original = f.getvalue()[len(b'prefix'):]
+        max_image_pixels, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, 1000
+        try:
+            resized = resizer.resize(f, 'image/png')
+        finally:
+            Image.MAX_IMAGE_PIXELS = max_image_pixels
+        # Left alone, and read from where it was
+        self.assertIs(resized, f)
+        self.assertEqual(resized.read(), original)
+        self.assertEqual(resizer.images, 0)
+
+
+class TestSendQueue(FakeTestCase):
+    def setUp(self):
+        super(TestSendQueue, self).setUp()
+        self.sent = self.record('_doSendRequest')
+
+    def test_order(self):
+        submitted = [(str(i % 3), '{}'.format(i)) for i in range(12)]
+        with SendQueue(self.client, workers=4, rate=1000) as queue:
+            futures = [queue.sendMessage(body, thread_id=thread_id, thread_type=ThreadType.USER) for thread_id, body in submitted]
+        self.assertEqual(sorted(future.result() for future in futures), sorted('mid.$fake{}'.format(i) for i in range(1, 13)))
+        # The threads are sent to concurrently, but the messages of each thread are sent in the order they were submitted
+        sent = [(args[0]['other_user_fbid'], args[0]['body']) for args, kwargs in self.sent]
+        for thread_id in '012':
+            self.assertEqual([m for m in sent if m[0] == thread_id], [m for m in submitted if m[0] == thread_id])
+
+    def test_noRetryAfterSending(self):
+        # Facebook got the message, but the response is unexpected
+        self.fake.routes[('POST', '/messaging/send/')] = lambda handler, url, body: (200, _json({'payload': {}}), {})
+        with SendQueue(self.client, rate=1000, backoff=0) as queue:
+            future = queue.sendMessage('test', thread_id='1234')
+        self.assertRaises(FBchatException, future.result)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_retryConnectionErrors(self):
+        self.client.req_url.SEND = 'http://127.0.0.1:1/messaging/send/'
+        with SendQueue(self.client, rate=1000, max_retries=2, backoff=0) as queue:
+            future = queue.sendMessage('test', thread_id='1234')
+        self.assertRaises(requests.ConnectionError, future.result)
+        # Retried with the same IDs, so Facebook could recognize a message it got twice
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(len(set(args[0]['offline_threading_id'] for args, kwargs in self.sent)), 1)
+
+
+class TestSendMessageToMany(FakeTestCase):
+    def test_duplicateTargets(self):
+        targets = [('1', ThreadType.USER), User('2'), ('1', ThreadType.USER), ('3', ThreadType.GROUP)]
+        results = self.client.sendMessageToMany('test', targets, rate=1000)
+        # Every thread gets the message once, with a result of its own
+        self.assertEqual(sorted(results), ['1', '2', '3'])
+        self.assertEqual(sorted(results.values()), ['mid.$fake1', 'mid.$fake2', 'mid.$fake3'])
+        self.assertEqual(self.fake.counts, {'/messaging/send/': 3})
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        metrics = Metrics(buckets=(1, 2, 4))
+        for value in [0.5, 1.5, 1.5, 3, 10]:
+            metrics.observe('latency', value, endpoint='SEND')
+        histogram = metrics.histogram('latency', endpoint='SEND')
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual((histogram.count, histogram.sum), (5, 16.5))
+        self.assertEqual(histogram.quantile(0.5), 1.75)
+        self.assertEqual(histogram.quantile(1), 4)
+        self.assertIsNone(metrics.histogram('latency', endpoint='STICKY'))
+
+    def test_snapshot(self):
+        metrics = Metrics(buckets=(1, 2))
+        metrics.count('requests', endpoint='SEND')
+        metrics.count('requests', 2, endpoint='SEND')
+        metrics.observe('latency', 1.5)
+        snapshot = metrics.snapshot(reset=True)
+        self.assertEqual(snapshot['counters'], {'requests': [{'labels': {'endpoint': 'SEND'}, 'value': 3}]})
+        self.assertEqual(snapshot['histograms'], {'latency': [{'labels': {}, 'buckets': [[1, 0], [2, 1], [float('inf'), 1]], 'sum': 1.5, 'count': 1}]})
+        self.assertEqual(metrics.snapshot(), {'counters': {}, 'histograms': {}})
+
+        # Merged twice, once with extra labels
+        metrics.merge(snapshot)
+        metrics.merge(snapshot)
+        metrics.merge(snapshot, shard='1')
+        self.assertEqual(metrics.histogram('latency').counts, [0, 2, 0])
+        counters = metrics.snapshot()['counters']['requests']
+        self.assertEqual(sorted((sorted(c['labels'].items()), c['value']) for c in counters), [
+            ([('endpoint', 'SEND')], 6),
+            ([('endpoint', 'SEND'), ('shard', '1')], 3),
+        ])
+        other = Metrics(buckets=(1, 3))
+        other.observe('latency', 1)
+        self.assertRaises(FBchatUserError, other.merge, snapshot)
+
+    def test_prometheus(self):
+        metrics = Metrics(buckets=(1,))
+        metrics.count('requests', endpoint='SEND', status='200')
+        metrics.observe('latency', 0.5, endpoint='a "quoted" name')
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.prom')
+        try:
+            metrics.export(PrometheusExporter(path))
+            with open(path) as f:
+                text = f.read()
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        self.assertEqual(text.splitlines(), [
+            '# TYPE requests counter',
+            'requests{endpoint="SEND",status="200"} 1',
+            '# TYPE latency histogram',
+            'latency_bucket{endpoint="a \\"quoted\\" name",le="1"} 1',
+            'latency_bucket{endpoint="a \\"quoted\\" name",le="+Inf"} 1',
+            'latency_sum{endpoint="a \\"quoted\\" name"} 0.5',
+            'latency_count{endpoint="a \\"quoted\\" name"} 1',
+        ])
+
+
+class TestRequestMetrics(FakeTestCase):
+    def test_requests(self):
+        client = self.client
+        client.metrics = Metrics()
+        client.sendMessage('test', thread_id='1234', thread_type=ThreadType.USER)
+        counters = client.metrics.snapshot()['counters']
+        self.assertEqual(counters['fbchat_requests_total'], [{'labels': {'endpoint': 'SEND', 'method': 'POST', 'status': '200'}, 'value': 1}])
+        self.assertEqual(client.metrics.histogram('fbchat_request_duration_seconds', endpoint='SEND').count, 1)
+        self.assertGreater(counters['fbchat_request_bytes_total'][0]['value'], 0)
+
+
+class TestReceiptBatcher(FakeTestCase):
+    def test_receiptBatcher(self):
+        self.client.receipt_batcher = ReceiptBatcher(self.client, interval=60)
+        for i in range(3):
+            self.assertTrue(self.client.markAsDelivered('1234', 'mid.{}'.format(i)))
+            self.assertTrue(self.client.markAsRead('1234'))
+            self.assertTrue(self.client.markAsSeen())
+        self.client.markAsRead('5678')
+        self.assertEqual(len(self.client.receipt_batcher), 4)
+        self.assertEqual(self.fake.counts, {})
+
+        self.client.stopListening()
+        self.assertEqual(len(self.client.receipt_batcher), 0)
+        self.assertEqual(self.fake.counts, {
+            '/ajax/mercury/delivery_receipts.php': 1,
+            '/ajax/mercury/change_read_status.php': 2,
+            '/ajax/mercury/mark_seen.php': 1,
+        })
+        self.client.receipt_batcher.close()
+        self.assertRaises(FBchatUserError, self.client.markAsSeen)
+
+    def test_receiptBatcherInterval(self):
+        with ReceiptBatcher(self.client, interval=0.01) as batcher:
+            batcher.markAsSeen()
+            # Sent by the timer, without flushing
+            for i in range(100):
+                if self.fake.counts:
+                    break
+                sleep(0.01)
+            self.assertEqual(self.fake.counts, {'/ajax/mercury/mark_seen.php': 1})
+            self.assertEqual(len(batcher), 0)
+
+
+class TestTypingManager(FakeTestCase):
+    def setUp(self):
+        super(TestTypingManager, self).setUp()
+        self.calls = self.record('setTypingStatus')
+
+    def statuses(self):
+        return [(kwargs['thread_id'], args[0]) for args, kwargs in self.calls]
+
+    def test_typing(self):
+        with TypingManager(self.client, linger=60) as typing:
+            for i in range(3):
+                with typing('1234'):
+                    pass
+            typing('5678', ThreadType.GROUP)
+            typing.stop('5678')
+        # `TYPING` is only sent once per thread, and `STOPPED` when the thread stops or the manager closes
+        self.assertEqual(self.statuses(), [
+            ('1234', TypingStatus.TYPING),
+            ('5678', TypingStatus.TYPING),
+            ('5678', TypingStatus.STOPPED),
+            ('1234', TypingStatus.STOPPED),
+        ])
+        self.assertEqual(self.fake.counts, {'/ajax/messaging/typ.php': 4})
+        self.assertRaises(FBchatUserError, typing, '1234')
+
+    def test_idle(self):
+        with TypingManager(self.client, idle=0.01) as typing:
+            typing('1234')
+            for i in range(100):
+                if len(self.calls) == 2:
+                    break
+                sleep(0.01)
+            self.assertEqual(self.statuses(), [('1234', TypingStatus.TYPING), ('1234', TypingStatus.STOPPED)])
+
+
+class TestListening(FakeTestCase):
+    def test_enableMetrics(self):
+        def onMessage(**kwargs):
+            # Starts recording metrics when a message is received
+            if self.client.metrics is None:
+                self.client.metrics = Metrics()
+
+        self.client.onMessage = onMessage
+        self.client._parseMessage({'ms': [payloads.new_message_delta(i) for i in range(3)]})
+        # Only the messages received after enabling them are recorded
+        self.assertEqual(self.client.metrics.histogram('fbchat_parse_duration_seconds', type='NewMessage').count, 2)
+        self.assertEqual(self.client.metrics.histogram('fbchat_handler_duration_seconds', hook='onMessage').count, 2)
+
+
+
+class TestTracing(FakeTestCase):
+    def test_sendFromHook(self):
+        exporter = MemorySpanExporter()
+        self.client.tracer = Tracer([exporter])
+        queue = SendQueue(self.client, rate=1000)
+
+        def onMessage(thread_id=None, thread_type=None, **kwargs):
+            self.client.sendMessage('Reply', thread_id=thread_id, thread_type=thread_type)
+            queue.sendMessage('Queued reply', thread_id=thread_id, thread_type=thread_type)
+
+        self.client.onMessage = onMessage
+        self.fake.push(self.client.uid, payloads.new_message_delta(0))
+        self.client.startListening()
+        self.client.doOneListen()
+        queue.close()
+
+        spans = dict((span.span_id, span) for span in exporter.spans)
+        [hook] = [span for span in spans.values() if span.name == 'onMessage']
+        sends = [span for span in spans.values() if span.name == 'POST SEND']
+        self.assertEqual(len(sends), 2)
+        # Both sends are part of the hook, even the one sent by a worker of the queue
+        self.assertEqual([span.parent_id for span in sends], [hook.span_id] * 2)
+        self.assertEqual(len(set(span.thread_id for span in sends)), 2)
+        # The hook is part of the listening cycle that received the message
+        self.assertEqual(spans[hook.parent_id].name, '_parseMessage')
+        self.assertEqual(spans[spans[hook.parent_id].parent_id].name, 'doOneListen')
+        # Decoding the response of each send is traced too, in the thread that sent it
+        decoding = [span for span in spans.values() if span.name == 'check_request' and span.parent_id == hook.span_id]
+        self.assertEqual(sorted(span.thread_id for span in decoding), sorted(span.thread_id for span in sends))
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'Needs os.fork')
+class TestAfterFork(FakeTestCase):
+    def fork(self, child, locks=()):
+        """Runs `child` in a forked process while `locks` are held by the parent, and returns what it returned"""
+        read, write = os.pipe()
+        for lock in locks:
+            lock.acquire()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read)
+                os.write(write, json.dumps(child()).encode('utf-8'))
+            finally:
+                os._exit(0)
+        for lock in locks:
+            lock.release()
+        os.close(write)
+        try:
+            ready, _, _ = select.select([read], [], [], 10)
+            if not ready:
+                os.kill(pid, 9)
+                self.fail('The child process is stuck')
+            result = os.read(read, 65536)
+        finally:
+            os.close(read)
+            os.waitpid(pid, 0)
+        self.assertTrue(result, 'The child process failed')
+        return json.loads(result.decode('utf-8'))
+
+    def test_afterFork(self):
+        client = self.client
+        client.message_index = MessageIndex()
+        client.message_index.add('1234', Message('mid.1', text='hello there'))
+        client.upload_cache = UploadCache()
+        client.upload_cache.set(client.uid, 'sha256:abc', '5678', 'image/png')
+        client.thread_index = ThreadIndex()
+        client.thread_index.add(graphql_to_user(payloads.user_node(1)))
+        client.metrics = Metrics()
+        client.metrics.count('parent')
+        client.receipt_batcher = ReceiptBatcher(client, interval=60)
+        client.markAsRead('1234')
+        client.sticky, client.pool = 'sticky', 'pool'
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        memory = MemorySpanExporter()
+        client.tracer = Tracer([memory, TraceFileExporter(os.path.join(directory, 'trace.json'))])
+        client._sendSeenReceipt()
+        typing = TypingManager(client)
+
+        def child():
+            client.afterFork()
+            typing.afterFork()
+            client.message_index.add('1234', Message('mid.2', text='hello again'))
+            client.metrics.count('child')
+            with typing:
+                typing('1234')
+            return {
+                'client_id': client.client_id,
+                'sticky': client.sticky,
+                'messages': sorted(m.uid for m in client.message_index.search('hello')['1234']),
+                'upload': list(client.upload_cache.get(client.uid, 'sha256:abc')),
+                'threads': [t.uid for t in client.thread_index.search(payloads.user_node(1)['name'])],
+                'counters': sorted(client.metrics.snapshot()['counters']),
+                'receipts': len(client.receipt_batcher),
+                'spans': [span.name for span in memory.spans],
+                'trace': client.tracer.exporters[1].path,
+                'pid': os.getpid(),
+            }
+
+        result = self.fork(child, locks=[
+            client.thread_index._lock, client.metrics._lock, client.receipt_batcher._lock, memory._lock, client.tracer.exporters[1]._lock
+        ])
+        self.assertNotEqual(result['client_id'], client.client_id)
+        self.assertIsNone(result['sticky'])
+        self.assertEqual(result['messages'], ['mid.1', 'mid.2'])
+        self.assertEqual(result['upload'], ['5678', 'image/png', None])
+        self.assertEqual(result['threads'], [graphql_to_user(payloads.user_node(1)).uid])
+        # The parent's metrics and receipts stay in the parent
+        self.assertIn('child', result['counters'])
+        self.assertNotIn('parent', result['counters'])
+        self.assertEqual(result['receipts'], 0)
+        self.assertEqual(len(client.receipt_batcher), 1)
+        self.assertEqual(self.fake.counts.get('/ajax/messaging/typ.php'), 2)
+        # The parent's database is left alone
+        self.assertEqual(len(client.message_index), 1)
+        typing.close()
+
+        # The child traces to a file of its own
+        self.assertEqual(result['trace'], os.path.join(directory, 'trace.{}.json'.format(result['pid'])))
+        self.assertNotIn('POST MARK_SEEN', result['spans'])
+        self.assertIn('POST TYPING', result['spans'])
+        client.tracer.close()
+        for path, pid in [(os.path.join(directory, 'trace.json'), os.getpid()), (result['trace'], result['pid'])]:
+            with open(path) as f:
+                events = json.loads(f.read().rstrip().rstrip(',') + ']')
+            self.assertTrue(events)
+            self.assertEqual(set(event['pid'] for event in events), set([pid]))
+
+
+
+class CrashingClient(Client):
+    """Crashes its listening loop on every new message. A hook of the worker processes, so it can't be set on an instance"""
+    def onMessage(self, mid=None, **kwargs):
+        raise RuntimeError('Crashed on {}'.format(mid))
+
+    def onMessageError(self, exception=None, msg={}):
+        raise exception
+
+    def onListenError(self, exception=None):
+        raise exception
+
+
+class TestSupervisor(FakeTestCase):
+    def setUp(self):
+        super(TestSupervisor, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.restart_delay, workers.RESTART_DELAY = workers.RESTART_DELAY, 0.1
+        self.fake.pull_timeout = 0.1
+        # Every pull moves the listening position forward, like on Facebook. `seqs` are the positions the pulls were sent with
+        self.seqs, self.crashes = [], []
+        pull = self.fake.routes[('GET', '/pull')]
+
+        def counting_pull(handler, url, body):
+            query = parse_qs(url.query)
+            if 'sticky_token' not in query:
+                return pull(handler, url, body)
+            self.seqs.append(int(query['seq'][0]))
+            status, content, headers = pull(handler, url, body)
+            j = json.loads(content[len('for (;;);'):])
+            j['seq'] = len(self.seqs)
+            if j.get('ms'):
+                self.crashes.append(len(self.seqs))
+            return status, _json(j), headers
+
+        self.fake.routes[('GET', '/pull')] = counting_pull
+        # Logging in with the login form fails
+        self.fake.routes[('POST', '/login.php')] = self.fake.routes[('GET', '/login.php')]
+
+    def tearDown(self):
+        workers.RESTART_DELAY = self.restart_delay
+        shutil.rmtree(self.directory)
+        super(TestSupervisor, self).tearDown()
+
+    def waitFor(self, condition):
+        for i in range(100):
+            if condition():
+                return
+            sleep(0.1)
+        self.fail('Timed out')
+
+    def test_restart(self):
+        session_file = os.path.join(self.directory, 'session.json')
+        accounts = [Account(self.client.email, session_file=session_file, state=self.client.getState()), Account('failing', 'password')]
+        supervisor = Supervisor(
+            accounts, client_class=CrashingClient, processes=1, checkpoint_interval=1,
+            client_kwargs={'logging_level': logging.ERROR, 'max_tries': 1},
+        )
+        started, crashed, failed = [], [], []
+        supervisor.onWorkerStarted = lambda shard=None, pid=None: started.append(pid)
+        supervisor.onWorkerCrashed = lambda shard=None, exitcode=None, delay=None: crashed.append((shard, exitcode, delay))
+        supervisor.onAccountFailed = lambda account=None, error=None: failed.append(account)
+
+        supervisor.start()
+        try:
+            for i in range(2):
+                self.fake.push(self.client.uid, payloads.new_message_delta(i))
+                self.waitFor(lambda: len(started) == i + 2 and len(self.seqs) > self.crashes[-1])
+        finally:
+            supervisor.stop()
+
+        # Restarted after a delay that doubles on every crash in a row
+        self.assertEqual(crashed, [(0, 1, 0.1), (0, 1, 0.2)])
+        self.assertEqual(len(set(started)), 3)
+        restarts = supervisor.metrics.snapshot()['counters']['fbchat_worker_restarts_total']
+        self.assertEqual(restarts, [{'labels': {'shard': '0'}, 'value': 2}])
+        # The restarted workers continue from the position the crashed ones were at, without logging in again
+        self.assertEqual([self.seqs[crash] for crash in self.crashes], self.crashes)
+        self.assertEqual(supervisor.states[0]['seq'], len(self.seqs))
+        with open(session_file) as f:
+            self.assertEqual(json.load(f), supervisor.states[0]['cookies'])
+        # The failing account is only logged in once
+        self.assertEqual(failed, [accounts[1]])
+        self.assertEqual(list(supervisor.failed), [1])
+        self.assertEqual(self.fake.counts['/login.php'], 1)
+        # The metrics of every worker are merged, even of the ones that crashed
+        pulls = supervisor.metrics.histogram('fbchat_pull_messages')
+        self.assertEqual((pulls.count, pulls.sum), (len(self.seqs), 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
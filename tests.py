@@ -8,9 +8,21 @@ import unittest
 from getpass import getpass
 from sys import argv
 from os import path, chdir
+from threading import Thread
 from glob import glob
+from shutil import rmtree
+from tempfile import mkdtemp
 from fbchat import Client
 from fbchat.models import *
+from fbchat.export import Exporter, SQLiteWriter
+from fbchat.index import MessageIndex, ThreadIndex
+from fbchat.contacts import ContactTable
+from fbchat.sending import SendQueue, ReceiptBatcher, TypingManager
+from fbchat.cache import UploadCache
+from fbchat.metrics import Metrics, PrometheusExporter
+from fbchat.tracing import Tracer, MemorySpanExporter
+from fbchat.workers import Supervisor, Account
+from time import sleep
 import py_compile
 
 logging_level = logging.ERROR
@@ -62,6 +74,13 @@ class TestFbchat(unittest.TestCase):
 
         self.assertTrue(client.isLoggedIn())
 
+    def test_getState(self):
+        state_client = Client(None, None, state=client.getState(), logging_level=logging_level)
+        state_client.afterFork()
+        self.assertEqual(state_client.uid, client.uid)
+        self.assertNotEqual(state_client.client_id, client.client_id)
+        self.assertTrue(state_client.isLoggedIn())
+
     def test_defaultThread(self):
         # setDefaultThread
         client.setDefaultThread(group_id, ThreadType.GROUP)
@@ -79,6 +98,21 @@ class TestFbchat(unittest.TestCase):
         users = client.fetchAllUsers()
         self.assertGreater(len(users), 0)
 
+    def test_fetchContactTable(self):
+        table = client.fetchContactTable()
+        self.assertGreater(len(table), 0)
+        self.assertEqual(table.update(client._fetchAllUsersPayload())[:2], (0, 0))
+
+        directory = mkdtemp()
+        try:
+            table_path = path.join(directory, 'contacts.bin')
+            table.save(table_path)
+            loaded = ContactTable.load(table_path)
+            self.assertEqual(sorted(loaded.rows), sorted(table.rows))
+            del loaded
+        finally:
+            rmtree(directory)
+
     def test_searchFor(self):
         users = client.searchForUsers('Mark Zuckerberg')
         self.assertGreater(len(users), 0)
@@ -96,6 +130,28 @@ class TestFbchat(unittest.TestCase):
         groups = client.searchForGroups('té')
         self.assertGreater(len(groups), 0)
 
+    def test_searchForIndexed(self):
+        client.thread_index = ThreadIndex()
+        client.thread_index.refresh(client, thread_pages=1)
+        self.assertGreater(len(client.thread_index), 0)
+
+        group = client.fetchGroupInfo(group_id)[group_id]
+        groups = client.searchForGroups(group.name)
+        self.assertEqual(groups[0].uid, group_id)
+
+        client.thread_index = None
+
+    def test_searchForMessages(self):
+        client.message_index = MessageIndex()
+        client.sendMessage('test_searchForMessages★', thread_id=user_id, thread_type=ThreadType.USER)
+        client.fetchThreadMessages(thread_id=user_id, limit=1)
+
+        messages = client.searchForMessages('test_searchForMessages', thread_id=user_id)[user_id]
+        self.assertEqual(messages[0].text, 'test_searchForMessages★')
+
+        client.message_index = None
+        self.assertEqual(client.searchForMessages('test_searchForMessages'), {})
+
     def test_sendEmoji(self):
         self.assertIsNotNone(client.sendEmoji(size=EmojiSize.SMALL, thread_id=user_id, thread_type=ThreadType.USER))
         self.assertIsNotNone(client.sendEmoji(size=EmojiSize.MEDIUM, thread_id=user_id, thread_type=ThreadType.USER))
@@ -113,6 +169,30 @@ class TestFbchat(unittest.TestCase):
         with self.assertRaises(Exception):
             client.sendMessage('test_send_group_should_fail★', group_id, ThreadType.USER)
 
+    def test_sendMessageToMany(self):
+        message_ids = client.sendMessageToMany('test_sendMessageToMany★', [(user_id, ThreadType.USER), (group_id, ThreadType.GROUP)])
+        self.assertEqual(set(message_ids), {user_id, group_id})
+        self.assertFalse(any(isinstance(message_id, Exception) for message_id in message_ids.values()))
+
+    def test_sendQueue(self):
+        with SendQueue(client) as queue:
+            futures = [queue.sendMessage('test_sendQueue_{}★'.format(i), user_id, ThreadType.USER) for i in range(3)]
+            futures.append(queue.sendMessage('test_sendQueue★', group_id, ThreadType.GROUP))
+        self.assertTrue(all(future.result() for future in futures))
+
+        messages = client.fetchThreadMessages(thread_id=user_id, limit=3)
+        self.assertEqual([m.text for m in messages], ['test_sendQueue_{}★'.format(i) for i in reversed(range(3))])
+
+    def test_receiptBatcher(self):
+        with ReceiptBatcher(client, interval=60) as batcher:
+            client.receipt_batcher = batcher
+            for thread_id in [user_id, group_id] * 3:
+                self.assertTrue(client.markAsRead(thread_id))
+            client.markAsSeen()
+            self.assertEqual(len(batcher), 3)
+            self.assertEqual(batcher.flush(), 0)
+        client.receipt_batcher = None
+
     def test_sendImages(self):
         image_url = 'https://cdn4.iconfinder.com/data/icons/ionicons/512/icon-image-128.png'
         image_local_url = path.join(path.dirname(__file__), 'tests/image.png')
@@ -121,6 +201,50 @@ class TestFbchat(unittest.TestCase):
         self.assertTrue(client.sendLocalImage(image_local_url, 'test_send_group_images_local★', user_id, ThreadType.USER))
         self.assertTrue(client.sendLocalImage(image_local_url, 'test_send_group_images_local★', group_id, ThreadType.GROUP))
 
+    def test_sendLocalFile(self):
+        file_path = path.join(path.dirname(__file__), 'tests/image.png')
+        progress = []
+        self.assertTrue(client.sendLocalFile(file_path, 'test_send_local_file★', user_id, ThreadType.USER, callback=lambda *args: progress.append(args)))
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        self.assertTrue(client.sendLocalFile(file_path, 'test_send_local_file★', group_id, ThreadType.GROUP))
+
+    def test_sendFiles(self):
+        image_url = 'https://cdn4.iconfinder.com/data/icons/ionicons/512/icon-image-128.png'
+        image_local_url = path.join(path.dirname(__file__), 'tests/image.png')
+        self.assertTrue(client.sendRemoteFiles([image_url, image_url], 'test_send_remote_files★', user_id, ThreadType.USER))
+        self.assertTrue(client.sendLocalFiles([image_local_url, image_local_url], 'test_send_local_files★', group_id, ThreadType.GROUP))
+
+    def test_uploadCache(self):
+        client.upload_cache = UploadCache()
+        file_path = path.join(path.dirname(__file__), 'tests/image.png')
+        self.assertTrue(client.sendLocalFile(file_path, 'test_upload_cache★', user_id, ThreadType.USER))
+        self.assertEqual(len(client.upload_cache), 1)
+        # Sent without uploading the image again
+        self.assertTrue(client.sendLocalFile(file_path, 'test_upload_cache★', group_id, ThreadType.GROUP))
+        client.upload_cache = None
+
+    def test_metrics(self):
+        client.metrics = Metrics()
+        try:
+            client.sendMessage('test_metrics★', thread_id=user_id, thread_type=ThreadType.USER)
+            client.fetchThreadList()
+        finally:
+            metrics, client.metrics = client.metrics, None
+        self.assertEqual(metrics.histogram('fbchat_request_duration_seconds', endpoint='SEND').count, 1)
+        self.assertIn('fbchat_requests_total{endpoint="SEND",method="POST",status="200"} 1', PrometheusExporter.render(metrics.snapshot()))
+
+    def test_tracing(self):
+        spans = MemorySpanExporter()
+        client.tracer = Tracer([spans])
+        try:
+            with client.tracer.span('test_tracing') as root:
+                client.sendMessage('test_tracing★', thread_id=user_id, thread_type=ThreadType.USER)
+        finally:
+            client.tracer = None
+        self.assertIn('POST SEND', [span.name for span in spans.spans])
+        self.assertIs(spans.spans[-1], root)
+        self.assertTrue(all(span.trace_id == root.trace_id for span in spans.spans))
+
     def test_fetchThreadList(self):
         client.fetchThreadList(offset=0, limit=20)
 
@@ -137,6 +261,14 @@ class TestFbchat(unittest.TestCase):
         self.assertEqual(messages[0].author, client.uid)
         self.assertEqual(messages[0].text, 'test_group_getThreadInfo★')
 
+    def test_export(self):
+        exporter = Exporter(client, SQLiteWriter(':memory:'))
+        thread = client.fetchThreadInfo(user_id)[user_id]
+
+        self.assertGreater(exporter.exportThread(thread), 0)
+        # Everything has already been exported
+        self.assertEqual(exporter.exportThread(thread), 0)
+
     def test_listen(self):
         client.startListening()
         client.doOneListen()
@@ -144,6 +276,33 @@ class TestFbchat(unittest.TestCase):
 
         self.assertTrue(client.got_qprimer)
 
+    def test_listenMetrics(self):
+        client.metrics = Metrics()
+        try:
+            client.startListening()
+            client.doOneListen()
+            client.stopListening()
+        finally:
+            metrics, client.metrics = client.metrics, None
+        self.assertEqual(metrics.histogram('fbchat_pull_messages').count, 1)
+        self.assertIsNotNone(metrics.histogram('fbchat_handler_duration_seconds', hook='onQprimer'))
+
+    def test_supervisor(self):
+        # `client` keeps being used, so the worker gets a client ID and listening position of its own
+        state_client = Client(None, None, state=client.getState(), logging_level=logging_level)
+        state_client.afterFork()
+        supervisor = Supervisor([Account(client.email, state=state_client.getState())], checkpoint_interval=1, client_kwargs={'logging_level': logging_level})
+        supervisor.start()
+        try:
+            for i in range(30):
+                if supervisor.metrics.histogram('fbchat_pull_messages') is not None:
+                    break
+                sleep(1)
+        finally:
+            supervisor.stop()
+        self.assertEqual(supervisor.states[0]['uid'], client.uid)
+        self.assertIsNotNone(supervisor.metrics.histogram('fbchat_pull_messages'))
+
     def test_fetchInfo(self):
         info = client.fetchUserInfo('4')['4']
         self.assertEqual(info.name, 'Mark Zuckerberg')
@@ -151,10 +310,27 @@ class TestFbchat(unittest.TestCase):
         info = client.fetchGroupInfo(group_id)[group_id]
         self.assertEqual(info.type, ThreadType.GROUP)
 
+    def test_fetchInfoConcurrently(self):
+        results = []
+        threads = [Thread(target=lambda: results.append(client.fetchThreadInfo(group_id, user_id))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(r[group_id].uid == group_id for r in results))
+
     def test_removeAddFromGroup(self):
         client.removeUserFromGroup(user_id, thread_id=group_id)
         client.addUsersToGroup(user_id, thread_id=group_id)
 
+    def test_setGroupParticipants(self):
+        group = client.fetchGroupInfo(group_id)[group_id]
+        participants = set(group.participants)
+        self.assertEqual(client.setGroupParticipants(participants - {user_id}, group=group), {user_id: False})
+        self.assertEqual(client.setGroupParticipants(participants, group=group), {user_id: True})
+        self.assertEqual(group.participants, participants)
+
     def test_changeThreadTitle(self):
         client.changeThreadTitle('test_changeThreadTitle★', thread_id=group_id, thread_type=ThreadType.GROUP)
         client.changeThreadTitle('test_changeThreadTitle★', thread_id=user_id, thread_type=ThreadType.USER)
@@ -189,6 +365,29 @@ class TestFbchat(unittest.TestCase):
         client.setTypingStatus(TypingStatus.TYPING, thread_id=group_id, thread_type=ThreadType.GROUP)
         client.setTypingStatus(TypingStatus.STOPPED, thread_id=group_id, thread_type=ThreadType.GROUP)
 
+    def test_typingManager(self):
+        statuses = []
+        set_typing_status = client.setTypingStatus
+
+        def record(status, thread_id=None, thread_type=None):
+            # Only recorded if the request succeeded
+            set_typing_status(status, thread_id=thread_id, thread_type=thread_type)
+            statuses.append((thread_id, status))
+
+        client.setTypingStatus = record
+        try:
+            with TypingManager(client, linger=60) as typing:
+                for i in range(2):
+                    with typing(user_id, ThreadType.USER):
+                        client.sendMessage('test_typingManager★', thread_id=user_id, thread_type=ThreadType.USER)
+                typing(group_id, ThreadType.GROUP)
+        finally:
+            del client.setTypingStatus
+        # One `TYPING` per thread, and a `STOPPED` for each when the manager is closed
+        self.assertEqual(statuses[:2], [(user_id, TypingStatus.TYPING), (group_id, TypingStatus.TYPING)])
+        self.assertEqual(len(statuses), 4)
+        self.assertEqual(set(statuses[2:]), set([(user_id, TypingStatus.STOPPED), (group_id, TypingStatus.STOPPED)]))
+
 
 def start_test(param_client, param_group_id, param_user_id, tests=[]):
     global client